@@ -8,6 +8,9 @@ from collections import namedtuple
 
 from invisible_cities.core.system_of_units_c import units
 
+from antea.mcsim.errmat   import errmat
+from antea.mcsim.errmat3d import errmat3d
+
 db_data  = namedtuple('db_data', 'detector nsipms')
 
 
@@ -43,3 +46,53 @@ def db(request):
                 ids=["sim-only"])
 def db_sim_only(request):
     return request.param
+
+
+def write_fastmc_errmat(filename, xmin, dx, nx, shift):
+    """
+    Write an error matrix with a single, very narrow, error bin for each
+    coordinate bin, so that the error drawn for a coordinate is fixed.
+    """
+    matrix = np.zeros((nx, 50))
+    matrix[np.arange(nx), (7*np.arange(nx) + shift) % 50] = 1.
+    np.savez(filename, errmat=matrix, eff=np.ones(nx),
+             xmin=xmin, ymin=-1., dx=dx, dy=1.e-9)
+    return errmat(filename)
+
+
+def write_fastmc_errmat3d(filename, xmin, dx, nx, shift):
+    """
+    Write a 3D error matrix, binned in r as second coordinate, with a
+    single, very narrow, error bin for each cell, so that the error drawn
+    for a point is fixed. The cells of the first r bin (r < 365 mm) are
+    left empty.
+    """
+    ny     = 10
+    matrix = np.zeros((nx, ny, 50))
+    i, j   = np.meshgrid(np.arange(nx), np.arange(ny), indexing='ij')
+    matrix[i, j, (7*i + 3*j + shift) % 50] = 1.
+    matrix[:, 0] = 0
+    np.savez(filename, errmat=matrix, eff=np.ones(nx),
+             xmin=xmin, ymin=350., zmin=-1., dx=dx, dy=15., dz=1.e-9)
+    return errmat3d(filename)
+
+
+@pytest.fixture(scope = 'session')
+def fastmc_errmats(output_tmpdir):
+    """
+    Factory of the error matrices of r, phi, z and t, for photoelectric-like
+    and compton-like interactions, in the order taken by the fast MC.
+    With errmat3d=True, those of phi and z are also binned in r.
+    """
+    def make_errmats(errmat3d=False):
+        errmats = []
+        for i, (name, xmin, dx, nx) in enumerate([('r'  ,     0., 10., 100), ('phi', -np.pi, 0.1,   70),
+                                                  ('z'  , -1500., 30., 100), ('t'  ,   -10.,  1., 1000)]*2):
+            if errmat3d and name in ['phi', 'z']:
+                filename = os.path.join(output_tmpdir, 'errmat3d_{}_{}.npz'.format(name, i))
+                errmats.append(write_fastmc_errmat3d(filename, xmin, dx, nx, i))
+            else:
+                filename = os.path.join(output_tmpdir, 'errmat_{}_{}.npz'.format(name, i))
+                errmats.append(write_fastmc_errmat  (filename, xmin, dx, nx, i))
+        return errmats
+    return make_errmats
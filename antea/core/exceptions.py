@@ -10,3 +10,6 @@ class NoInputFiles(ANTEAException):
 
 class WaveformEmptyTable(ANTEAException):
     pass
+
+class UnsortedEventTable(ANTEAException):
+    """ Table rows are not ordered by event id """
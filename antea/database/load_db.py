@@ -59,3 +59,50 @@ order by pos.SensorID
     conn.close()
 
     return data
+
+
+class SiPMGeometry:
+    """
+    Compact geometry of the SiPMs of a database table (DataSiPM or
+    DataSiPMsim_only): contiguous arrays of X, Y, Z, PhiNumber and ZNumber
+    and a dense index (rows) giving the row of each sensor id in them,
+    -1 for the ids not in the table. The sensor ids must not be negative.
+    """
+    def __init__(self, data: pd.DataFrame):
+        if 'SensorID' not in data.columns:
+            data = data.reset_index()
+        self.sensor_ids = np.ascontiguousarray(data.SensorID .values, dtype='int64')
+        self.X          = np.ascontiguousarray(data.X        .values, dtype='float64')
+        self.Y          = np.ascontiguousarray(data.Y        .values, dtype='float64')
+        self.Z          = np.ascontiguousarray(data.Z        .values, dtype='float64')
+        self.PhiNumber  = np.ascontiguousarray(data.PhiNumber.values, dtype='int32')
+        self.ZNumber    = np.ascontiguousarray(data.ZNumber  .values, dtype='int32')
+        self.positions  = np.column_stack([self.X, self.Y, self.Z])
+
+        if np.any(self.sensor_ids < 0):
+            raise ValueError('Negative sensor ids {} cannot be indexed'
+                             .format(self.sensor_ids[self.sensor_ids < 0]))
+        self.rows = np.full(self.sensor_ids.max() + 1, -1, dtype='int64')
+        self.rows[self.sensor_ids] = np.arange(len(self.sensor_ids))
+
+    def __len__(self):
+        return len(self.sensor_ids)
+
+    def rows_of(self, sensor_ids):
+        """
+        Return the rows of the given sensor ids, raising KeyError
+        if any of them is not in the table.
+        """
+        sensor_ids = np.asarray(sensor_ids, dtype='int64')
+        rows       = np.full(len(sensor_ids), -1, dtype='int64')
+        known      = (sensor_ids >= 0) & (sensor_ids < len(self.rows))
+        rows[known] = self.rows[sensor_ids[known]]
+        if np.any(rows < 0):
+            raise KeyError('Sensors {} not in the database'.format(sensor_ids[rows < 0]))
+        return rows
+
+    def positions_of(self, sensor_ids):
+        """
+        Return the (x, y, z) positions of the given sensor ids.
+        """
+        return self.positions[self.rows_of(sensor_ids)]
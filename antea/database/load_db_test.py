@@ -7,6 +7,7 @@ import numpy as np
 
 from pytest  import fixture
 from pytest  import mark
+from pytest  import raises
 
 from . import load_db as DB
 
@@ -29,3 +30,28 @@ def test_sipm_pd_sim_only(db_sim_only):
 
 def test_mc_runs_equal_data_runs(db):
     assert (DB.DataSiPM(db.detector, -3550).values == DB.DataSiPM(db.detector, 3550).values).all()
+
+
+def test_sipm_geometry(db_sim_only):
+    """Check that the compact geometry gives the positions and numbers of the SiPMs of the table."""
+    sipms    = DB.DataSiPMsim_only(db_sim_only.detector)
+    geometry = DB.SiPMGeometry(sipms)
+    assert len(geometry) == db_sim_only.nsipms
+
+    sipms_idx  = sipms.set_index('SensorID')
+    sensor_ids = sipms.SensorID.values[::-7]
+    positions  = geometry.positions_of(sensor_ids)
+    rows       = geometry.rows_of(sensor_ids)
+    assert np.all(positions[:, 0] == sipms_idx.loc[sensor_ids].X.values)
+    assert np.all(positions[:, 1] == sipms_idx.loc[sensor_ids].Y.values)
+    assert np.all(positions[:, 2] == sipms_idx.loc[sensor_ids].Z.values)
+    assert np.all(geometry.PhiNumber[rows] == sipms_idx.loc[sensor_ids].PhiNumber.values)
+    assert np.all(geometry.ZNumber  [rows] == sipms_idx.loc[sensor_ids].ZNumber  .values)
+
+    with raises(KeyError):
+        geometry.positions_of([-1, sipms.SensorID.max() + 1])
+
+    negative = sipms.copy()
+    negative.loc[negative.index[0], 'SensorID'] = -1
+    with raises(ValueError):
+        DB.SiPMGeometry(negative)
@@ -1,17 +1,32 @@
+import os
 import tables as tb
+import numpy  as np
 import pandas as pd
 
 from invisible_cities.core         import system_of_units as units
 from invisible_cities.io.mcinfo_io import units_dict
 
-from typing import Mapping
+from antea.core.exceptions import UnsortedEventTable
+
+from typing import Iterator, Mapping, Sequence, Tuple
 
 str_length = 20
 
+mc_tables = ('hits', 'particles', 'waveforms', 'tof_waveforms')
+
 
 class mc_sns_response_writer:
-    """Add MC sensor response info to existing file."""
-    def __init__(self, filename: str, sns_df_name: str = 'waveforms_lut'):
+    """
+    Add MC sensor response info to existing file.
+    Rows are accumulated in buffers of buffer_size rows, which are
+    written in a single append when full and when the file is closed.
+    The buffers take the dtypes of the sensor ids and charges of the
+    given responses, so that the table columns have the same types as
+    when each event is appended on its own.
+    The table index is only created when the file is closed.
+    """
+    def __init__(self, filename: str, sns_df_name: str = 'waveforms_lut',
+                 buffer_size: int = 100000):
 
         self.filename = filename
         self.sns_df_name = sns_df_name
@@ -22,66 +37,314 @@ class mc_sns_response_writer:
 
         self.store = pd.HDFStore(filename, "a", complib=str("zlib"), complevel=4)
 
+        self.buffer_size = buffer_size
+        self.buffer      = None
+        self.n_rows      = 0
+
+
+    def write(self, waveforms: pd.DataFrame):
+        self.store.append('MC/'+self.sns_df_name, waveforms, format='t', data_columns=True, index=False)
+
+
+    def flush(self):
+        if self.n_rows:
+            self.write(pd.DataFrame({col: buf[:self.n_rows] for col, buf in self.buffer.items()}))
+        self.n_rows = 0
+
+
+    def allocate(self, sensor_ids: np.ndarray, charges: np.ndarray):
+        """
+        Allocate the buffers, with the dtypes of the given sensor ids and charges.
+        """
+        self.buffer = {'event_id':  np.empty(self.buffer_size, dtype=np.int64),
+                       'sensor_id': np.empty(self.buffer_size, dtype=sensor_ids.dtype),
+                       'time_bin':  np.zeros(self.buffer_size, dtype=np.int64),
+                       'charge':    np.empty(self.buffer_size, dtype=charges.dtype)}
+
 
     def close_file(self):
+        self.flush()
+        if 'MC/'+self.sns_df_name in self.store:
+            self.store.create_table_index('MC/'+self.sns_df_name)
         self.store.close()
 
 
     def __call__(self, sns_response: Mapping[int, Mapping[int, float]], evt_number: int):
 
         waveforms_dict = sns_response[evt_number]
-        waveforms = pd.DataFrame({'event_id':  [evt_number for i in range(len(waveforms_dict))],
-                                  'sensor_id': list(waveforms_dict.keys()),
-                                  'time_bin':  [0 for i in range(len(waveforms_dict))],
-                                  'charge':    list(waveforms_dict.values())})
-        self.store.append('MC/'+self.sns_df_name, waveforms, format='t', data_columns=True)
+        n_sns          = len(waveforms_dict)
+        if n_sns == 0:
+            return
+
+        sensor_ids = np.array(list(waveforms_dict.keys  ()))
+        charges    = np.array(list(waveforms_dict.values()))
+        if (self.buffer is None or
+            self.buffer['sensor_id'].dtype != sensor_ids.dtype or
+            self.buffer['charge']   .dtype != charges   .dtype):
+            self.flush()
+            self.allocate(sensor_ids, charges)
+
+        if self.n_rows + n_sns > self.buffer_size:
+            self.flush()
+
+        if n_sns > self.buffer_size:
+            self.write(pd.DataFrame({'event_id':  np.full(n_sns, evt_number, dtype=np.int64),
+                                     'sensor_id': sensor_ids,
+                                     'time_bin':  np.zeros(n_sns, dtype=np.int64),
+                                     'charge':    charges}))
+            return
+
+        rows = slice(self.n_rows, self.n_rows + n_sns)
+        self.buffer['event_id'] [rows] = evt_number
+        self.buffer['sensor_id'][rows] = sensor_ids
+        self.buffer['charge']   [rows] = charges
+        self.n_rows += n_sns
 
 
 class mc_writer:
-    """Copy MC true info to output file."""
-    def __init__(self, filename_in: str, filename_out: str):
+    """
+    Copy MC true info to output file.
+    The hits and particles of the selected events are read from the input
+    file in chunks of chunk_size rows, located with the event index of each
+    table, so that copying the events in increasing order reads each row
+    at most once, without loading the full tables in memory.
+    Tables not ordered by event id are loaded in full and the rows of each
+    event are selected with a mask (see event_cursor).
+    The selected events are accumulated until buffer_size rows are
+    collected, and written in a single append. The table indices are
+    only created when the file is closed.
+    """
+    def __init__(self, filename_in: str, filename_out: str,
+                 buffer_size: int = 100000, chunk_size: int = 100000):
 
         self.store = pd.HDFStore(filename_out, "a", complib=str("zlib"), complevel=4)
         conf = load_configuration(filename_in)
         self.store.append('MC/configuration', conf, format='t', data_columns=True)
 
-        self.hits      = load_mchits(filename_in)
-        self.particles = load_mcparticles(filename_in)
+        self.store_in  = pd.HDFStore(filename_in, "r")
+        self.hits_cursor      = event_cursor(self.store_in, 'MC/hits',      chunk_size)
+        self.particles_cursor = event_cursor(self.store_in, 'MC/particles', chunk_size)
+
+        self.buffer_size      = buffer_size
+        self.hits_buffer      = []
+        self.particles_buffer = []
+        self.n_rows           = 0
+
+
+    @property
+    def hits(self) -> pd.DataFrame:
+        """
+        All the hits of the input file (read on demand).
+        """
+        return self.store_in.select('MC/hits')
+
+
+    @property
+    def particles(self) -> pd.DataFrame:
+        """
+        All the particles of the input file (read on demand).
+        """
+        return self.store_in.select('MC/particles')
+
+
+    def flush(self):
+        if self.hits_buffer:
+            self.store.append('MC/hits',      pd.concat(self.hits_buffer),
+                              format='t', data_columns=True, index=False,
+                              min_itemsize={'label' : str_length})
+        if self.particles_buffer:
+            self.store.append('MC/particles', pd.concat(self.particles_buffer),
+                              format='t', data_columns=True, index=False,
+                              min_itemsize={'name' : str_length, 'initial_volume' : str_length,
+                                            'final_volume' : str_length, 'creator_proc': str_length})
+        self.hits_buffer      = []
+        self.particles_buffer = []
+        self.n_rows           = 0
 
 
     def close_file(self):
+        self.flush()
+        for table_name in ('MC/hits', 'MC/particles'):
+            if table_name in self.store:
+                self.store.create_table_index(table_name)
         self.store.close()
+        self.store_in.close()
 
 
     def __call__(self, evt_number: int):
 
-        evt_hits      = self.hits[self.hits.event_id == evt_number]
-        evt_particles = self.particles[self.particles.event_id == evt_number]
-        self.store.append('MC/hits',      evt_hits,      format='t', data_columns=True,
-                          min_itemsize={'label' : str_length})
-        self.store.append('MC/particles', evt_particles, format='t', data_columns=True,
-                          min_itemsize={'name' : str_length, 'initial_volume' : str_length,
-                                        'final_volume' : str_length, 'creator_proc': str_length})
+        evt_hits      = self.hits_cursor     (evt_number)
+        evt_particles = self.particles_cursor(evt_number)
+        self.hits_buffer     .append(evt_hits)
+        self.particles_buffer.append(evt_particles)
 
+        self.n_rows += len(evt_hits) + len(evt_particles)
+        if self.n_rows >= self.buffer_size:
+            self.flush()
 
-def read_sensor_bin_width_from_conf(h5f, tof=False):
+
+class event_cursor:
     """
-    Return the time bin width (either TOF or no TOF) with units.
+    Read the rows of given events from a MC table of an open HDFStore.
+    The rows of each event are located with the event index of the table;
+    when they are not in the chunk already in memory, a new chunk of at
+    least chunk_size rows is read, starting at the requested event.
+    If the table is not ordered by event id, it has no event index: the
+    whole table is read once and the rows of each event are selected
+    with a mask, in their order in the table.
+    """
+    def __init__(self, store: pd.HDFStore, table_name: str, chunk_size: int = 100000):
+
+        self.store      = store
+        self.table_name = table_name
+        self.chunk_size = chunk_size
+        event_ids       = store.select_column(table_name, 'event_id').values
+        try:
+            self.index      = EventIndex(event_ids)
+            self.chunk      = store.select(table_name, start=0, stop=0)
+            self.chunk_rows = slice(0, 0)
+        except UnsortedEventTable:
+            self.index      = None
+            self.chunk      = store.select(table_name)
+            self.chunk_rows = slice(0, len(self.chunk))
+
+
+    def __call__(self, evt_number: int) -> pd.DataFrame:
+
+        if self.index is None:
+            return self.chunk[self.chunk.event_id.values == evt_number]
+
+        rows = self.index.rows(evt_number)
+        if rows.start == rows.stop:
+            return self.chunk.iloc[:0]
+
+        if rows.start < self.chunk_rows.start or rows.stop > self.chunk_rows.stop:
+            stop            = max(rows.start + self.chunk_size, rows.stop)
+            self.chunk      = self.store.select(self.table_name, start=rows.start, stop=stop)
+            self.chunk_rows = slice(rows.start, rows.start + len(self.chunk))
+
+        first = rows.start - self.chunk_rows.start
+        return self.chunk.iloc[first:first + rows.stop - rows.start]
+
+
+class MCConfiguration(dict):
+    """
+    Parameters of the MC/configuration table of a file, as a dictionary
+    param_key -> param_value. Values given as a number followed by a unit
+    are converted to floats with the unit applied; any other value is
+    kept as a string. The parameters are also kept as a list of
+    (key, value) pairs in the order of the table, in rows.
+    """
+    def __init__(self, param_keys: Sequence, param_values: Sequence):
+
+        self.rows = [(decode_config_field(key), parse_config_value(decode_config_field(value)))
+                     for key, value in zip(param_keys, param_values)]
+        super().__init__(self.rows)
+
+
+    def last_match(self, *patterns: str):
+        """
+        Return the value of the last parameter whose key contains all the
+        given patterns, or None if there is no such parameter.
+        """
+        value = None
+        for key, val in self.rows:
+            if all(key.find(pattern) >= 0 for pattern in patterns):
+                value = val
+        return value
+
+
+    def quantity_match(self, *patterns: str) -> float:
+        """
+        Return the value of the last parameter whose key contains all the
+        given patterns, which must be a number followed by a unit, or None
+        if there is no such parameter.
+        """
+        value = self.last_match(*patterns)
+        if isinstance(value, str):
+            raise ValueError('Configuration parameter {} is not a number with units: {}'
+                             .format(' '.join(patterns), value))
+        return value
+
+
+    def sensor_bin_width(self, tof: bool = False) -> float:
+        """
+        Return the time bin width (either TOF or no TOF) with units.
+        """
+        binning = 'bin_size'
+        if tof:
+            binning = 'tof_bin_size'
+        return self.quantity_match(binning)
+
+
+    def sipm_bin_width(self) -> float:
+        """
+        Return the SiPM time bin width with units, 1 microsecond by default.
+        """
+        bin_width = self.quantity_match('time_binning', 'SiPM')
+        if bin_width is None:
+            bin_width = 1 * units.microsecond
+        return bin_width
+
+
+def decode_config_field(field) -> str:
+    if isinstance(field, bytes):
+        return field.decode('utf-8','ignore')
+    return field
+
+
+def parse_config_value(value: str):
+    fields = value.split()
+    if len(fields) == 2 and fields[1] in units_dict:
+        try:
+            return float(fields[0]) * units_dict[fields[1]]
+        except ValueError:
+            pass
+    return value
+
+
+_configurations = {}
+max_cached_configurations = 128
+
+
+def read_mc_configuration(h5f) -> MCConfiguration:
+    """
+    Return the parsed MC configuration of an open file. The configuration
+    table is read in a single call and the result is cached, keyed on the
+    path and the modification time of the file.
+    """
+    cache_key = (os.path.abspath(h5f.filename), os.path.getmtime(h5f.filename))
+    if cache_key not in _configurations:
+        h5config = h5f.get_node('/MC/configuration')
+        if isinstance(h5config, tb.Group): ## table written with pandas
+            h5config = h5config.table
+        config = h5config.read()
+
+        if len(_configurations) >= max_cached_configurations:
+            _configurations.pop(next(iter(_configurations)))
+        _configurations[cache_key] = MCConfiguration(config['param_key'], config['param_value'])
+
+    return _configurations[cache_key]
+
+
+def load_mc_configuration(file_name: str) -> MCConfiguration:
+    """
+    Return the parsed MC configuration of a file, opening it
+    only if it is not cached.
     """
+    cache_key = (os.path.abspath(file_name), os.path.getmtime(file_name))
+    if cache_key in _configurations:
+        return _configurations[cache_key]
 
-    h5config = h5f.root.MC.configuration
-    bin_width = None
-    binning = 'bin_size'
-    if tof:
-        binning = 'tof_bin_size'
-    for row in h5config:
-        param_name = row['param_key'].decode('utf-8','ignore')
-        if param_name.find(binning) >= 0:
-            param_value = row['param_value'].decode('utf-8','ignore')
-            numb, unit  = param_value.split()
-            bin_width = float(numb) * units_dict[unit]
+    with tb.open_file(file_name, 'r') as h5f:
+        return read_mc_configuration(h5f)
 
-    return bin_width
+
+def read_sensor_bin_width_from_conf(h5f, tof=False):
+    """
+    Return the time bin width (either TOF or no TOF) with units.
+    """
+    return read_mc_configuration(h5f).sensor_bin_width(tof)
 
 
 def load_mchits(file_name: str) -> pd.DataFrame:
@@ -117,3 +380,95 @@ def load_configuration(file_name: str) -> pd.DataFrame:
     conf = pd.read_hdf(file_name, 'MC/configuration')
 
     return conf
+
+
+class EventIndex:
+    """
+    Row ranges [start, stop) of each event in a table written in event
+    order, built once per table so that the rows of a given event can be
+    taken as a slice instead of scanning the whole table.
+    """
+    def __init__(self, event_ids: Sequence[int]):
+
+        event_ids = np.asarray(event_ids)
+        if np.any(np.diff(event_ids) < 0):
+            raise UnsortedEventTable("Table rows are not ordered by event id")
+
+        self.event_ids, starts = np.unique(event_ids, return_index=True)
+        self.boundaries        = np.append(starts, len(event_ids))
+
+
+    def __len__(self):
+        return len(self.event_ids)
+
+
+    def __contains__(self, evt_number: int):
+        i = np.searchsorted(self.event_ids, evt_number)
+        return i < len(self.event_ids) and self.event_ids[i] == evt_number
+
+
+    def rows(self, evt_number: int) -> slice:
+        """
+        Return the rows of a given event, or an empty slice
+        if the event is not in the table.
+        """
+        i = np.searchsorted(self.event_ids, evt_number)
+        if i < len(self.event_ids) and self.event_ids[i] == evt_number:
+            return slice(int(self.boundaries[i]), int(self.boundaries[i+1]))
+        return slice(0, 0)
+
+
+    def rows_between(self, first_evt: int, last_evt: int) -> slice:
+        """
+        Return the rows of all the events with ids
+        between first_evt and last_evt, both included.
+        """
+        first = np.searchsorted(self.event_ids, first_evt, side='left')
+        last  = np.searchsorted(self.event_ids, last_evt,  side='right')
+        return slice(int(self.boundaries[first]), int(self.boundaries[last]))
+
+
+def load_event_index(file_name: str, table_name: str = 'hits') -> EventIndex:
+    """
+    Build the event index of a MC table reading only its event_id column.
+    """
+    with pd.HDFStore(file_name, 'r') as store:
+        event_ids = store.select_column('MC/' + table_name, 'event_id').values
+
+    return EventIndex(event_ids)
+
+
+def select_event(df: pd.DataFrame, evt_number: int,
+                 index: EventIndex = None) -> pd.DataFrame:
+    """
+    Return the rows of df belonging to a given event. If the event index
+    of df is given, the rows are sliced without scanning the table.
+    """
+    if index is None:
+        return df[df.event_id == evt_number]
+    return df.iloc[index.rows(evt_number)]
+
+
+def load_mc_blocks(file_name: str, events_per_block: int = 1000,
+                   tables: Sequence[str] = mc_tables) -> Iterator[Tuple[pd.DataFrame, ...]]:
+    """
+    Read the MC tables of a file in blocks of consecutive events.
+    For each block, a tuple with one dataframe per table name is yielded,
+    in the order given by tables, all of them restricted to the same
+    range of event ids. Only the event_id columns are read in full,
+    so memory usage is bounded by the block size and not by the file size.
+    The tables are assumed to be written in event order.
+    """
+    with pd.HDFStore(file_name, 'r') as store:
+        table_names = ['MC/' + table for table in tables]
+        indices     = [EventIndex(store.select_column(name, 'event_id').values)
+                       for name in table_names]
+        events      = np.unique(np.concatenate([index.event_ids for index in indices]))
+
+        for first in range(0, len(events), events_per_block):
+            block_evts = events[first:first+events_per_block]
+            block      = []
+            for name, index in zip(table_names, indices):
+                rows = index.rows_between(block_evts[0], block_evts[-1])
+                block.append(store.select(name, start=rows.start, stop=rows.stop))
+            yield tuple(block)
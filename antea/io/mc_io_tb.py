@@ -3,116 +3,159 @@ import numpy  as np
 
 from invisible_cities.core            import system_of_units as units
 from invisible_cities.evm.event_model import Waveform
-from invisible_cities.io.mcinfo_io    import units_dict
 
-from typing import Mapping
+from antea.io.mc_io import read_mc_configuration
+
+from typing      import Mapping, Tuple
+from collections import abc
 
 
 def read_SiPM_bin_width_from_conf(h5f):
 
-    h5config = h5f.root.MC.configuration
-    bin_width = None
-    for row in h5config:
-        param_name = row['param_key'].decode('utf-8','ignore')
-        if param_name.find('time_binning') >= 0:
-            param_value = row['param_value'].decode('utf-8','ignore')
-            numb, unit  = param_value.split()
-            if param_name.find('SiPM') >= 0:
-                bin_width = float(numb) * units_dict[unit]
+    return read_mc_configuration(h5f).sipm_bin_width()
 
-    if bin_width is None:
-        bin_width = 1 * units.microsecond
 
-    return bin_width
+class CompactWaveforms(abc.Mapping):
+    """
+    Sensor response of many events stored as flat arrays, in a CSR-like
+    layout: the times and charges of all the waveforms are concatenated,
+    sensor_offsets gives the rows [start, stop) of each waveform and
+    event_offsets the waveforms [start, stop) of each event.
+    It behaves as a mapping event -> sensor -> Waveform, but the
+    Waveform objects of an event are only built when the event is accessed.
+    """
+    def __init__(self, event_ids, event_offsets, sensor_ids, sensor_offsets,
+                 times, charges, bin_width):
 
+        self.event_ids      = event_ids
+        self.event_offsets  = event_offsets
+        self.sensor_ids     = sensor_ids
+        self.sensor_offsets = sensor_offsets
+        self.times          = times
+        self.charges        = charges
+        self.bin_width      = bin_width
+        self._event_rows    = {evt: i for i, evt in enumerate(event_ids)}
+
+
+    def __getitem__(self, evt_number: int) -> Mapping[int, Waveform]:
+        i           = self._event_rows[evt_number]
+        first, last = self.event_offsets[i], self.event_offsets[i+1]
+
+        current_event = {}
+        for sns_id, start, stop in zip(self.sensor_ids    [first  :last  ],
+                                       self.sensor_offsets[first  :last  ],
+                                       self.sensor_offsets[first+1:last+1]):
+            current_event[sns_id] = Waveform(self.times[start:stop], self.charges[start:stop], self.bin_width)
+
+        return current_event
+
+
+    def __iter__(self):
+        return iter(self.event_ids)
 
-def read_mcsns_response_evt (mctables: (tb.Table, tb.Table),
-                             event_number: int, last_line_of_event,
-                             bin_width, last_row=0) -> [tb.Table]:
 
+    def __len__(self):
+        return len(self.event_ids)
+
+
+def read_mcsns_response_range(mctables: (tb.Table, tb.Table),
+                              event_range: Tuple[int, int], last_line_of_event,
+                              bin_width, compact=False) -> Mapping[int, Mapping[int, Waveform]]:
+    """
+    Read the sensor response of the events stored in the rows event_range
+    of the extents table. The waveforms of all the events are read in a
+    single call and then split by event and by sensor.
+    If compact is True, a CompactWaveforms is returned instead of
+    a dictionary of dictionaries of Waveform objects.
+    """
     h5extents   = mctables[0]
     h5waveforms = mctables[1]
 
-    current_event = {}
-    event_range   = (last_row, int(1e9))
-
-    iwvf = int(0)
-    if event_range[0] > 0:
-        iwvf = int(h5extents[event_range[0]-1][last_line_of_event]) + 1
+    first_row = event_range[0]
+    last_row  = max(min(event_range[1], len(h5extents)), first_row)
+
+    # the index of the first waveform is 0 unless the first event
+    #  written is to be skipped: in this case they must be read from the extents
+    extents   = h5extents.read(first_row, last_row)
+    wvf_stops = extents[last_line_of_event].astype(np.int64) + 1
+    first_wvf = 0
+    if first_row > 0 and len(extents):
+        first_wvf = int(h5extents[first_row-1][last_line_of_event]) + 1
+    wvf_starts = np.append(first_wvf, wvf_stops[:-1])[:len(wvf_stops)]
+
+    ## rows of the waveforms of each event in a single read of the table
+    lengths    = np.clip(wvf_stops - wvf_starts, 0, None)
+    evt_starts = np.append(0, np.cumsum(lengths))
+    wvf_min    = wvf_starts.min()              if len(extents) else 0
+    wvf_max    = max(wvf_stops.max(), wvf_min) if len(extents) else 0
+    rows       = np.arange(evt_starts[-1]) + np.repeat(wvf_starts - evt_starts[:-1], lengths)
+    waveforms  = h5waveforms.read(wvf_min, wvf_max)
+    if not np.array_equal(rows, np.arange(wvf_min, wvf_max)):
+        waveforms = waveforms[rows - wvf_min]
+
+    ## a new waveform starts each time the sensor id changes or a new event begins
+    sensor_ids     = waveforms['sensor_id']
+    new_wvf        = np.ones(len(sensor_ids), dtype=bool)
+    new_wvf[1:]    = sensor_ids[1:] != sensor_ids[:-1]
+    new_wvf[evt_starts[:-1][lengths > 0]] = True
+    sensor_offsets = np.append(np.flatnonzero(new_wvf), len(sensor_ids))
+    event_offsets  = np.searchsorted(sensor_offsets[:-1], evt_starts)
+
+    all_events = CompactWaveforms(extents['evt_number'], event_offsets,
+                                  sensor_ids[new_wvf], sensor_offsets,
+                                  waveforms['time_bin'] * bin_width,
+                                  np.ascontiguousarray(waveforms['charge']), bin_width)
+    if compact:
+        return all_events
 
-    for iext in range(*event_range):
-        this_row = h5extents[iext]
-        if this_row['evt_number'] == event_number:
-            # the index of the first waveform is 0 unless the first event
-            #  written is to be skipped: in this case they must be read from the extents
-            iwvf_end          = int(h5extents[iext][last_line_of_event])
-            if iwvf_end < iwvf: break
-            current_sensor_id = h5waveforms[iwvf]['sensor_id']
-            time_bins         = []
-            charges           = []
-            while iwvf <= iwvf_end:
-                wvf_row   = h5waveforms[iwvf]
-                sensor_id = wvf_row['sensor_id']
+    return {evt_number: all_events[evt_number] for evt_number in all_events}
 
-                if sensor_id == current_sensor_id:
-                    time_bins.append(wvf_row['time_bin'])
-                    charges.  append(wvf_row['charge'])
-                else:
-                    times = np.array(time_bins) * bin_width
-                    current_event[current_sensor_id] = Waveform(times, charges, bin_width)
 
-                    time_bins = []
-                    charges   = []
-                    time_bins.append(wvf_row['time_bin'])
-                    charges.append(wvf_row['charge'])
+def read_mcsns_response_evt (mctables: (tb.Table, tb.Table),
+                             event_number: int, last_line_of_event,
+                             bin_width, last_row=0) -> Mapping[int, Waveform]:
 
-                    current_sensor_id = sensor_id
+    h5extents = mctables[0]
 
-                iwvf += 1
+    iext = last_row
+    if iext >= len(h5extents) or h5extents[iext]['evt_number'] != event_number:
+        matches = np.flatnonzero(h5extents.read(last_row)['evt_number'] == event_number)
+        if not len(matches):
+            return {}
+        iext = last_row + int(matches[0])
 
-            times     = np.array(time_bins) * bin_width
-            current_event[current_sensor_id] = Waveform(times, charges, bin_width)
-            break
+    all_events = read_mcsns_response_range(mctables, (iext, iext+1),
+                                           last_line_of_event, bin_width)
 
-    return current_event
+    return all_events[h5extents[iext]['evt_number']]
 
-def go_through_file(h5f, h5waveforms, event_range=(0, int(1e9)), bin_width=1.*units.microsecond, kind_of_waveform='data'):
+def go_through_file(h5f, h5waveforms, event_range=(0, int(1e9)), bin_width=1.*units.microsecond, kind_of_waveform='data', compact=False):
 
     h5extents   = h5f.root.MC.extents
     sns_info    = (h5extents, h5waveforms)
 
     last_line_name = 'last_sns_' + kind_of_waveform
-    events_in_file = len(h5extents)
-
-    all_events     = {}
-    for iext in range(*event_range):
-        if iext >= events_in_file:
-            break
-
-        evt_number = h5extents[iext]['evt_number']
-        wvf_rows = read_mcsns_response_evt(sns_info, evt_number, last_line_name, bin_width, iext)
-        all_events[evt_number] = wvf_rows
 
-    return all_events
+    return read_mcsns_response_range(sns_info, event_range, last_line_name, bin_width, compact)
 
-def read_mcsns_response(file_name, event_range=(0, int(1e9))) ->Mapping[int, Mapping[int, Waveform]]:
+def read_mcsns_response(file_name, event_range=(0, int(1e9)), compact=False) ->Mapping[int, Mapping[int, Waveform]]:
 
     kind_of_waveform = 'data'
 
     with tb.open_file(file_name, mode='r') as h5f:
         bin_width   = read_SiPM_bin_width_from_conf(h5f)
         h5waveforms = h5f.root.MC.waveforms
-        all_events  = go_through_file(h5f, h5waveforms, event_range, bin_width, kind_of_waveform)
+        all_events  = go_through_file(h5f, h5waveforms, event_range, bin_width, kind_of_waveform, compact)
 
         return all_events
 
-def read_mcTOFsns_response(file_name, event_range=(0, int(1e9))) ->Mapping[int, Mapping[int, Waveform]]:
+def read_mcTOFsns_response(file_name, event_range=(0, int(1e9)), compact=False) ->Mapping[int, Mapping[int, Waveform]]:
 
     kind_of_waveform = 'tof'
     bin_width        = 5 * units.picosecond
 
     with tb.open_file(file_name, mode='r') as h5f:
         h5waveforms = h5f.root.MC.tof_waveforms
-        all_events = go_through_file(h5f, h5waveforms, event_range, bin_width, kind_of_waveform)
+        all_events = go_through_file(h5f, h5waveforms, event_range, bin_width, kind_of_waveform, compact)
 
         return all_events
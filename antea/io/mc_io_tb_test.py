@@ -4,6 +4,8 @@ import tables as tb
 
 from . mc_io_tb import read_mcsns_response
 from . mc_io_tb import read_mcTOFsns_response
+from . mc_io_tb import read_mcsns_response_evt
+from . mc_io_tb import read_SiPM_bin_width_from_conf
 
 
 def test_read_sensor_response(ANTEADATADIR):
@@ -44,3 +46,50 @@ def test_read_last_sensor_response(ANTEADATADIR):
         last_read_id = list(waveforms.keys())[-1]
 
         assert last_read_id == last_written_id
+
+def test_read_event_range_sensor_response(ANTEADATADIR):
+    """
+    Checks that reading a range of events gives the same waveforms
+    as reading all of them or reading each event separately.
+    """
+    test_file = os.path.join(ANTEADATADIR,'ring_test_tb.h5')
+
+    all_events   = read_mcsns_response(test_file)
+    event_range  = (1, 3)
+    range_events = read_mcsns_response(test_file, event_range)
+
+    with tb.open_file(test_file, mode='r') as h5in:
+        h5extents = h5in.root.MC.extents
+        mctables  = (h5extents, h5in.root.MC.waveforms)
+        bin_width = read_SiPM_bin_width_from_conf(h5in)
+
+        for iext in range(*event_range):
+            evt_number = h5extents[iext]['evt_number']
+            evt_wvfs   = read_mcsns_response_evt(mctables, evt_number, 'last_sns_data', bin_width, iext)
+
+            assert list(range_events[evt_number]) == list(all_events[evt_number])
+            assert list(evt_wvfs)                 == list(all_events[evt_number])
+            for sns_id, wvf in evt_wvfs.items():
+                assert np.allclose(wvf.times,   all_events[evt_number][sns_id].times)
+                assert np.allclose(wvf.charges, all_events[evt_number][sns_id].charges)
+
+
+def test_read_compact_sensor_response(ANTEADATADIR):
+    """
+    Checks that the compact sensor response contains the same waveforms
+    as the dictionary of Waveform objects.
+    """
+    test_file = os.path.join(ANTEADATADIR,'ring_test_tb.h5')
+
+    for read_response in (read_mcsns_response, read_mcTOFsns_response):
+        all_events     = read_response(test_file)
+        compact_events = read_response(test_file, compact=True)
+
+        assert list(compact_events) == list(all_events)
+        assert len(compact_events.times) == len(compact_events.charges)
+        for evt_number, waveforms in all_events.items():
+            compact_waveforms = compact_events[evt_number]
+            assert list(compact_waveforms) == list(waveforms)
+            for sns_id, wvf in waveforms.items():
+                assert np.allclose(compact_waveforms[sns_id].times,   wvf.times)
+                assert np.allclose(compact_waveforms[sns_id].charges, wvf.charges)
@@ -10,6 +10,13 @@ from . mc_io import load_mchits, load_mcparticles, load_configuration
 from . mc_io import load_mcsns_response
 from . mc_io import load_mcTOFsns_response
 from . mc_io import mc_writer, mc_sns_response_writer
+from . mc_io import load_mc_blocks
+from . mc_io import EventIndex, load_event_index, select_event
+from . mc_io import load_mc_configuration, read_sensor_bin_width_from_conf
+
+from .. core.exceptions import UnsortedEventTable
+
+from pytest import raises
 
 
 def test_read_sensor_response(ANTEADATADIR):
@@ -72,6 +79,57 @@ def test_write_mc_info(ANTEADATADIR, output_tmpdir):
     assert conf_out.equals(conf_in)
 
 
+def test_write_mc_info_small_chunks(ANTEADATADIR, output_tmpdir):
+    """
+    Checks that the events are copied correctly when the input tables
+    are read in chunks smaller than the events and in any order.
+    """
+    test_file_in  = os.path.join(ANTEADATADIR,'ring_test.h5')
+    test_file_out = os.path.join(output_tmpdir, 'test_output_small_chunks.h5')
+
+    hits_in         = load_mchits(test_file_in)
+    events_to_write = hits_in.event_id.unique()[:5][::-1]
+
+    writer = mc_writer(test_file_in, test_file_out, buffer_size=10, chunk_size=2)
+    for evt in events_to_write:
+        writer(evt)
+    writer.close_file()
+
+    hits_out        = load_mchits(test_file_out)
+    hits_in_written = pd.concat([hits_in[hits_in.event_id == evt] for evt in events_to_write])
+
+    assert hits_out.equals(hits_in_written)
+
+
+def test_write_mc_info_unsorted(ANTEADATADIR, output_tmpdir):
+    """
+    Checks that the events of input tables not ordered by event id
+    are copied as well.
+    """
+    test_file_in  = os.path.join(ANTEADATADIR,'ring_test.h5')
+    unsorted_file = os.path.join(output_tmpdir, 'test_unsorted.h5')
+    test_file_out = os.path.join(output_tmpdir, 'test_output_unsorted.h5')
+
+    hits_in      = load_mchits(test_file_in)
+    particles_in = load_mcparticles(test_file_in)
+    hits_in      = hits_in.iloc[::-1]
+    load_configuration(test_file_in).to_hdf(unsorted_file, key='MC/configuration', format='t', data_columns=True)
+    hits_in     .to_hdf(unsorted_file, key='MC/hits',      format='t', data_columns=True)
+    particles_in.to_hdf(unsorted_file, key='MC/particles', format='t', data_columns=True)
+
+    events_to_write = hits_in.event_id.unique()[:5]
+    writer = mc_writer(unsorted_file, test_file_out, chunk_size=2)
+    assert writer.hits.equals(hits_in)
+    for evt in events_to_write:
+        writer(evt)
+    writer.close_file()
+
+    hits_out        = load_mchits(test_file_out)
+    hits_in_written = pd.concat([hits_in[hits_in.event_id == evt] for evt in events_to_write])
+
+    assert hits_out.equals(hits_in_written)
+
+
 def test_write_sns_info(tmpdir):
     test_file_in    = os.environ['ANTEADIR'] + '/testdata/ring_test.h5'
     test_file_in_cp = os.path.join(tmpdir, 'test.h5')
@@ -93,3 +151,131 @@ def test_write_sns_info(tmpdir):
     assert events        == np.array([event_id])
     assert np.all(sns    == list(sns_response[event_id].keys()))
     assert np.all(charge == list(sns_response[event_id].values()))
+
+
+def test_write_sns_info_in_blocks(tmpdir):
+    """
+    Checks that the sensor response is written correctly
+    when the buffer is flushed several times.
+    """
+    test_file_in    = os.environ['ANTEADIR'] + '/testdata/ring_test.h5'
+    test_file_in_cp = os.path.join(tmpdir, 'test.h5')
+    utils.copy(test_file_in, test_file_in_cp)
+
+    sns_response = {evt : {1000 + i: i + 1 for i in range(evt)} for evt in range(6)}
+
+    writer = mc_sns_response_writer(test_file_in_cp, 'test_sns_response', buffer_size=4)
+    for evt in sns_response:
+        writer(sns_response, evt)
+    writer.close_file()
+
+    sns_response_written = pd.read_hdf(test_file_in_cp, 'MC/test_sns_response')
+
+    for evt, charges in sns_response.items():
+        evt_written = sns_response_written[sns_response_written.event_id == evt]
+        assert np.all(evt_written.sensor_id == list(charges.keys()))
+        assert np.all(evt_written.charge    == list(charges.values()))
+
+
+def test_write_sns_info_keeps_dtypes(tmpdir):
+    """
+    Checks that the sensor ids and charges are written with the dtypes
+    of the given sensor response, as when each event is appended alone.
+    """
+    test_file_in    = os.environ['ANTEADIR'] + '/testdata/ring_test.h5'
+    test_file_in_cp = os.path.join(tmpdir, 'test.h5')
+
+    for charges, dtype in [([1, 3], np.int64), ([1.5, 3.], np.float64)]:
+        utils.copy(test_file_in, test_file_in_cp)
+        sns_response = {evt : dict(zip([1000, 1001], charges)) for evt in range(3)}
+
+        writer = mc_sns_response_writer(test_file_in_cp, 'test_sns_response', buffer_size=4)
+        for evt in sns_response:
+            writer(sns_response, evt)
+        writer.close_file()
+
+        sns_response_written = pd.read_hdf(test_file_in_cp, 'MC/test_sns_response')
+        assert sns_response_written.sensor_id.dtype == np.int64
+        assert sns_response_written.charge   .dtype == dtype
+
+
+def test_load_mc_blocks(ANTEADATADIR):
+    """
+    Checks that the tables read in blocks of events are aligned
+    and that, once put together, they are equal to the full tables.
+    """
+    test_file = os.path.join(ANTEADATADIR,'ring_test.h5')
+
+    hits         = load_mchits           (test_file)
+    particles    = load_mcparticles      (test_file)
+    sns_response = load_mcsns_response   (test_file)
+    tof_response = load_mcTOFsns_response(test_file)
+
+    blocks = list(load_mc_blocks(test_file, events_per_block=3))
+    for block in blocks:
+        evt_ids = np.unique(np.concatenate([df.event_id.values for df in block]))
+        assert len(evt_ids) <= 3
+
+    for i, df in enumerate([hits, particles, sns_response, tof_response]):
+        df_blocks = pd.concat([block[i] for block in blocks])
+        assert np.all(df_blocks.values == df.values)
+
+
+def test_event_index_selects_same_rows_as_mask(ANTEADATADIR):
+    test_file = os.path.join(ANTEADATADIR,'ring_test.h5')
+
+    hits      = load_mchits(test_file)
+    hits_idx  = load_event_index(test_file, 'hits')
+    particles = load_mcparticles(test_file)
+
+    assert len(hits_idx) == len(hits.event_id.unique())
+    for evt in particles.event_id.unique():
+        assert select_event(hits, evt, hits_idx).equals(select_event(hits, evt))
+
+
+def test_event_index_missing_event():
+    index = EventIndex([0, 0, 1, 3, 3, 3])
+
+    assert 2 not in index
+    assert index.rows(2) == slice(0, 0)
+    assert index.rows(3) == slice(3, 6)
+    assert index.rows_between(1, 2) == slice(2, 3)
+
+
+def test_event_index_raises_UnsortedEventTable():
+    with raises(UnsortedEventTable):
+        EventIndex([0, 2, 1])
+
+
+def test_load_mc_configuration(tmpdir):
+    """
+    Checks that the configuration values with units are parsed,
+    and that the configuration is cached until the file changes.
+    """
+    test_file = os.path.join(tmpdir, 'test_conf.h5')
+    conf      = pd.DataFrame({'param_key'  : ['/Actions/bin_size', '/Actions/tof_bin_size', 'num_events'],
+                              'param_value': ['1 microsecond',     '5 picosecond',          '100']})
+    conf.to_hdf(test_file, key='MC/configuration', format='t', data_columns=True)
+
+    mc_conf = load_mc_configuration(test_file)
+
+    assert np.isclose(mc_conf['/Actions/bin_size'], 1 * units.microsecond)
+    assert np.isclose(mc_conf.sensor_bin_width(tof=True), 5 * units.picosecond)
+    assert mc_conf['num_events'] == '100'
+    assert load_mc_configuration(test_file) is mc_conf
+
+    with tb.open_file(test_file, 'r') as h5f:
+        assert read_sensor_bin_width_from_conf(h5f, tof=True) == mc_conf.sensor_bin_width(tof=True)
+
+    os.utime(test_file, (0, 0))
+    assert load_mc_configuration(test_file) is not mc_conf
+
+
+def test_sensor_bin_width_without_units(tmpdir):
+    test_file = os.path.join(tmpdir, 'test_conf_no_units.h5')
+    conf      = pd.DataFrame({'param_key'  : ['/Actions/bin_size'],
+                              'param_value': ['5']})
+    conf.to_hdf(test_file, key='MC/configuration', format='t', data_columns=True)
+
+    with raises(ValueError):
+        load_mc_configuration(test_file).sensor_bin_width()
@@ -1,5 +1,7 @@
 import numpy as np
 
+from . rng import get_rng
+
 
 class errmat:
     """
@@ -15,6 +17,15 @@ class errmat:
 
     The distribution of simulated coordinates is calculated by summing over the
     error dimension.
+
+    The cumulative distributions of the coordinates and of the errors of each
+    coordinate bin are computed once, at load time, as np.random.choice does,
+    so that drawing a bin is a search in them. The scalar methods draw
+    the same numbers as np.random.choice would, and the sample_* methods
+    draw many values in one call.
+
+    All the methods draw from the global np.random state, or from the
+    np.random.Generator given as rng (see antea.mcsim.rng).
     """
     def __init__(self,errmat_file):
 
@@ -30,9 +41,11 @@ class errmat:
         # The coordinate matrix is the sum along the error dimension.
         self.coordmat = np.sum(errmat,axis=1)
 
-        # Normalize the error matrix along the error dimension.
-        for i in range(len(self.coordmat)):
-            errmat[i,:] = errmat[i,:]/self.coordmat[i]
+        # Normalize the error matrix along the error dimension,
+        #  leaving the empty coordinate bins to 0.
+        norm   = np.where(self.coordmat != 0, self.coordmat, 1)
+        errmat = np.where(self.coordmat[:, np.newaxis] != 0,
+                          errmat / norm[:, np.newaxis], 0)
 
         # Normalize the coordinate matrix.
         self.coordmat /= np.sum(self.coordmat)
@@ -44,27 +57,111 @@ class errmat:
         self.dx = dx
         self.dy = dy
 
-    def get_random_coord(self):
+        # Cumulative distributions, normalized as in np.random.choice
+        #  (NaN for the empty coordinate bins).
+        self.coord_cdf = cumulative_distributions(self.coordmat)
+        self.err_cdf   = cumulative_distributions(self.errmat)
+        self.empty     = ~np.any(self.errmat != 0, axis=1)
+
+    def get_random_coord(self, rng=None):
         """
         Select a random coordinate from the coordinate matrix.
 
+        :param rng: the random generator (None for the global np.random state)
         :rtype: float
         :returns: the randomly selected coordinate
         """
-        i = np.random.choice(len(self.coordmat),p=self.coordmat)
-        return self.xmin + (i + np.random.uniform())*self.dx
+        rng = get_rng(rng)
+        i = np.searchsorted(self.coord_cdf, rng.random(), side='right')
+        return self.xmin + (i + rng.uniform())*self.dx
 
-    def get_random_error(self,x):
+    def get_random_error(self,x, rng=None):
         """
         Select a random error for the specified coordinate.
 
         :param x: the coordinate
         :type x: float
+        :param rng: the random generator (None for the global np.random state)
         :returns: a random error corresponding to the specified coordinate
         :rtype: float
+        :raises ValueError: if the coordinate bin of x has no errors
+        """
+        rng = get_rng(rng)
+        i = self.coord_bins([x])[0]
+        if self.empty[i]:
+            raise ValueError('No errors in the coordinate bin of {}'.format(x))
+        j = np.searchsorted(self.err_cdf[i], rng.random(), side='right')
+        return self.ymin + (j + rng.uniform())*self.dy
+
+    def coord_bins(self, x):
+        """
+        Return the coordinate bin of each coordinate of x: coordinates below
+        the range go to the first bin and those above it to the last one.
+        NaN coordinates are given the first bin.
+
+        :param x: the coordinates
+        :type x: array
+        :rtype: array
+        """
+        i = np.floor((np.asarray(x, dtype=float) - self.xmin)/self.dx)
+        i = np.clip(np.nan_to_num(i), 0, len(self.errmat)-1)
+        return i.astype(int)
+
+    def sample_coords(self, n, rng=None):
+        """
+        Select n random coordinates from the coordinate matrix.
+
+        :param n: the number of coordinates
+        :type n: int
+        :param rng: the random generator (None for the global np.random state)
+        :returns: the randomly selected coordinates
+        :rtype: array
         """
-        i = int((x - self.xmin)/self.dx)
-        if(i >= len(self.errmat)): i = len(self.errmat)-1
-        edist = self.errmat[i]
-        j = np.random.choice(len(edist),p=edist)
-        return self.ymin + (j + np.random.uniform())*self.dy
+        rng = get_rng(rng)
+        i = np.searchsorted(self.coord_cdf, rng.random(n), side='right')
+        return self.xmin + (i + rng.uniform(size=n))*self.dx
+
+    def sample_errors(self, x, rng=None):
+        """
+        Select a random error for each one of the specified coordinates.
+
+        :param x: the coordinates
+        :type x: array
+        :param rng: the random generator (None for the global np.random state)
+        :returns: a random error corresponding to each coordinate, NaN for
+         the coordinates of empty bins and for NaN coordinates
+        :rtype: array
+        """
+        rng = get_rng(rng)
+        i = self.coord_bins(x)
+        j = searchsorted_rows(self.err_cdf, i, rng.random(len(i)))
+        e = self.ymin + (j + rng.uniform(size=len(i)))*self.dy
+        return np.where(self.empty[i] | np.isnan(x), np.nan, e)
+
+
+def cumulative_distributions(p):
+    """
+    Cumulative distribution(s) along the last axis of p, normalized to 1
+    as in np.random.choice.
+    """
+    cdf = np.cumsum(p, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cdf /= cdf[..., -1:]
+    return cdf
+
+
+def searchsorted_rows(cdfs, rows, u):
+    """
+    For each value u[k], the number of elements of the cumulative distribution
+    cdfs[rows[k]] lower than or equal to it (np.searchsorted with side='right'
+    on the row), computed with a vectorized binary search over all the values.
+    """
+    lo = np.zeros(len(u), dtype=int)
+    hi = np.full (len(u), cdfs.shape[-1])
+    while np.any(lo < hi):
+        mid    = (lo + hi) // 2
+        active = lo < hi
+        below  = active & (cdfs[rows, np.minimum(mid, cdfs.shape[-1]-1)] <= u)
+        lo     = np.where(below, mid + 1, lo)
+        hi     = np.where(active & ~below, mid, hi)
+    return lo
@@ -1,7 +1,13 @@
 import numpy as np
 
+from . errmat import cumulative_distributions
+from . errmat import searchsorted_rows
+from . rng    import get_rng
+
 # Class to store the error matrix and relevant information.
 # Note that errors are always expressed in (true - reco).
+# The errors are drawn from the global np.random state, or from the
+#  np.random.Generator given as rng (see antea.mcsim.rng).
 class errmat3d:
 
     def __init__(self,errmat_file):
@@ -20,13 +26,11 @@ class errmat3d:
         # The coordinate matrix is a 2d array; it's the sum along the error dimension.
         self.coordmat = np.sum(errmat, axis=2)
 
-        # Normalize the error matrix along the error dimension.
-        for i in range(len(self.coordmat)):
-            for j in range(len(self.coordmat[0])):
-                if self.coordmat[i,j] != 0:
-                    errmat[i,j,:] = errmat[i,j,:]/self.coordmat[i,j]
-                else:
-                    errmat[i,j,:] = 0
+        # Normalize the error matrix along the error dimension,
+        #  leaving the empty cells to 0.
+        norm   = np.where(self.coordmat != 0, self.coordmat, 1)
+        errmat = np.where(self.coordmat[..., np.newaxis] != 0,
+                          errmat / norm[..., np.newaxis], 0)
 
         # Normalize the coordinate matrix. Sum over both axes.
         self.coordmat /= np.sum(self.coordmat)
@@ -40,15 +44,41 @@ class errmat3d:
         self.dy = dy
         self.dz = dz
 
+        # Cumulative error distribution of each cell, normalized as in
+        #  np.random.choice (NaN for empty cells).
+        self.err_cdf = cumulative_distributions(errmat)
+        self.empty   = ~np.any(errmat != 0, axis=2)
+
 
     # Select a random error for the specified coordinate.
-    def get_random_error(self, x, y):
-        i = int((x - self.xmin)/self.dx)
-        j = int((y - self.ymin)/self.dy)
-        if i >= len(self.errmat): i = len(self.errmat)-1
-        if j >= len(self.errmat[0]): j = len(self.errmat[0])-1
-        edist = self.errmat[i,j]
-        if all(p == 0 for p in edist):
+    def get_random_error(self, x, y, rng=None):
+        rng  = get_rng(rng)
+        i, j = self.cells([x], [y])
+        i, j = i[0], j[0]
+        if self.empty[i,j]:
             return None
-        k = np.random.choice(len(edist), p=edist)
-        return self.zmin + (k + np.random.uniform())*self.dz
+        k = np.searchsorted(self.err_cdf[i,j], rng.random(), side='right')
+        return self.zmin + (k + rng.uniform())*self.dz
+
+    # Return the (i, j) cells of the specified coordinates: coordinates
+    #  below the range go to the first bin and those above it to the last
+    #  one. NaN coordinates are given the first bin.
+    def cells(self, xs, ys):
+        nx, ny = self.errmat.shape[:2]
+        i = np.floor((np.asarray(xs, dtype=float) - self.xmin)/self.dx)
+        j = np.floor((np.asarray(ys, dtype=float) - self.ymin)/self.dy)
+        i = np.clip(np.nan_to_num(i), 0, nx-1).astype(int)
+        j = np.clip(np.nan_to_num(j), 0, ny-1).astype(int)
+        return i, j
+
+    # Select a random error for each one of the specified coordinates,
+    #  NaN for those in empty cells and for NaN coordinates.
+    def sample_errors(self, xs, ys, rng=None):
+        rng   = get_rng(rng)
+        i, j  = self.cells(xs, ys)
+        nz    = self.errmat.shape[2]
+        cdfs  = self.err_cdf.reshape(-1, nz)
+        k     = searchsorted_rows(cdfs, i*self.errmat.shape[1] + j,
+                                  rng.random(len(i)))
+        error = self.zmin + (k + rng.uniform(size=len(i)))*self.dz
+        return np.where(self.empty[i,j] | np.isnan(xs) | np.isnan(ys), np.nan, error)
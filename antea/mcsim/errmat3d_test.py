@@ -0,0 +1,100 @@
+import os
+import numpy as np
+
+from . errmat3d import errmat3d
+
+
+def write_errmat3d(filename, nx=10, ny=8, nz=30):
+    """
+    Write a random 3D error matrix with some empty cells.
+    """
+    rng    = np.random.RandomState(1)
+    matrix = rng.randint(0, 10, size=(nx, ny, nz)).astype(float)
+    matrix[2, 5] = 0
+    matrix[7, :] = 0
+    np.savez(filename, errmat=matrix, eff=np.ones(nx),
+             xmin=-5., ymin=0., zmin=-1., dx=1., dy=10., dz=2./nz)
+
+
+def test_errmat3d_normalization(output_tmpdir):
+    filename = os.path.join(output_tmpdir, 'test_errmat3d.npz')
+    write_errmat3d(filename)
+    emat = errmat3d(filename)
+
+    sums = emat.errmat.sum(axis=2)
+    np.testing.assert_allclose(sums[~emat.empty], 1)
+    assert np.all(sums[emat.empty] == 0)
+    assert emat.empty[2, 5] and np.all(emat.empty[7])
+    assert np.isclose(emat.coordmat.sum(), 1)
+
+
+def test_errmat3d_get_random_error_as_random_choice(output_tmpdir):
+    """
+    Checks that get_random_error draws the same numbers as the previous
+    implementation based on np.random.choice, and None for empty cells.
+    """
+    filename = os.path.join(output_tmpdir, 'test_errmat3d.npz')
+    write_errmat3d(filename)
+    emat = errmat3d(filename)
+
+    assert emat.get_random_error(2.5, 55.) is None
+
+    for seed, (x, y) in enumerate([(-4.5, 3.), (0.2, 79.), (4.9, 100.), (-2., 42.)]):
+        np.random.seed(seed)
+        i, j  = int((x + 5)/1.), min(int(y/10.), 7)
+        k     = np.random.choice(emat.errmat.shape[2], p=emat.errmat[i, j])
+        error = emat.zmin + (k + np.random.uniform())*emat.dz
+
+        np.random.seed(seed)
+        assert emat.get_random_error(x, y) == error
+
+
+def test_errmat3d_sample_errors(output_tmpdir):
+    """
+    Checks that sample_errors draws, for each point, the error of the bin
+    np.searchsorted finds in the cumulative distribution of its cell,
+    and NaN for the points in empty cells.
+    """
+    filename = os.path.join(output_tmpdir, 'test_errmat3d.npz')
+    write_errmat3d(filename)
+    emat = errmat3d(filename)
+
+    np.random.seed(0)
+    xs = np.random.uniform(-5, 7,  size=1000)
+    ys = np.random.uniform( 0, 90, size=1000)
+
+    np.random.seed(1)
+    errors = emat.sample_errors(xs, ys)
+
+    np.random.seed(1)
+    u = np.random.random_sample(len(xs))
+    v = np.random.uniform(size=len(xs))
+    i, j = emat.cells(xs, ys)
+    for ii, jj, ui, vi, error in zip(i, j, u, v, errors):
+        if emat.empty[ii, jj]:
+            assert np.isnan(error)
+            continue
+        k = np.searchsorted(emat.err_cdf[ii, jj], ui, side='right')
+        assert np.isclose(error, emat.zmin + (k + vi)*emat.dz)
+    assert np.isnan(errors).any()
+
+
+def test_errmat3d_cells_out_of_range(output_tmpdir):
+    """
+    Checks that the points out of the range go to the first and last
+    bins, and that sample_errors returns NaN for NaN coordinates.
+    """
+    filename = os.path.join(output_tmpdir, 'test_errmat3d.npz')
+    write_errmat3d(filename)
+    emat = errmat3d(filename)
+
+    xs = [-5.5, -5., 4.5, 9., np.nan, 0.5]
+    ys = [-1.,  0., 79., 95., 10., np.nan]
+    i, j = emat.cells(xs, ys)
+    np.testing.assert_array_equal(i, [0, 0, 9, 9, 0, 5])
+    np.testing.assert_array_equal(j, [0, 0, 7, 7, 1, 0])
+
+    errors = emat.sample_errors(xs, ys)
+    assert np.all(np.isfinite(errors[:4]))
+    assert np.all(np.isnan  (errors[4:]))
+    assert emat.get_random_error(-5.5, -1.) is not None
@@ -0,0 +1,121 @@
+import os
+import numpy as np
+
+from pytest import raises
+
+from . errmat import errmat
+
+
+def write_errmat(filename, nx=20, ny=30):
+    """
+    Write a random error matrix with an empty coordinate bin.
+    """
+    rng    = np.random.RandomState(0)
+    matrix = rng.randint(0, 10, size=(nx, ny)).astype(float)
+    matrix[3] = 0
+    np.savez(filename, errmat=matrix, eff=np.ones(nx),
+             xmin=-10., ymin=-1., dx=1., dy=2./ny)
+
+
+def test_errmat_scalar_sampling_as_random_choice(output_tmpdir):
+    """
+    Checks that get_random_coord and get_random_error draw the same numbers
+    as the previous implementation based on np.random.choice, and that
+    get_random_error raises a ValueError for the empty coordinate bin.
+    """
+    filename = os.path.join(output_tmpdir, 'test_errmat.npz')
+    write_errmat(filename)
+    emat = errmat(filename)
+
+    for seed in range(20):
+        np.random.seed(seed)
+        i     = np.random.choice(len(emat.coordmat), p=emat.coordmat)
+        coord = emat.xmin + (i + np.random.uniform())*emat.dx
+        j     = np.random.choice(emat.errmat.shape[1], p=emat.errmat[i])
+        error = emat.ymin + (j + np.random.uniform())*emat.dy
+
+        np.random.seed(seed)
+        assert emat.get_random_coord()       == coord
+        assert emat.get_random_error(coord) == error
+
+    with raises(ValueError):
+        emat.get_random_error(-6.5)
+
+
+def test_errmat_normalization(output_tmpdir):
+    filename = os.path.join(output_tmpdir, 'test_errmat.npz')
+    write_errmat(filename)
+    emat = errmat(filename)
+
+    sums = emat.errmat.sum(axis=1)
+    np.testing.assert_allclose(sums[~emat.empty], 1)
+    assert np.all(sums[emat.empty] == 0)
+    assert np.flatnonzero(emat.empty).tolist() == [3]
+
+
+def test_errmat_coord_bins(output_tmpdir):
+    """
+    Checks that the coordinates out of the range go to the first and
+    last bins, and that NaN coordinates are given the first bin.
+    """
+    filename = os.path.join(output_tmpdir, 'test_errmat.npz')
+    write_errmat(filename)
+    emat = errmat(filename)
+
+    x = [-10.5, -10., -9.5, 9.5, 10., 25., np.nan]
+    np.testing.assert_array_equal(emat.coord_bins(x), [0, 0, 0, 19, 19, 19, 0])
+
+
+def test_errmat_sample_errors(output_tmpdir):
+    """
+    Checks that sample_errors draws, for each coordinate, the error
+    of the bin np.searchsorted finds in the cumulative distribution of
+    its coordinate bin, and NaN for empty bins and NaN coordinates.
+    """
+    filename = os.path.join(output_tmpdir, 'test_errmat.npz')
+    write_errmat(filename)
+    emat = errmat(filename)
+
+    for seed in range(20):
+        np.random.seed(seed)
+        x = np.random.uniform(-15, 15, size=500)
+        x[::50] = np.nan
+
+        np.random.seed(seed + 1)
+        errors = emat.sample_errors(x)
+
+        np.random.seed(seed + 1)
+        u = np.random.random_sample(len(x))
+        v = np.random.uniform(size=len(x))
+        for xi, ui, vi, error in zip(x, u, v, errors):
+            i = emat.coord_bins([xi])[0]
+            if np.isnan(xi) or i == 3:
+                assert np.isnan(error)
+                continue
+            j = np.searchsorted(emat.err_cdf[i], ui, side='right')
+            assert np.isclose(error, emat.ymin + (j + vi)*emat.dy)
+
+    coords = emat.sample_coords(1000)
+    assert np.all((coords >= emat.xmin) & (coords < emat.xmin + 20*emat.dx))
+    assert np.count_nonzero((coords >= -7) & (coords < -6)) == 0
+
+
+def test_errmat_generator(output_tmpdir):
+    """
+    Checks that the values drawn with a np.random.Generator depend only
+    on its seed, not on the global np.random state.
+    """
+    filename = os.path.join(output_tmpdir, 'test_errmat.npz')
+    write_errmat(filename)
+    emat = errmat(filename)
+    x    = np.linspace(-10, 10, 100)
+
+    results = []
+    for seed in [1, 2]:
+        np.random.seed(seed)
+        rng = np.random.default_rng(123)
+        results.append((emat.sample_coords(100, rng), emat.sample_errors(x, rng),
+                        emat.get_random_coord(rng),   emat.get_random_error(0.5, rng)))
+
+    for values1, values2 in zip(*results):
+        np.testing.assert_array_equal(values1, values2)
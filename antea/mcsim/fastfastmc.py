@@ -6,12 +6,23 @@
 import numpy  as np
 import pandas as pd
 
+from typing import Iterator
+
 from . errmat import errmat
 from . phantom import phantom
+from . rng     import get_rng
+
+event_columns = ['event_id',
+                 'true_r1', 'true_phi1', 'true_z1', 'true_t1',
+                 'true_r2', 'true_phi2', 'true_z2', 'true_t2',
+                 'reco_r1', 'reco_phi1', 'reco_z1',
+                 'reco_r2', 'reco_phi2', 'reco_z2']
 
 def run_fastfastmc(Nevts: int, phtm: phantom, errmat_r: errmat, errmat_phi: errmat,
                     errmat_z: errmat, rmin: float = 380.0, zmin: float = -450.0,
-                    zmax: float = 450.0, coslim: float = 0.309) -> pd.DataFrame:
+                    zmax: float = 450.0, coslim: float = 0.309,
+                    chunk_size: int = 1000000, rng: np.random.Generator = None,
+                    first_event_id: int = 0) -> pd.DataFrame:
     """
     Runs the fast fast MC, simulating coincident events in a PETALO geometry
     subject to the specified restrictions.
@@ -35,6 +46,12 @@ def run_fastfastmc(Nevts: int, phtm: phantom, errmat_r: errmat, errmat_phi: errm
     :param coslim: limit on the cosine of the opening angle of emitted gammas
      (see note below)
     :type coslim: float
+    :param chunk_size: maximum number of events simulated at once
+    :type chunk_size: int
+    :param rng: the random generator; None draws from the global np.random state
+    :type rng: np.random.Generator
+    :param first_event_id: the event id of the first event
+    :type first_event_id: int
     :returns: dataframe containing the following information for each
      event: 'event_id', 'true_r1', 'true_phi1', 'true_z1', 'true_t1',
      'true_r2', 'true_phi2', 'true_z2', 'true_t2', 'reco_r1', 'reco_phi1',
@@ -49,136 +66,148 @@ def run_fastfastmc(Nevts: int, phtm: phantom, errmat_r: errmat, errmat_phi: errm
             by specifying coslim < 0 and meaningful values for rmin, zmin, and
             zmax. In this case gammas will be generated so that they interact
             only within (zmin, zmax).
+
+    The events are simulated as arrays, in chunks of at most chunk_size
+    events (see fastfastmc_chunks).
+
+    To split a simulation over several processes, give each of them one of
+    the generators of antea.mcsim.rng.spawn_generators(n_workers, seed) and
+    its own range of event ids: the result is then reproducible and the
+    streams of the workers are independent.
+    """
+    chunks = list(fastfastmc_chunks(Nevts, phtm, errmat_r, errmat_phi, errmat_z,
+                                    rmin, zmin, zmax, coslim, chunk_size,
+                                    rng, first_event_id))
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=event_columns)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def fastfastmc_chunks(Nevts: int, phtm: phantom, errmat_r: errmat, errmat_phi: errmat,
+                      errmat_z: errmat, rmin: float = 380.0, zmin: float = -450.0,
+                      zmax: float = 450.0, coslim: float = 0.309,
+                      chunk_size: int = 1000000, rng: np.random.Generator = None,
+                      first_event_id: int = 0) -> Iterator[pd.DataFrame]:
+    """
+    Runs the fast fast MC as run_fastfastmc does, yielding the events in
+    dataframes of at most chunk_size events, so that very large samples
+    can be generated (and, for instance, written to file) with bounded memory.
+    The event ids run from first_event_id to first_event_id + Nevts - 1
+    across the chunks.
+    """
+    pdist = phtm.get_pdist()
+    rng   = get_rng(rng)
+
+    for first_evt in range(0, Nevts, chunk_size):
+        n = min(chunk_size, Nevts - first_evt)
+        events = _simulate_events(n, phtm, pdist, errmat_r, errmat_phi, errmat_z,
+                                  rmin, zmin, zmax, coslim, rng)
+        events.insert(0, 'event_id', first_event_id + np.arange(first_evt, first_evt + n))
+        print("Done {} events".format(first_evt + n))
+        yield events
+
+
+def _simulate_events(Nevts: int, phtm: phantom, pdist: np.ndarray, errmat_r: errmat,
+                     errmat_phi: errmat, errmat_z: errmat, rmin: float, zmin: float,
+                     zmax: float, coslim: float, rng) -> pd.DataFrame:
+    """
+    Simulates Nevts events of the fast fast MC at once, as arrays,
+    drawing from the random stream rng.
     """
 
     # Pick a random number for the location of the emission point.
-    pdist = phtm.get_pdist()
-    ievts = np.random.choice(len(pdist),Nevts,p=pdist)
+    ievts = rng.choice(len(pdist),Nevts,p=pdist)
 
     # Compute the cosines and sines of the axial angle.
-    phis = np.random.uniform(size=Nevts)*2*np.pi
-    cosines_phi = np.cos(phis)
-    sines_phi = np.sin(phis)
-
-    # Set up empty arrays to contain the event information.
-    a_event_ids = []
-    a_true_r1 = []; a_true_phi1 = []; a_true_z1 = []; a_true_t1 = []
-    a_true_r2 = []; a_true_phi2 = []; a_true_z2 = []; a_true_t2 = []
-    a_reco_r1 = []; a_reco_phi1 = []; a_reco_z1 = []; a_reco_t1 = []
-    a_reco_r2 = []; a_reco_phi2 = []; a_reco_z2 = []; a_reco_t2 = []
-
-    # Simulate the events.
-    for ievt,(ii,cphi,sphi,phi) in enumerate(zip(ievts,cosines_phi,sines_phi,phis)):
-
-        # Determine the point from which the gammas are emitted.
-        nnx = int(ii / phtm.NyNz)
-        nny = int(ii/phtm.Nz) % phtm.Ny
-        nnz = int(ii) % phtm.Nz
-
-        # Convert to world coordinates:
-        #  By convention (x, y, z) = (0.0, 0.0, 0.0) cooresponds to the center
-        #  of the modeled volume.
-        xpt = phtm.Lx*(1.0*nnx/phtm.Nx - 0.5)
-        ypt = phtm.Ly*(1.0*nny/phtm.Ny - 0.5)
-        zpt = phtm.Lz*(1.0*nnz/phtm.Nz - 0.5)
-
-        # Compute the azimuthal angle.
-        if(coslim < 0):
-            clim_high = (zmax - zpt)/(rmin**2 + (zmax-zpt)**2)**0.5
-            clim_low = (zmin - zpt)/(rmin**2 + (zmin-zpt)**2)**0.5
-            clim = min(abs(clim_low),abs(clim_high))
-            cth = np.random.uniform(-clim,clim)
-        else:
-            cth = np.random.uniform(-coslim,coslim)
-        sth = (1-cth**2)**0.5
-
-        # Get 2 random radii.
-        rc1 = errmat_r.get_random_coord()
-        rc2 = errmat_r.get_random_coord()
-
-        # Determine the radii extending from the emission point for the corresponding random radii
-        #  (which extend from the origin).  Note that these radii are in the x-y plane.
-        rpt_sq = xpt**2 + ypt**2 + zpt**2
-        b1 = 2*(xpt*cphi*sth + ypt*sphi*sth)
-        c1 = rpt_sq - rc1**2 - zpt**2
-        rp1 = np.max(np.roots([sth**2, b1, c1]))*np.abs(sth)
-
-        b2 = -b1
-        c2 = rpt_sq - rc2**2 - zpt**2
-        rp2 = np.max(np.roots([sth**2, b2, c2]))*np.abs(sth)
-
-        # Compute the full radii from the emission point to each interaction point (including z).
-        rstar1 = rp1/np.abs(sth)
-        rstar2 = rp2/np.abs(sth)
-
-        # Compute the two "interaction points".
-        x1 = xpt + rstar1*cphi*sth
-        x2 = xpt - rstar2*cphi*sth
-        y1 = ypt + rstar1*sphi*sth
-        y2 = ypt - rstar2*sphi*sth
-        z1 = zpt + rstar1*cth
-        z2 = zpt - rstar2*cth
-
-        # Convert to cylindrical coordinates.
-        r1 = (x1**2 + y1**2)**0.5  # This should be equal to rc1
-        phi1 = np.arctan2(y1,x1)
-        r2 = (x2**2 + y2**2)**0.5
-        phi2 = np.arctan2(y2,x2)
-
-        # Get all errors.
-        er1 = errmat_r.get_random_error(r1)
-        er2 = errmat_r.get_random_error(r2)
-        ephi1 = errmat_phi.get_random_error(phi1)
-        ephi2 = errmat_phi.get_random_error(phi2)
-        ez1 = errmat_z.get_random_error(z1)
-        ez2 = errmat_z.get_random_error(z2)
-
-        # Compute reconstructed quantities.
-        r1_reco = r1 - er1
-        r2_reco = r2 - er2
-        phi1_reco = phi1 - ephi1
-        phi2_reco = phi2 - ephi2
-        z1_reco = z1 - ez1
-        z2_reco = z2 - ez2
-
-        # Compute (in ns) the TOF.
-        tof = 1.0e9*(((x2-xpt)**2 + (y2-ypt)**2 + (z2-zpt)**2)**0.5 - ((x1-xpt)**2 + (y1-ypt)**2 + (z1-zpt)**2)**0.5)/3.0e11
-
-        # Add the values for this event to the arrays.
-        a_event_ids.append(ievt)
-
-        a_true_r1.append(r1)
-        a_true_phi1.append(phi1)
-        a_true_t1.append(0.)
-        a_true_z1.append(z1)
-        a_true_r2.append(r2)
-        a_true_phi2.append(phi2)
-        a_true_z2.append(z2)
-        a_true_t2.append(tof)
-
-        a_reco_r1.append(r1_reco)
-        a_reco_r2.append(r2_reco)
-        a_reco_phi1.append(phi1_reco)
-        a_reco_phi2.append(phi2_reco)
-        a_reco_z1.append(z1_reco)
-        a_reco_z2.append(z2_reco)
-
-        if(ievt % (Nevts/10) == 0):
-            print("Done {} events".format(ievt))
-
-    events = pd.DataFrame({'event_id':  a_event_ids,
-                           'true_r1':   a_true_r1,
-                           'true_phi1': a_true_phi1,
-                           'true_z1':   a_true_z1,
-                           'true_t1':   a_true_t1,
-                           'true_r2':   a_true_r2,
-                           'true_phi2': a_true_phi2,
-                           'true_z2':   a_true_z2,
-                           'true_t2':   a_true_t2,
-                           'reco_r1':   a_reco_r1,
-                           'reco_phi1': a_reco_phi1,
-                           'reco_z1':   a_reco_z1,
-                           'reco_r2':   a_reco_r2,
-                           'reco_phi2': a_reco_phi2,
-                           'reco_z2':   a_reco_z2})
+    phis = rng.uniform(size=Nevts)*2*np.pi
+    cphi = np.cos(phis)
+    sphi = np.sin(phis)
+
+    # Determine the points from which the gammas are emitted.
+    nnx = ievts // phtm.NyNz
+    nny = (ievts // phtm.Nz) % phtm.Ny
+    nnz = ievts % phtm.Nz
+
+    # Convert to world coordinates:
+    #  By convention (x, y, z) = (0.0, 0.0, 0.0) cooresponds to the center
+    #  of the modeled volume.
+    xpt = phtm.Lx*(1.0*nnx/phtm.Nx - 0.5)
+    ypt = phtm.Ly*(1.0*nny/phtm.Ny - 0.5)
+    zpt = phtm.Lz*(1.0*nnz/phtm.Nz - 0.5)
+
+    # Compute the azimuthal angle.
+    if(coslim < 0):
+        clim_high = (zmax - zpt)/(rmin**2 + (zmax-zpt)**2)**0.5
+        clim_low = (zmin - zpt)/(rmin**2 + (zmin-zpt)**2)**0.5
+        clim = np.minimum(np.abs(clim_low),np.abs(clim_high))
+        cth = rng.uniform(-clim,clim)
+    else:
+        cth = rng.uniform(-coslim,coslim,size=Nevts)
+    sth = (1-cth**2)**0.5
+
+    # Get 2 random radii per event.
+    rc1 = errmat_r.sample_coords(Nevts, rng)
+    rc2 = errmat_r.sample_coords(Nevts, rng)
+
+    # Determine the full distances from the emission point to the interaction
+    #  points at the random radii (which extend from the origin), as the
+    #  largest root of the quadratic equation sth**2 t**2 + b t + c = 0.
+    rpt_sq = xpt**2 + ypt**2 + zpt**2
+    b1 = 2*(xpt*cphi*sth + ypt*sphi*sth)
+    c1 = rpt_sq - rc1**2 - zpt**2
+    rstar1 = _largest_root(sth**2, b1, c1)
+
+    b2 = -b1
+    c2 = rpt_sq - rc2**2 - zpt**2
+    rstar2 = _largest_root(sth**2, b2, c2)
+
+    # Compute the two "interaction points".
+    x1 = xpt + rstar1*cphi*sth
+    x2 = xpt - rstar2*cphi*sth
+    y1 = ypt + rstar1*sphi*sth
+    y2 = ypt - rstar2*sphi*sth
+    z1 = zpt + rstar1*cth
+    z2 = zpt - rstar2*cth
+
+    # Convert to cylindrical coordinates.
+    r1 = (x1**2 + y1**2)**0.5  # This should be equal to rc1
+    phi1 = np.arctan2(y1,x1)
+    r2 = (x2**2 + y2**2)**0.5
+    phi2 = np.arctan2(y2,x2)
+
+    # Get all errors.
+    er1 = errmat_r.sample_errors(r1, rng)
+    er2 = errmat_r.sample_errors(r2, rng)
+    ephi1 = errmat_phi.sample_errors(phi1, rng)
+    ephi2 = errmat_phi.sample_errors(phi2, rng)
+    ez1 = errmat_z.sample_errors(z1, rng)
+    ez2 = errmat_z.sample_errors(z2, rng)
+
+    # Compute (in ns) the TOF.
+    tof = 1.0e9*(((x2-xpt)**2 + (y2-ypt)**2 + (z2-zpt)**2)**0.5 - ((x1-xpt)**2 + (y1-ypt)**2 + (z1-zpt)**2)**0.5)/3.0e11
+
+    events = pd.DataFrame({'true_r1':   r1,
+                           'true_phi1': phi1,
+                           'true_z1':   z1,
+                           'true_t1':   np.zeros(Nevts),
+                           'true_r2':   r2,
+                           'true_phi2': phi2,
+                           'true_z2':   z2,
+                           'true_t2':   tof,
+                           'reco_r1':   r1 - er1,
+                           'reco_phi1': phi1 - ephi1,
+                           'reco_z1':   z1 - ez1,
+                           'reco_r2':   r2 - er2,
+                           'reco_phi2': phi2 - ephi2,
+                           'reco_z2':   z2 - ez2})
     return events
+
+
+def _largest_root(a: np.ndarray, b: np.ndarray, c: np.ndarray) -> np.ndarray:
+    """
+    Largest root of the quadratic equations a t**2 + b t + c = 0, with a > 0
+    and c < 0 (so that the two roots are real and of opposite sign),
+    in a form that avoids cancellations.
+    """
+    sqrt_disc = np.sqrt(b**2 - 4*a*c)
+    return np.where(b > 0, 2*c/(-b - sqrt_disc), (-b + sqrt_disc)/(2*a))
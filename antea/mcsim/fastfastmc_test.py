@@ -5,6 +5,7 @@ import pandas as pd
 from  .            import fastfastmc as ffmc
 from  . errmat     import errmat
 from  . phantom    import phantom
+from  . rng        import spawn_generators
 
 def test_run_fastfastmc(ANTEADATADIR):
     """
@@ -30,3 +31,58 @@ def test_run_fastfastmc(ANTEADATADIR):
     # Ensure the number of events simulated is Nevts.
     if(len(events)):
         assert(len(events.event_id) == 1000)
+
+
+def test_run_fastfastmc_chunks(ANTEADATADIR):
+    """
+    Checks that the events simulated in chunks have consecutive event ids
+    and that the true radii are consistent with the interaction points.
+    """
+    Nevts = 1000
+
+    phtm = phantom(phantom_file=os.path.join(ANTEADATADIR, 'phantom_NEMAlike.npz'))
+    errmat_r   = errmat(os.path.join(ANTEADATADIR, 'errmat_r.npz'))
+    errmat_phi = errmat(os.path.join(ANTEADATADIR, 'errmat_phi.npz'))
+    errmat_z   = errmat(os.path.join(ANTEADATADIR, 'errmat_z.npz'))
+
+    chunks = list(ffmc.fastfastmc_chunks(Nevts, phtm, errmat_r, errmat_phi, errmat_z,
+                                         chunk_size=300))
+    assert [len(chunk) for chunk in chunks] == [300, 300, 300, 100]
+
+    events = pd.concat(chunks)
+    assert list(events.columns) == ffmc.event_columns
+    np.testing.assert_array_equal(events.event_id, np.arange(Nevts))
+
+    # The radii are drawn from the r error matrix coordinate range.
+    rmin = errmat_r.xmin
+    rmax = errmat_r.xmin + len(errmat_r.coordmat)*errmat_r.dx
+    assert np.all((events.true_r1 >= rmin - 1e-6) & (events.true_r1 <= rmax + 1e-6))
+    assert np.all((events.true_r2 >= rmin - 1e-6) & (events.true_r2 <= rmax + 1e-6))
+
+
+def test_run_fastfastmc_sharded(ANTEADATADIR):
+    """
+    Checks that a simulation split in shards, each with its own spawned
+    generator, is reproducible and that the shards are independent.
+    """
+    phtm = phantom(phantom_file=os.path.join(ANTEADATADIR, 'phantom_NEMAlike.npz'))
+    errmat_r   = errmat(os.path.join(ANTEADATADIR, 'errmat_r.npz'))
+    errmat_phi = errmat(os.path.join(ANTEADATADIR, 'errmat_phi.npz'))
+    errmat_z   = errmat(os.path.join(ANTEADATADIR, 'errmat_z.npz'))
+
+    def run_shards(seed, n_workers=3, n_evts=200):
+        shards = [ffmc.run_fastfastmc(n_evts, phtm, errmat_r, errmat_phi, errmat_z,
+                                      chunk_size=70, rng=rng, first_event_id=i*n_evts)
+                  for i, rng in enumerate(spawn_generators(n_workers, seed))]
+        return shards
+
+    shards1 = run_shards(seed=42)
+    np.random.seed(0)
+    shards2 = run_shards(seed=42)
+
+    for shard1, shard2 in zip(shards1, shards2):
+        pd.testing.assert_frame_equal(shard1, shard2)
+
+    events = pd.concat(shards1)
+    np.testing.assert_array_equal(events.event_id, np.arange(600))
+    assert not np.allclose(shards1[0].true_r1.values, shards1[1].true_r1.values)
@@ -7,23 +7,37 @@
 import numpy  as np
 import pandas as pd
 
+from typing import Any, Callable, Dict, List, Tuple
+
 from invisible_cities.core import system_of_units as units
 
 from antea.mcsim.errmat import errmat
+from antea.mcsim.rng import get_rng
 import antea.reco.reco_functions as rf
 
+from antea.io.mc_io import EventIndex, select_event
+
 def simulate_reco_event(evt_id: int, hits: pd.DataFrame, particles: pd.DataFrame,
                         errmat_p_r: errmat, errmat_p_phi: errmat, errmat_p_z: errmat,
                         errmat_p_t: errmat, errmat_c_r: errmat, errmat_c_phi: errmat,
                         errmat_c_z: errmat, errmat_c_t: errmat,
-                        true_e_threshold: float = 0.) -> pd.DataFrame:
+                        true_e_threshold: float = 0.,
+                        hits_index: EventIndex = None,
+                        particles_index: EventIndex = None,
+                        rng: np.random.Generator = None) -> pd.DataFrame:
     """
     Simulate the reconstructed coordinates for 1 coincidence from true GEANT4 dataframes.
     Notice that the time binning must be provided in ps.
+
+    The event indices of hits and particles, if given, are used to slice
+    the rows of the event instead of scanning the full tables.
+    The errors are drawn from rng, or from the global np.random state
+    if it is None.
     """
+    rng = get_rng(rng)
 
-    evt_parts = particles[particles.event_id == evt_id]
-    evt_hits  = hits     [hits.event_id      == evt_id]
+    evt_parts = select_event(particles, evt_id, particles_index)
+    evt_hits  = select_event(hits,      evt_id, hits_index)
     energy    = evt_hits.energy.sum()
     if energy < true_e_threshold:
         events = pd.DataFrame({'event_id':  [float(evt_id)],
@@ -90,26 +104,26 @@ def simulate_reco_event(evt_id: int, hits: pd.DataFrame, particles: pd.DataFrame
 
     # Get all errors.
     if phot1:
-        er1   = errmat_p_r.get_random_error(r1)
-        ephi1 = errmat_p_phi.get_random_error(phi1)
-        ez1   = errmat_p_z.get_random_error(z1)
-        et1   = errmat_p_t.get_random_error(t1)
+        er1   = errmat_p_r.get_random_error(r1, rng=rng)
+        ephi1 = errmat_p_phi.get_random_error(phi1, rng=rng)
+        ez1   = errmat_p_z.get_random_error(z1, rng=rng)
+        et1   = errmat_p_t.get_random_error(t1, rng=rng)
     else:
-        er1   = errmat_c_r.get_random_error(r1)
-        ephi1 = errmat_c_phi.get_random_error(phi1)
-        ez1   = errmat_c_z.get_random_error(z1)
-        et1   = errmat_c_t.get_random_error(t1)
+        er1   = errmat_c_r.get_random_error(r1, rng=rng)
+        ephi1 = errmat_c_phi.get_random_error(phi1, rng=rng)
+        ez1   = errmat_c_z.get_random_error(z1, rng=rng)
+        et1   = errmat_c_t.get_random_error(t1, rng=rng)
 
     if phot2:
-        er2   = errmat_p_r.get_random_error(r2)
-        ephi2 = errmat_p_phi.get_random_error(phi2)
-        ez2   = errmat_p_z.get_random_error(z2)
-        et2   = errmat_p_t.get_random_error(t2)
+        er2   = errmat_p_r.get_random_error(r2, rng=rng)
+        ephi2 = errmat_p_phi.get_random_error(phi2, rng=rng)
+        ez2   = errmat_p_z.get_random_error(z2, rng=rng)
+        et2   = errmat_p_t.get_random_error(t2, rng=rng)
     else:
-        er2   = errmat_c_r.get_random_error(r2)
-        ephi2 = errmat_c_phi.get_random_error(phi2)
-        ez2   = errmat_c_z.get_random_error(z2)
-        et2   = errmat_c_t.get_random_error(t2)
+        er2   = errmat_c_r.get_random_error(r2, rng=rng)
+        ephi2 = errmat_c_phi.get_random_error(phi2, rng=rng)
+        ez2   = errmat_c_z.get_random_error(z2, rng=rng)
+        et2   = errmat_c_t.get_random_error(t2, rng=rng)
 
     # Compute reconstructed quantities.
     r1_reco = r1 - er1
@@ -166,3 +180,95 @@ def simulate_reco_event(evt_id: int, hits: pd.DataFrame, particles: pd.DataFrame
                            'reco_z2':   reco_z2,
                            'reco_t2':   reco_t2})
     return events
+
+
+event_columns = ['event_id', 'true_energy',
+                 'true_r1', 'true_phi1', 'true_z1', 'true_t1',
+                 'true_r2', 'true_phi2', 'true_z2', 'true_t2',
+                 'phot_like1', 'phot_like2',
+                 'reco_r1', 'reco_phi1', 'reco_z1', 'reco_t1',
+                 'reco_r2', 'reco_phi2', 'reco_z2', 'reco_t2']
+
+
+def simulate_reco_events(hits: pd.DataFrame, particles: pd.DataFrame,
+                         errmat_p_r: errmat, errmat_p_phi: errmat, errmat_p_z: errmat,
+                         errmat_p_t: errmat, errmat_c_r: errmat, errmat_c_phi: errmat,
+                         errmat_c_z: errmat, errmat_c_t: errmat,
+                         true_e_threshold: float = 0.,
+                         rng: np.random.Generator = None) -> pd.DataFrame:
+    """
+    Simulate the reconstructed coordinates of all the events of the particles
+    dataframe at once, as simulate_reco_event does for one event.
+    The true interactions of all the events are found in one pass
+    (see find_all_first_interactions_in_active), and the errors of each
+    coordinate are drawn at once for all the photoelectric-like and for
+    all the compton-like interactions.
+    Returns a single dataframe with one row per event, in event id order.
+    As in simulate_reco_event, the events under the energy threshold,
+    without two interactions or with an error that cannot be drawn
+    (empty bin of an error matrix) have all the coordinates set to 0.
+    The errors are drawn from rng, or from the global np.random state
+    if it is None.
+    """
+    errmats = {'r'  : (errmat_p_r  , errmat_c_r  ),
+               'phi': (errmat_p_phi, errmat_c_phi),
+               'z'  : (errmat_p_z  , errmat_c_z  ),
+               't'  : (errmat_p_t  , errmat_c_t  )}
+    return _simulate_reco_events(hits, particles, errmats, lambda var, true: [true[var]],
+                                 true_e_threshold, rng)
+
+
+def _simulate_reco_events(hits: pd.DataFrame, particles: pd.DataFrame,
+                          errmats: Dict[str, Tuple[Any, Any]],
+                          error_args: Callable[[str, Dict[str, np.ndarray]], List[np.ndarray]],
+                          true_e_threshold: float,
+                          rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Body of simulate_reco_events, shared with fastmc3d. errmats gives the
+    photoelectric-like and compton-like error matrices of each coordinate,
+    and error_args(var, true) the arguments of their sample_errors method
+    for the coordinate var, from the true coordinates of the interactions.
+    """
+    rng      = get_rng(rng)
+    evt_ids  = np.unique(particles.event_id.values)
+    energies = hits.groupby('event_id').energy.sum().reindex(evt_ids, fill_value=0.).values
+    sel_evts = evt_ids[energies >= true_e_threshold]
+
+    interactions = rf.find_all_first_interactions_in_active(particles[particles.event_id.isin(sel_evts)],
+                                                            hits     [hits     .event_id.isin(sel_evts)])
+
+    events = pd.DataFrame(0., index=np.arange(len(evt_ids)), columns=event_columns)
+    events['event_id']    = evt_ids.astype(float)
+    events['true_energy'] = energies
+
+    values = {}
+    good   = np.ones(len(interactions), dtype=bool)
+    for i in ['1', '2']:
+        pos  = interactions[['true_x'+i, 'true_y'+i, 'true_z'+i]].values
+        phot = interactions['phot_like'+i].values
+
+        # Transform in cylindrical coordinates
+        cyl_pos = rf.from_cartesian_to_cyl(pos)
+        true    = {'r'  : cyl_pos[:, 0],
+                   'phi': cyl_pos[:, 1],
+                   'z'  : cyl_pos[:, 2],
+                   't'  : interactions['true_t'+i].values / units.ps}
+
+        # Get all errors, for each coordinate and kind of interaction.
+        for var in ['r', 'phi', 'z', 't']:
+            err_p, err_c = errmats[var]
+            args         = error_args(var, true)
+            error        = np.empty(len(phot))
+            error[ phot] = err_p.sample_errors(*[arg[ phot] for arg in args], rng=rng)
+            error[~phot] = err_c.sample_errors(*[arg[~phot] for arg in args], rng=rng)
+            good        &= ~np.isnan(error)
+
+            values['true_'+var+i] = true[var]
+            values['reco_'+var+i] = true[var] - error
+        values['phot_like'+i] = phot.astype(float)
+
+    rows = np.searchsorted(evt_ids, interactions.event_id.values[good])
+    for col, vals in values.items():
+        events.loc[rows, col] = vals[good]
+
+    return events
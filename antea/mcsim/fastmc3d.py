@@ -10,21 +10,36 @@ import pandas as pd
 
 from invisible_cities.core import system_of_units as units
 
+from typing import Dict, List
+
 from antea.mcsim.errmat   import errmat
 from antea.mcsim.errmat3d import errmat3d
+from antea.mcsim.rng      import get_rng
+from antea.mcsim.fastmc   import _simulate_reco_events
 import antea.reco.reco_functions as rf
 
+from antea.io.mc_io import EventIndex, select_event
+
 def simulate_reco_event(evt_id: int, hits: pd.DataFrame, particles: pd.DataFrame,
                         errmat_p_r: errmat, errmat_p_phi: errmat3d, errmat_p_z: errmat3d,
                         errmat_p_t: errmat, errmat_c_r: errmat, errmat_c_phi: errmat3d,
                         errmat_c_z: errmat3d, errmat_c_t: errmat,
-                        true_e_threshold: float = 0.) -> pd.DataFrame:
+                        true_e_threshold: float = 0.,
+                        hits_index: EventIndex = None,
+                        particles_index: EventIndex = None,
+                        rng: np.random.Generator = None) -> pd.DataFrame:
     """
     Simulate the reconstructed coordinates for 1 coincidence from true GEANT4 dataframes.
+
+    The event indices of hits and particles, if given, are used to slice
+    the rows of the event instead of scanning the full tables.
+    The errors are drawn from rng, or from the global np.random state
+    if it is None.
     """
+    rng = get_rng(rng)
 
-    evt_parts = particles[particles.event_id == evt_id]
-    evt_hits  = hits     [hits.event_id      == evt_id]
+    evt_parts = select_event(particles, evt_id, particles_index)
+    evt_hits  = select_event(hits,      evt_id, hits_index)
     energy    = evt_hits.energy.sum()
     if energy < true_e_threshold:
         events = pd.DataFrame({'event_id':  [float(evt_id)],
@@ -91,26 +106,26 @@ def simulate_reco_event(evt_id: int, hits: pd.DataFrame, particles: pd.DataFrame
 
     # Get all errors.
     if phot1:
-        er1   = errmat_p_r.get_random_error(r1)
-        ephi1 = errmat_p_phi.get_random_error(phi1, r1)
-        ez1   = errmat_p_z.get_random_error(z1, r1)
-        et1   = errmat_p_t.get_random_error(t1)
+        er1   = errmat_p_r.get_random_error(r1, rng=rng)
+        ephi1 = errmat_p_phi.get_random_error(phi1, r1, rng=rng)
+        ez1   = errmat_p_z.get_random_error(z1, r1, rng=rng)
+        et1   = errmat_p_t.get_random_error(t1, rng=rng)
     else:
-        er1   = errmat_c_r.get_random_error(r1)
-        ephi1 = errmat_c_phi.get_random_error(phi1, r1)
-        ez1   = errmat_c_z.get_random_error(z1, r1)
-        et1   = errmat_c_t.get_random_error(t1)
+        er1   = errmat_c_r.get_random_error(r1, rng=rng)
+        ephi1 = errmat_c_phi.get_random_error(phi1, r1, rng=rng)
+        ez1   = errmat_c_z.get_random_error(z1, r1, rng=rng)
+        et1   = errmat_c_t.get_random_error(t1, rng=rng)
 
     if phot2:
-        er2   = errmat_p_r.get_random_error(r2)
-        ephi2 = errmat_p_phi.get_random_error(phi2, r2)
-        ez2   = errmat_p_z.get_random_error(z2, r2)
-        et2   = errmat_p_t.get_random_error(t2)
+        er2   = errmat_p_r.get_random_error(r2, rng=rng)
+        ephi2 = errmat_p_phi.get_random_error(phi2, r2, rng=rng)
+        ez2   = errmat_p_z.get_random_error(z2, r2, rng=rng)
+        et2   = errmat_p_t.get_random_error(t2, rng=rng)
     else:
-        er2   = errmat_c_r.get_random_error(r2)
-        ephi2 = errmat_c_phi.get_random_error(phi2, r2)
-        ez2   = errmat_c_z.get_random_error(z2, r2)
-        et2   = errmat_c_t.get_random_error(t2)
+        er2   = errmat_c_r.get_random_error(r2, rng=rng)
+        ephi2 = errmat_c_phi.get_random_error(phi2, r2, rng=rng)
+        ez2   = errmat_c_z.get_random_error(z2, r2, rng=rng)
+        et2   = errmat_c_t.get_random_error(t2, rng=rng)
 
     if er1 == None or ephi1 == None or ez1 == None or et1 == None or er2 == None or ephi2 == None or ez2 == None or et2 == None:
         events = pd.DataFrame({'event_id':  [float(evt_id)],
@@ -192,3 +207,42 @@ def simulate_reco_event(evt_id: int, hits: pd.DataFrame, particles: pd.DataFrame
                            'reco_z2':   reco_z2,
                            'reco_t2':   reco_t2})
     return events
+
+
+def simulate_reco_events(hits: pd.DataFrame, particles: pd.DataFrame,
+                         errmat_p_r: errmat, errmat_p_phi: errmat3d, errmat_p_z: errmat3d,
+                         errmat_p_t: errmat, errmat_c_r: errmat, errmat_c_phi: errmat3d,
+                         errmat_c_z: errmat3d, errmat_c_t: errmat,
+                         true_e_threshold: float = 0.,
+                         rng: np.random.Generator = None) -> pd.DataFrame:
+    """
+    Simulate the reconstructed coordinates of all the events of the particles
+    dataframe at once, as simulate_reco_event does for one event.
+    The errors of phi and z depend also on the true r.
+    The true interactions of all the events are found in one pass
+    (see find_all_first_interactions_in_active), and the errors of each
+    coordinate are drawn at once for all the photoelectric-like and for
+    all the compton-like interactions.
+    Returns a single dataframe with one row per event, in event id order.
+    As in simulate_reco_event, the events under the energy threshold,
+    without two interactions or with an error that cannot be drawn
+    (empty cell of an error matrix) have all the coordinates set to 0.
+    The errors are drawn from rng, or from the global np.random state
+    if it is None.
+    """
+    errmats = {'r'  : (errmat_p_r  , errmat_c_r  ),
+               'phi': (errmat_p_phi, errmat_c_phi),
+               'z'  : (errmat_p_z  , errmat_c_z  ),
+               't'  : (errmat_p_t  , errmat_c_t  )}
+    return _simulate_reco_events(hits, particles, errmats, _error_args,
+                                 true_e_threshold, rng)
+
+
+def _error_args(var: str, true: Dict[str, np.ndarray]) -> List[np.ndarray]:
+    """
+    Arguments of the sample_errors method of the error matrix of the
+    coordinate var: the errors of phi and z depend also on the true r.
+    """
+    if var in ['r', 't']:
+        return [true[var]]
+    return [true[var], true['r']]
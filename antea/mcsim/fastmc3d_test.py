@@ -0,0 +1,52 @@
+import os
+import numpy  as np
+import pandas as pd
+
+from .           import fastmc
+from .           import fastmc3d
+from .. io.mc_io import EventIndex
+from .. io.mc_io import load_mchits
+from .. io.mc_io import load_mcparticles
+
+
+def test_simulate_reco_events(ANTEADATADIR, fastmc_errmats):
+    """
+    Checks that simulate_reco_events gives the same dataframe as
+    simulate_reco_event applied to each event, with the errors of
+    phi and z depending also on the true r.
+    """
+    PATH_IN   = os.path.join(ANTEADATADIR, 'ring_test_1000ev.h5')
+    hits      = load_mchits(PATH_IN)
+    particles = load_mcparticles(PATH_IN)
+    errmats   = fastmc_errmats(errmat3d=True)
+
+    events = fastmc3d.simulate_reco_events(hits, particles, *errmats, true_e_threshold=0.5)
+    assert list(events.columns) == fastmc.event_columns
+    np.testing.assert_array_equal(events.event_id, np.unique(particles.event_id))
+
+    hits_index      = EventIndex(hits     .event_id.values)
+    particles_index = EventIndex(particles.event_id.values)
+    for evt in events.event_id.values:
+        evt_events = fastmc3d.simulate_reco_event(int(evt), hits, particles, *errmats,
+                                                  true_e_threshold=0.5, hits_index=hits_index,
+                                                  particles_index=particles_index)
+        np.testing.assert_allclose(events[events.event_id == evt].values,
+                                   evt_events.values, atol=1.e-6)
+    assert np.count_nonzero(events.true_r1) > 0
+
+
+def test_simulate_reco_events_generator(ANTEADATADIR, fastmc_errmats):
+    """
+    Checks that simulate_reco_events gives the same result with two
+    generators with the same seed.
+    """
+    PATH_IN   = os.path.join(ANTEADATADIR, 'ring_test_1000ev.h5')
+    hits      = load_mchits(PATH_IN)
+    particles = load_mcparticles(PATH_IN)
+    errmats   = fastmc_errmats(errmat3d=True)
+
+    events1 = fastmc3d.simulate_reco_events(hits, particles, *errmats,
+                                            rng=np.random.default_rng(10))
+    events2 = fastmc3d.simulate_reco_events(hits, particles, *errmats,
+                                            rng=np.random.default_rng(10))
+    pd.testing.assert_frame_equal(events1, events2)
@@ -0,0 +1,47 @@
+#
+# Random number streams of the fast MC modules.
+#
+# All the samplers take an optional rng argument: None keeps using the
+#  global np.random state (so that np.random.seed still reproduces the
+#  results), otherwise a np.random.Generator (or RandomState) is used.
+#  Independent generators for the workers of a sharded simulation are
+#  obtained with spawn_generators.
+#
+import numpy as np
+
+from typing import List, Union
+
+RandomStream = Union[np.random.Generator, np.random.RandomState]
+
+
+def get_rng(rng: Union[None, int, np.random.SeedSequence, RandomStream] = None):
+    """
+    Returns the random stream to draw from: the global np.random state
+    for None (or np.random itself), the given generator itself, or a new
+    np.random.Generator for an integer seed or a SeedSequence.
+    The returned object provides random, uniform and choice.
+    """
+    if rng is None:
+        return np.random
+    if rng is np.random or isinstance(rng, (np.random.Generator, np.random.RandomState)):
+        return rng
+    return np.random.default_rng(rng)
+
+
+def spawn_generators(n_workers: int,
+                     seed: Union[None, int, np.random.SeedSequence] = None) -> List[np.random.Generator]:
+    """
+    Returns n_workers statistically independent generators, spawned from
+    a SeedSequence with the given seed. The same seed gives the same
+    generators, so that a simulation split in n_workers shards is
+    reproducible.
+
+    :param n_workers: the number of generators
+    :type n_workers: int
+    :param seed: the seed (or SeedSequence) of the simulation; None takes
+     fresh entropy from the OS
+    :returns: a list of n_workers np.random.Generator
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return [np.random.default_rng(child) for child in seed.spawn(n_workers)]
@@ -0,0 +1,28 @@
+import numpy                 as np
+import hypothesis.strategies as st
+
+from hypothesis import given
+
+from . rng import get_rng
+from . rng import spawn_generators
+
+
+def test_get_rng():
+    generator = np.random.default_rng(1)
+    assert get_rng()          is np.random
+    assert get_rng(np.random) is np.random
+    assert get_rng(generator) is generator
+    np.testing.assert_array_equal(get_rng(7).random(10),
+                                  np.random.default_rng(7).random(10))
+
+
+@given(st.integers(min_value=1, max_value=10), st.integers(min_value=0, max_value=2**32))
+def test_spawn_generators(n_workers, seed):
+    """
+    Checks that the generators spawned with the same seed draw the same
+    numbers, and that those of different workers draw different numbers.
+    """
+    draws1 = [rng.random(5) for rng in spawn_generators(n_workers, seed)]
+    draws2 = [rng.random(5) for rng in spawn_generators(n_workers, seed)]
+    np.testing.assert_array_equal(draws1, draws2)
+    assert len(np.unique(np.array(draws1)[:, 0])) == n_workers
@@ -13,39 +13,77 @@ def find_hits_of_given_particles(p_ids: Sequence[int], hits: pd.DataFrame) -> pd
     return hits[hits.particle_id.isin(p_ids)]
 
 
-def select_photoelectric(evt_parts: pd.DataFrame, evt_hits: pd.DataFrame) -> Tuple[bool, Sequence[Tuple[float, float, float]]]:
+def find_photoelectric_positions(particles: pd.DataFrame, hits: pd.DataFrame) -> pd.DataFrame:
     """
-    Select only the events where one or two photoelectric events occur, and nothing else.
+    Select, for all the events of the particles and hits tables at once,
+    the events where one or two photoelectric events occur, and nothing else.
+    Return a DataFrame with the event_id, the particle_id and the true
+    position (x, y, z) of each photoelectric interaction of those events,
+    calculated as the energy-weighted average of the hits of the electron.
     """
-    sel_volume   = (evt_parts.initial_volume == 'ACTIVE') & (evt_parts.final_volume == 'ACTIVE')
-    sel_name     =  evt_parts.name == 'e-'
-    sel_vol_name = evt_parts[sel_volume & sel_name]
-    ids          = sel_vol_name.particle_id.values
+    sel_volume   = (particles.initial_volume == 'ACTIVE') & (particles.final_volume == 'ACTIVE')
+    sel_name     =  particles.name == 'e-'
+    sel_vol_name = particles.loc[sel_volume & sel_name, ['event_id', 'particle_id', 'mother_id']]
 
-    sel_hits   = find_hits_of_given_particles(ids, evt_hits)
-    energies   = sel_hits.groupby(['particle_id'])[['energy']].sum()
-    energies   = energies.reset_index()
-    energy_sel = energies[rf.greater_or_equal(energies.energy, 0.476443, allowed_error=1.e-6)]
+    primaries = particles.loc[particles.primary == True, ['event_id', 'particle_id']]
+    primaries = primaries.rename(columns={'particle_id': 'mother_id'})
+    sel_all   = sel_vol_name.merge(primaries, on=['event_id', 'mother_id'])
 
-    sel_vol_name_e  = sel_vol_name[sel_vol_name.particle_id.isin(energy_sel.particle_id)]
+    sel_hits = hits[['event_id', 'particle_id', 'x', 'y', 'z', 'energy']]
+    sel_hits = sel_hits.merge(sel_all[['event_id', 'particle_id']], on=['event_id', 'particle_id'])
+    energies = sel_hits.energy.values.astype(float)
+    sel_hits = pd.DataFrame({'event_id'   : sel_hits.event_id   .values,
+                             'particle_id': sel_hits.particle_id.values,
+                             'energy'     : energies,
+                             'x'          : energies * sel_hits.x.values,
+                             'y'          : energies * sel_hits.y.values,
+                             'z'          : energies * sel_hits.z.values})
 
-    primaries = evt_parts[evt_parts.primary == True]
-    sel_all   = sel_vol_name_e[sel_vol_name_e.mother_id.isin(primaries.particle_id.values)]
-    if len(sel_all) == 0:
-        return (False, [])
+    sums = sel_hits.groupby(['event_id', 'particle_id']).sum()
+    sums = sums[rf.greater_or_equal(sums.energy, 0.476443, allowed_error=1.e-6)]
+    for var in ['x', 'y', 'z']:
+        sums[var] = sums[var] / sums.energy
+    true_pos = sums[['x', 'y', 'z']].reset_index()
 
-    ### Once the event has passed the selection, let's calculate the true position(s)
-    ids      = sel_all.particle_id.values
-    sel_hits = find_hits_of_given_particles(ids, evt_hits)
+    ### Reject events where the two gammas have interacted in the same hemisphere.
+    n_true     = true_pos.groupby('event_id').particle_id.transform('size').values
+    evt_energy = hits.groupby('event_id').energy.sum()
+    evt_energy = evt_energy.reindex(true_pos.event_id.values).values
+    rejected   = (n_true == 1) & (evt_energy > 0.511)
 
-    sel_hits = sel_hits.groupby(['particle_id'])
-    true_pos = []
-    for _, df in sel_hits:
-        hit_positions = np.array([df.x.values, df.y.values, df.z.values]).transpose()
-        true_pos.append(np.average(hit_positions, axis=0, weights=df.energy))
+    return true_pos[~rejected].reset_index(drop=True)
 
-    ### Reject events where the two gammas have interacted in the same hemisphere.
-    if (len(true_pos) == 1) & (evt_hits.energy.sum() > 0.511):
-       return (False, [])
 
-    return (True, true_pos)
+def select_photoelectric_events(particles: pd.DataFrame, hits: pd.DataFrame) -> pd.DataFrame:
+    """
+    Select the photoelectric events of the particles and hits tables, as
+    select_photoelectric does for one event.
+    Return a DataFrame with one row per event of particles, with the
+    selection flag (selected), the number of true positions (n_true) and
+    the first two true positions (true_x1, ..., true_z2), NaN if absent.
+    """
+    true_pos = find_photoelectric_positions(particles, hits)
+    n_true   = true_pos.groupby('event_id').size()
+    i_pos    = true_pos.groupby('event_id').cumcount().values
+
+    events   = pd.DataFrame({'event_id': particles.event_id.unique()})
+    n_true   = n_true.reindex(events.event_id.values, fill_value=0).values
+    events['selected'] = n_true > 0
+    events['n_true']   = n_true
+    for i in [1, 2]:
+        pos_i = true_pos[i_pos == i-1].set_index('event_id')
+        for var in ['x', 'y', 'z']:
+            events['true_{}{}'.format(var, i)] = pos_i[var].reindex(events.event_id.values).values
+
+    return events
+
+
+def select_photoelectric(evt_parts: pd.DataFrame, evt_hits: pd.DataFrame) -> Tuple[bool, Sequence[Tuple[float, float, float]]]:
+    """
+    Select only the events where one or two photoelectric events occur, and nothing else.
+    """
+    true_pos = find_photoelectric_positions(evt_parts, evt_hits)
+    if len(true_pos) == 0:
+        return (False, [])
+
+    return (True, list(true_pos[['x', 'y', 'z']].values))
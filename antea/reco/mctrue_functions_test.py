@@ -89,3 +89,31 @@ def test_select_photoelectric(ANTEADATADIR):
         elif len(true_pos) == 2:
             assert evt_hits.energy.sum() > 0.511
 
+
+def test_select_photoelectric_events(ANTEADATADIR):
+    """
+    This test checks that the function select_photoelectric_events selects,
+    for all the events of a file at once, the same events and true positions
+    as select_photoelectric event by event.
+    """
+    PATH_IN   = os.path.join(ANTEADATADIR, 'ring_test_1000ev.h5')
+    particles = load_mcparticles(PATH_IN)
+    hits      = load_mchits(PATH_IN)
+
+    phot_evts = mcf.select_photoelectric_events(particles, hits)
+    assert np.all(phot_evts.event_id.values == particles.event_id.unique())
+    phot_evts = phot_evts.set_index('event_id')
+
+    for evt in phot_evts.index:
+        evt_parts = particles[particles.event_id == evt]
+        evt_hits  = hits     [hits     .event_id == evt]
+
+        select, true_pos = mcf.select_photoelectric(evt_parts, evt_hits)
+        evt_phot         = phot_evts.loc[evt]
+
+        assert evt_phot.selected == select
+        assert evt_phot.n_true   == len(true_pos)
+        for i, pos in enumerate(true_pos[:2], 1):
+            assert np.allclose([evt_phot['true_x{}'.format(i)],
+                                evt_phot['true_y{}'.format(i)],
+                                evt_phot['true_z{}'.format(i)]], pos)
@@ -1,6 +1,8 @@
 import numpy  as np
 import pandas as pd
 
+from scipy.spatial import cKDTree
+
 from . mctrue_functions import find_hits_of_given_particles
 
 from antea.core.exceptions import WaveformEmptyTable
@@ -26,23 +28,157 @@ def from_cartesian_to_cyl(pos: Sequence[np.array]) -> Sequence[np.array]:
 
 def phi_mean_var(pos_phi: Sequence[float],
                  q: Sequence[float]) -> Tuple[float, float]:
-    diff_sign = min(pos_phi ) < 0 < max(pos_phi)
-    if diff_sign & (np.abs(np.min(pos_phi))>np.pi/2):
-        pos_phi[pos_phi<0] = np.pi + np.pi + pos_phi[pos_phi<0]
-    mean_phi = np.average(pos_phi, weights=q)
-    var_phi  = np.average((pos_phi-mean_phi)**2, weights=q)
+    """
+    Charge-weighted mean and variance of the phi angles of a group of sensors.
+    pos_phi is not modified.
+    """
+    mean_phi, var_phi = segment_phi_mean_var(pos_phi, q, [0, len(pos_phi)])
+
+    return mean_phi[0], var_phi[0]
+
+
+def group_offsets(group_ids: Sequence[int],
+                  n_groups: int) -> Tuple[Sequence[int], Sequence[int]]:
+    """
+    Returns the (stable) order that sorts the rows by group id
+    (from 0 to n_groups - 1) and the offsets of the groups in it:
+    the rows of group i are order[offsets[i]:offsets[i+1]].
+    """
+    group_ids = np.asarray(group_ids, dtype=int)
+    order     = np.argsort(group_ids, kind='stable')
+    sizes     = np.bincount(group_ids, minlength=n_groups)
+    offsets   = np.concatenate([[0], np.cumsum(sizes)])
+
+    return order, offsets
+
+
+def concatenate_sensor_groups(positions: Sequence[Sequence[Tuple[float, float, float]]],
+                              charges: Sequence[Sequence[float]]) -> Tuple[np.array, np.array, np.array]:
+    """
+    Builds the flat arrays of positions and charges, and the group offsets,
+    of a list of groups of sensors (for instance, one per event).
+    """
+    sizes     = [len(q) for q in charges]
+    offsets   = np.concatenate([[0], np.cumsum(sizes, dtype=int)])
+    positions = np.concatenate([np.reshape(pos, (-1, 3)) for pos in positions] + [np.empty((0, 3))])
+    charges   = np.concatenate([np.asarray(q, dtype=float) for q in charges] + [np.empty(0)])
+
+    return positions, charges, offsets
+
+
+def segment_phi_mean_var(pos_phi: Sequence[float],
+                         q: Sequence[float],
+                         offsets: Sequence[int]) -> Tuple[np.array, np.array]:
+    """
+    Charge-weighted mean and variance of the phi angles of many groups of
+    sensors at once. The group i is made of the elements
+    offsets[i]:offsets[i+1] of pos_phi and q.
+    If the angles of a group cross phi = +-pi, its negative angles are
+    shifted by 2pi before averaging. Empty groups get NaN.
+    """
+    pos_phi = np.asarray(pos_phi, dtype=float)
+    q       = np.asarray(q,       dtype=float)
+    offsets = np.asarray(offsets, dtype=int)
+    sizes   = np.diff(offsets)
+    n_segs  = len(sizes)
+    seg_ids = np.repeat(np.arange(n_segs), sizes)
+
+    full    = sizes > 0
+    min_phi = np.full(n_segs, np.nan)
+    max_phi = np.full(n_segs, np.nan)
+    if len(pos_phi):
+        min_phi[full] = np.minimum.reduceat(pos_phi, offsets[:-1][full])
+        max_phi[full] = np.maximum.reduceat(pos_phi, offsets[:-1][full])
+
+    diff_sign = (min_phi < 0) & (0 < max_phi)
+    wrap      = diff_sign & (np.abs(min_phi) > np.pi/2)
+    pos_phi   = np.where(wrap[seg_ids] & (pos_phi < 0), np.pi + np.pi + pos_phi, pos_phi)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tot_q    = np.bincount(seg_ids, weights=q, minlength=n_segs)
+        mean_phi = np.bincount(seg_ids, weights=q*pos_phi, minlength=n_segs) / tot_q
+        var_phi  = np.bincount(seg_ids, weights=q*(pos_phi - mean_phi[seg_ids])**2,
+                               minlength=n_segs) / tot_q
 
     return mean_phi, var_phi
 
 
+sensor_group_dtype = np.dtype([('n_sipms' , 'i8'), ('charge', 'f8'),
+                               ('mean_phi', 'f8'), ('var_phi', 'f8'),
+                               ('mean_z'  , 'f8'), ('var_z'  , 'f8'),
+                               ('x'       , 'f8'), ('y'      , 'f8'), ('z', 'f8')])
+
+
+def charge_weighted_moments(positions: Sequence[Tuple[float, float, float]],
+                            charges: Sequence[float],
+                            offsets: Sequence[int]) -> np.ndarray:
+    """
+    Charge-weighted moments of many groups of sensors at once.
+    The group i is made of the sensors offsets[i]:offsets[i+1] of the
+    (cartesian) positions and charges.
+    Returns one record of sensor_group_dtype per group, with the number of
+    sensors, the total charge, the mean and variance of phi (computed as
+    in phi_mean_var) and of z, and the barycentre (x, y, z).
+    The moments of empty groups are NaN.
+    """
+    positions = np.reshape(np.asarray(positions, dtype=float), (-1, 3))
+    charges   = np.asarray(charges, dtype=float)
+    offsets   = np.asarray(offsets, dtype=int)
+    sizes     = np.diff(offsets)
+    n_segs    = len(sizes)
+    seg_ids   = np.repeat(np.arange(n_segs), sizes)
+
+    moments = np.zeros(n_segs, dtype=sensor_group_dtype)
+    moments['n_sipms'] = sizes
+    moments['charge']  = np.bincount(seg_ids, weights=charges, minlength=n_segs)
+
+    pos_phi = np.arctan2(positions[:, 1], positions[:, 0])
+    moments['mean_phi'], moments['var_phi'] = segment_phi_mean_var(pos_phi, charges, offsets)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i, coord in enumerate(['x', 'y', 'z']):
+            moments[coord] = np.bincount(seg_ids, weights=charges*positions[:, i],
+                                         minlength=n_segs) / moments['charge']
+        moments['mean_z'] = moments['z']
+        moments['var_z']  = np.bincount(seg_ids, weights=charges*(positions[:, 2] - moments['z'][seg_ids])**2,
+                                        minlength=n_segs) / moments['charge']
+
+    return moments
+
+
+def integrate_SiPM_charges(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Integrate the charge in time of each SiPM of each event.
+    """
+    return df.groupby(['event_id','sensor_id'])[['charge']].sum().reset_index()
+
+
+def select_SiPMs_over_thresholds(tot_charges_df: pd.DataFrame,
+                                 thresholds: Sequence[float]) -> Sequence[pd.DataFrame]:
+    """
+    Select, for each threshold, the SiPMs of a df of integrated charges
+    (see integrate_SiPM_charges) with total charge larger than it.
+    """
+    charges = tot_charges_df.charge.values
+    return [tot_charges_df[charges > threshold].reset_index(drop=True) for threshold in thresholds]
+
+
+def find_SiPMs_over_thresholds(df: pd.DataFrame,
+                               thresholds: Sequence[float]) -> Sequence[pd.DataFrame]:
+    """
+    Integrate the charge in time of each SiPM once and select, for each
+    threshold, only those with total charge larger than it.
+    """
+    return select_SiPMs_over_thresholds(integrate_SiPM_charges(df), thresholds)
+
+
 def find_SiPMs_over_threshold(df: pd.DataFrame,
                               threshold: float) -> pd.DataFrame:
     """
     Integrate the charge in time of each SiPM and select only those with
     total charge larger than threshold.
     """
-    tot_charges_df = df.groupby(['event_id','sensor_id'])[['charge']].sum()
-    return tot_charges_df[tot_charges_df.charge > threshold].reset_index()
+    return find_SiPMs_over_thresholds(df, [threshold])[0]
 
 
 def find_closest_sipm(point: Tuple[float, float, float],
@@ -52,13 +188,84 @@ def find_closest_sipm(point: Tuple[float, float, float],
    """
    sns_positions = np.array([sipms.X.values, sipms.Y.values, sipms.Z.values]).transpose()
 
-   subtr        = [np.subtract(point, pos) for pos in sns_positions]
-   distances    = [np.linalg.norm(d) for d in subtr]
-   min_dist     = np.min(distances)
-   min_sipm     = np.isclose(distances, min_dist)
-   closest_sipm = sipms[min_sipm]
+   return sipms.iloc[find_closest_position(point, sns_positions)]
 
-   return closest_sipm.iloc[0]
+
+def sensor_positions(sipms: pd.DataFrame,
+                     sns_ids: Sequence[int]) -> Sequence[Tuple[float, float, float]]:
+    """
+    Return the positions of the given sensor ids, from a SiPMGeometry
+    (any object with a positions_of method) or from a df of SiPMs
+    (indexed on the sensor ids or not).
+    """
+    if hasattr(sipms, 'positions_of'):
+        return sipms.positions_of(sns_ids)
+    if 'SensorID' in sipms.columns:
+        sipms = sipms.set_index('SensorID')
+    sipms = sipms.loc[sns_ids]
+    return np.array([sipms.X.values, sipms.Y.values, sipms.Z.values]).transpose()
+
+
+def find_closest_position(point: Tuple[float, float, float],
+                          positions: Sequence[Tuple[float, float, float]]) -> int:
+    """
+    Find the index of the closest position to a point, the first one
+    in case of ties, as find_closest_sipm does.
+    """
+    distances = np.linalg.norm(positions - np.asarray(point), axis=1)
+    return np.flatnonzero(np.isclose(distances, np.min(distances)))[0]
+
+
+class SiPMLocator:
+    """
+    Spatial index (KD-tree) of the SiPM positions of the database.
+    It is built once from DataSiPM, DataSiPM_idx or a SiPMGeometry and finds the
+    closest SiPM to many points in a single query. The queries restricted to
+    a few SiPMs (those with charge in an event) are done by brute force.
+    """
+    def __init__(self, DataSiPM: pd.DataFrame):
+        if not hasattr(DataSiPM, 'rows_of'):
+            from antea.database.load_db import SiPMGeometry
+            DataSiPM = SiPMGeometry(DataSiPM)
+        self.geometry   = DataSiPM
+        self.sensor_ids = DataSiPM.sensor_ids
+        self.positions  = DataSiPM.positions
+        self.tree       = cKDTree(self.positions)
+
+    def rows(self, sns_ids: Sequence[int]) -> Sequence[int]:
+        """
+        Return the rows of the given sensor ids in the database.
+        """
+        return self.geometry.rows_of(sns_ids)
+
+    def closest_sipms(self, points: Sequence[Tuple[float, float, float]],
+                      sns_ids: Sequence[int] = None) -> Tuple[Sequence[int],
+                                                              Sequence[Tuple[float, float, float]]]:
+        """
+        Return the ids and the positions of the closest SiPM to each point.
+        If sns_ids is given, only those SiPMs are considered. As in
+        find_closest_sipm, ties are solved in favour of the first one
+        in sns_ids (or in the database).
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        if sns_ids is None:
+            ## All the SiPMs within the np.isclose tolerance of the closest one
+            ## are found in the tree, and the first one in the database is taken.
+            min_dists, _ = self.tree.query(points)
+            neighbours   = self.tree.query_ball_point(points, r=min_dists*(1 + 1.e-5) + 1.e-8)
+            rows         = np.array([min(rows) for rows in neighbours], dtype=int)
+            return self.sensor_ids[rows], self.positions[rows]
+
+        if len(sns_ids) == 0:
+            raise ValueError('No SiPMs to choose from')
+        ## Only a few SiPMs are allowed: their distances to all the points
+        ## are computed at once, as find_closest_position does for one point.
+        rows      = self.rows(sns_ids)
+        positions = self.positions[rows]
+        dists     = np.linalg.norm(points[:, np.newaxis] - positions, axis=2)
+        closest   = np.isclose(dists, dists.min(axis=1)[:, np.newaxis]).argmax(axis=1)
+        rows      = rows[closest]
+        return self.sensor_ids[rows], self.positions[rows]
 
 
 def divide_sipms_in_two_hemispheres(sns_ids: Sequence[int],
@@ -76,71 +283,81 @@ def divide_sipms_in_two_hemispheres(sns_ids: Sequence[int],
     Return the lists of the ids, the charges and the positions of the
     SiPMs of the two groups.
     """
+    sns_ids       = np.asarray(sns_ids)
+    sns_positions = np.asarray(sns_positions).reshape(len(sns_ids), 3)
+    sns_charges   = np.asarray(sns_charges)
+
+    sel1 = sns_positions.dot(reference_pos) > 0.
+    sel2 = ~sel1
 
-    q1,   q2   = [], []
-    pos1, pos2 = [], []
-    id1, id2   = [], []
-    for sns_id, sns_pos, charge in zip(sns_ids, sns_positions, sns_charges):
-        scalar_prod = sns_pos.dot(reference_pos)
-        if scalar_prod > 0.:
-            q1  .append(charge)
-            pos1.append(sns_pos)
-            id1 .append(sns_id)
-        else:
-            q2  .append(charge)
-            pos2.append(sns_pos)
-            id2 .append(sns_id)
+    return sns_ids[sel1], sns_ids[sel2], sns_positions[sel1], sns_positions[sel2], sns_charges[sel1], sns_charges[sel2]
 
-    return np.array(id1), np.array(id2), np.array(pos1), np.array(pos2), np.array(q1), np.array(q2)
 
+def divide_sipms_in_two_hemispheres_per_event(evt_ids: Sequence[int],
+                                              sns_positions: Sequence[Tuple[float, float, float]],
+                                              ref_evt_ids: Sequence[int],
+                                              reference_pos: Sequence[Tuple[float, float, float]]) -> Sequence[bool]:
+    """
+    Divide the SiPMs with charge of many events between two hemispheres
+    at once, using the reference direction of the event of each SiPM.
+    evt_ids gives the event of each SiPM and reference_pos the reference
+    direction of each event in ref_evt_ids.
+    Return a mask which is True for the SiPMs in the same hemisphere
+    as the reference direction of their event.
+    """
+    evt_ids       = np.asarray(evt_ids)
+    sns_positions = np.asarray(sns_positions).reshape(len(evt_ids), 3)
+    ref_evt_ids   = np.asarray(ref_evt_ids)
+    reference_pos = np.asarray(reference_pos).reshape(len(ref_evt_ids), 3)
+
+    if not np.all(np.isin(evt_ids, ref_evt_ids)):
+        raise ValueError('Missing reference position for some events')
+    order = np.argsort(ref_evt_ids, kind='stable')
+    i_ref = order[np.searchsorted(ref_evt_ids, evt_ids, sorter=order)]
+
+    scalar_prods = np.einsum('ij,ij->i', sns_positions, reference_pos[i_ref])
+    return scalar_prods > 0.
 
 
 def assign_sipms_to_gammas(sns_response: pd.DataFrame,
                            true_pos: Sequence[Tuple[float, float, float]],
-                                              DataSiPM_idx: pd.DataFrame) -> Tuple[Sequence[int],
-                                                                                   Sequence[int],
-                                                                                   Sequence[Tuple[float, float, float]],
-                                                                                   Sequence[Tuple[float, float, float]],
-                                                                                   Sequence[float],
-                                                                                   Sequence[float]]:
+                           DataSiPM_idx: pd.DataFrame,
+                           locator: SiPMLocator = None) -> Tuple[Sequence[int],
+                                                                Sequence[int],
+                                                                Sequence[Tuple[float, float, float]],
+                                                                Sequence[Tuple[float, float, float]],
+                                                                Sequence[float],
+                                                                Sequence[float]]:
     """
     Divide the SiPMs with charge between the two back-to-back gammas,
     or to one of the two if the other one hasn't interacted.
     Return the lists of the charges and the positions of the SiPMs of
     the two groups.
     DataSiPM_idx is assumed to be indexed on the sensor ids. If it is not,
-    it is indexed inside the function.
-    """
-    if 'SensorID' in DataSiPM_idx.columns:
-        DataSiPM_idx = DataSiPM_idx.set_index('SensorID')
-    sipms           = DataSiPM_idx.loc[sns_response.sensor_id]
-    sns_ids         = sipms.index.astype('int64').values
-    sns_closest_pos = [np.array([find_closest_sipm(pos, sipms).X,
-                                 find_closest_sipm(pos, sipms).Y,
-                                 find_closest_sipm(pos, sipms).Z])
-                       for pos in true_pos]
-
-    q1,   q2   = [], []
-    pos1, pos2 = [], []
-    id1, id2   = [], []
-
-    sns_positions = np.array([sipms.X.values, sipms.Y.values, sipms.Z.values]).transpose()
-    sns_charges   = sns_response.charge
+    it is indexed inside the function. A SiPMGeometry can be given instead.
+    If a SiPMLocator is given, the closest SiPM to each true position is
+    found with a single query of it.
+    """
+    sns_ids       = sns_response.sensor_id.values.astype('int64')
+    sns_positions = sensor_positions(DataSiPM_idx, sns_ids)
+    sns_charges   = sns_response.charge.values
+    if locator is None:
+        sns_closest_pos = [sns_positions[find_closest_position(pos, sns_positions)] for pos in true_pos]
+    else:
+        _, sns_closest_pos = locator.closest_sipms(true_pos, sns_ids)
+
     closest_pos   = sns_closest_pos[0] ## Look at the first one, which always exists.
     ### The sensors on the same semisphere are grouped together,
     ### and those on the opposite side, too, only
     ### if two interactions have been detected.
+    sel1 = sns_positions.dot(closest_pos) > 0.
+    sel2 = ~sel1
+    if len(sns_closest_pos) != 2:
+        sel2 = np.zeros(len(sel1), dtype=bool)
 
-    for sns_id, sns_pos, charge in zip(sns_ids, sns_positions, sns_charges):
-        scalar_prod = sns_pos.dot(closest_pos)
-        if scalar_prod > 0.:
-            q1  .append(charge)
-            pos1.append(sns_pos)
-            id1.append(sns_id)
-        elif len(sns_closest_pos) == 2:
-            q2  .append(charge)
-            pos2.append(sns_pos)
-            id2.append(sns_id)
+    id1,  id2  = list(sns_ids      [sel1]), list(sns_ids      [sel2])
+    pos1, pos2 = list(sns_positions[sel1]), list(sns_positions[sel2])
+    q1,   q2   = list(sns_charges  [sel1]), list(sns_charges  [sel2])
 
     return id1, id2, pos1, pos2, q1, q2
 
@@ -230,6 +447,8 @@ def find_first_interactions_in_active(particles: pd.DataFrame,
                                                                        bool, bool]:
     """
     Looks for the first interaction of primary gammas in the active volume.
+    An interaction without hits in its hemisphere is considered
+    photoelectric-like, as all its hits (none) are close to it.
     """
     ### select electrons, primary gammas daughters in ACTIVE
     sel_volume   = (particles.initial_volume == 'ACTIVE') & (particles.final_volume == 'ACTIVE')
@@ -268,13 +487,13 @@ def find_first_interactions_in_active(particles: pd.DataFrame,
     ## find if the event is photoelectric-like
 
     distances1 = find_hit_distances_from_true_pos(hits, gamma_pos1)
-    if max(distances1) > photo_range: ## hits at <1 mm distance are considered of the same point
+    if len(distances1) and max(distances1) > photo_range: ## hits at <1 mm distance are considered of the same point
         phot_like1 = False
     else:
         phot_like1 = True
 
     distances2 = find_hit_distances_from_true_pos(hits, gamma_pos2)
-    if max(distances2) > photo_range: ## hits at <1 mm distance are considered of the same point
+    if len(distances2) and max(distances2) > photo_range: ## hits at <1 mm distance are considered of the same point
         phot_like2 = False
     else:
         phot_like2 = True
@@ -282,6 +501,88 @@ def find_first_interactions_in_active(particles: pd.DataFrame,
     return gamma_pos1, gamma_pos2, min_t1, min_t2, phot_like1, phot_like2
 
 
+def first_rows_per_group(df: pd.DataFrame, group_cols: Sequence[str],
+                         sort_cols: Sequence[str]) -> pd.DataFrame:
+    """
+    Returns, for each group, the first row with the minimum values
+    of sort_cols (compared in order), following the order of the rows
+    in df for ties.
+    """
+    keys  = [np.arange(len(df))] + [df[col].values for col in sort_cols [::-1]] \
+                                 + [df[col].values for col in group_cols[::-1]]
+    first = df.iloc[np.lexsort(keys)]
+    return first[~first.duplicated(subset=group_cols, keep='first')]
+
+
+def find_all_first_interactions_in_active(particles: pd.DataFrame,
+                                          hits: pd.DataFrame,
+                                          photo_range: float = 1.) -> pd.DataFrame:
+    """
+    Looks for the first interaction of primary gammas in the active volume,
+    for all the events of the particles and hits tables at once.
+    Returns a DataFrame with one row per event in which both gammas interact,
+    with the position (true_x1, true_y1, true_z1, ...) and time (true_t1, true_t2)
+    of the two interactions and whether they are photoelectric-like
+    (phot_like1, phot_like2), as find_first_interactions_in_active does
+    for one event. An interaction without hits in its hemisphere
+    is considered photoelectric-like, in both functions.
+    """
+    ### select electrons, primary gammas daughters in ACTIVE
+    sel_volume   = (particles.initial_volume == 'ACTIVE') & (particles.final_volume == 'ACTIVE')
+    sel_name     = particles.name == 'e-'
+    sel_mother   = particles.mother_id.isin([1, 2])
+    primaries    = particles.loc[particles.primary == True, ['event_id', 'particle_id']]
+    primaries    = primaries.rename(columns={'particle_id': 'mother_id'})
+    sel_all      = particles[sel_volume & sel_name & sel_mother]
+    sel_all      = sel_all[pd.MultiIndex.from_frame(sel_all[['event_id', 'mother_id']])
+                           .isin(pd.MultiIndex.from_frame(primaries))]
+
+    ### Initial vertex of the first daughter of each gamma...
+    daughters = first_rows_per_group(sel_all, ['event_id', 'mother_id'], ['initial_t'])
+    daughters = pd.DataFrame({'event_id': daughters.event_id .values,
+                              'gamma'   : daughters.mother_id.values,
+                              'x_d'     : daughters.initial_x.values,
+                              'y_d'     : daughters.initial_y.values,
+                              'z_d'     : daughters.initial_z.values,
+                              't_d'     : daughters.initial_t.values})
+
+    ### ...and first hit of each gamma, if any.
+    gamma_hits = hits[hits.particle_id.isin([1, 2])]
+    gamma_hits = first_rows_per_group(gamma_hits, ['event_id', 'particle_id'], ['time'])
+    gamma_hits = pd.DataFrame({'event_id': gamma_hits.event_id   .values,
+                               'gamma'   : gamma_hits.particle_id.values,
+                               'x_h'     : gamma_hits.x          .values,
+                               'y_h'     : gamma_hits.y          .values,
+                               'z_h'     : gamma_hits.z          .values,
+                               't_h'     : gamma_hits.time       .values})
+
+    ### The hit is taken when it happens before the daughter vertex.
+    first   = daughters.merge(gamma_hits, on=['event_id', 'gamma'], how='outer')
+    use_hit = first.t_h.fillna(np.inf).values < first.t_d.fillna(np.inf).values
+    for var in ['x', 'y', 'z', 't']:
+        first[var] = np.where(use_hit, first[var+'_h'], first[var+'_d'])
+    first = first[['event_id', 'gamma', 'x', 'y', 'z', 't']]
+
+    first1 = first[first.gamma == 1].drop(columns='gamma')
+    first2 = first[first.gamma == 2].drop(columns='gamma')
+    interactions = first1.merge(first2, on='event_id', suffixes=('1', '2'))
+    interactions = interactions.sort_values('event_id').reset_index(drop=True)
+    interactions.columns = ['event_id'] + ['true_' + col for col in interactions.columns[1:]]
+
+    ## find if the events are photoelectric-like:
+    ## hits at <photo_range distance are considered of the same point
+    evt_hits = hits[['event_id', 'x', 'y', 'z']].merge(interactions, on='event_id')
+    hit_pos  = evt_hits[['x', 'y', 'z']].values
+    for i in ['1', '2']:
+        true_pos  = evt_hits[['true_x'+i, 'true_y'+i, 'true_z'+i]].values
+        same_side = np.einsum('ij,ij->i', hit_pos, true_pos) >= 0
+        far       = same_side & (np.linalg.norm(hit_pos - true_pos, axis=1) > photo_range)
+        far_evts  = evt_hits.event_id.values[far]
+        interactions['phot_like'+i] = ~interactions.event_id.isin(far_evts).values
+
+    return interactions
+
+
 def reconstruct_coincidences(sns_response: pd.DataFrame,
                              charge_range: Tuple[float, float],
                              DataSiPM_idx: pd.DataFrame,
@@ -303,21 +604,16 @@ def reconstruct_coincidences(sns_response: pd.DataFrame,
     true gamma by position.
     A range of charge is given to select singles in the photoelectric peak.
     DataSiPM_idx is assumed to be indexed on the sensor ids. If it is not,
-    it is indexed inside the function.
+    it is indexed inside the function. A SiPMGeometry can be given instead.
     """
-    if 'SensorID' in DataSiPM_idx.columns:
-        DataSiPM_idx = DataSiPM_idx.set_index('SensorID')
-
     max_sns = sns_response[sns_response.charge == sns_response.charge.max()]
     ## If by chance two sensors have the maximum charge, choose one (arbitrarily)
     if len(max_sns != 1):
         max_sns = max_sns[max_sns.sensor_id == max_sns.sensor_id.min()]
-    max_sipm = DataSiPM_idx.loc[max_sns.sensor_id]
-    max_pos  = np.array([max_sipm.X.values, max_sipm.Y.values, max_sipm.Z.values]).transpose()[0]
+    max_pos = sensor_positions(DataSiPM_idx, max_sns.sensor_id.values)[0]
 
-    sipms         = DataSiPM_idx.loc[sns_response.sensor_id]
-    sns_ids       = sipms.index.astype('int64').values
-    sns_positions = np.array([sipms.X.values, sipms.Y.values, sipms.Z.values]).transpose()
+    sns_ids       = sns_response.sensor_id.values.astype('int64')
+    sns_positions = sensor_positions(DataSiPM_idx, sns_ids)
     sns_charges   = sns_response.charge
 
     sns1, sns2, pos1, pos2, q1, q2 = divide_sipms_in_two_hemispheres(sns_ids, sns_positions, sns_charges, max_pos)
@@ -355,6 +651,99 @@ def reconstruct_coincidences(sns_response: pd.DataFrame,
     return int_pos1, int_pos2, int_q1, int_q2, true_pos1, true_pos2, true_t1, true_t2, int_sns1, int_sns2
 
 
+coincidence_dtype = np.dtype([('event_id'   , 'i8'),
+                              ('coincidence', '?' ),
+                              ('true_x1'    , 'f8'), ('true_y1', 'f8'), ('true_z1', 'f8'),
+                              ('true_t1'    , 'f8'),
+                              ('true_x2'    , 'f8'), ('true_y2', 'f8'), ('true_z2', 'f8'),
+                              ('true_t2'    , 'f8'),
+                              ('n_sipms1'   , 'i8'), ('n_sipms2', 'i8'),
+                              ('charge1'    , 'f8'), ('charge2' , 'f8')])
+
+
+def reconstruct_coincidences_block(sns_response: pd.DataFrame,
+                                   charge_range: Tuple[float, float],
+                                   sipm_geometry: 'SiPMGeometry',
+                                   particles: pd.DataFrame,
+                                   hits: pd.DataFrame) -> Tuple[np.ndarray, Sequence[int]]:
+    """
+    Array version of reconstruct_coincidences, for all the events of
+    a block (a file or a chunk of it) at once.
+    sns_response holds the integrated charge of the SiPMs of the events
+    (see find_SiPMs_over_threshold), particles and hits their MC information.
+    Returns one record of coincidence_dtype per event of sns_response,
+    in event id order, and the gamma (1 or 2) each SiPM of sns_response
+    is assigned to, 0 if its event is not a coincidence.
+    """
+    evt_ids   = sns_response.event_id .values
+    sns_ids   = sns_response.sensor_id.values
+    charges   = sns_response.charge   .values
+    positions = sipm_geometry.positions_of(sns_ids)
+
+    events, evt_rows = np.unique(evt_ids, return_inverse=True)
+    n_evts           = len(events)
+
+    ## SiPM with maximum charge of each event. If by chance two sensors
+    ## have the maximum charge, the one with minimum id is chosen.
+    order    = np.lexsort((sns_ids, -charges, evt_rows))
+    max_rows = order[np.searchsorted(evt_rows[order], np.arange(n_evts))]
+    max_pos  = positions[max_rows]
+
+    same_side = np.einsum('ij,ij->i', positions, max_pos[evt_rows]) > 0.
+    tot_q1    = np.bincount(evt_rows, weights=np.where( same_side, charges, 0), minlength=n_evts)
+    tot_q2    = np.bincount(evt_rows, weights=np.where(~same_side, charges, 0), minlength=n_evts)
+    sel1      = (tot_q1 > charge_range[0]) & (tot_q1 < charge_range[1])
+    sel2      = (tot_q2 > charge_range[0]) & (tot_q2 < charge_range[1])
+    sel_evts  = events[sel1 & sel2]
+
+    interactions = find_all_first_interactions_in_active(particles[particles.event_id.isin(sel_evts)],
+                                                         hits     [hits     .event_id.isin(sel_evts)])
+    found        = np.isin(events, interactions.event_id.values) & sel1 & sel2
+
+    records = np.zeros(n_evts, dtype=coincidence_dtype)
+    records['event_id']    = events
+    records['coincidence'] = found
+    if len(interactions):
+        int_rows = np.searchsorted(interactions.event_id.values, events)
+        int_rows = np.minimum(int_rows, len(interactions) - 1)
+        for var in ['true_x1', 'true_y1', 'true_z1', 'true_t1',
+                    'true_x2', 'true_y2', 'true_z2', 'true_t2']:
+            records[var] = np.where(found, interactions[var].values[int_rows], 0)
+
+    ### The group of SiPMs in the same hemisphere as the first gamma is assigned to it.
+    true_pos1   = np.array([records['true_x1'], records['true_y1'], records['true_z1']]).transpose()
+    gamma1_side = np.einsum('ij,ij->i', true_pos1, max_pos) > 0
+    labels      = np.where(same_side == gamma1_side[evt_rows], 1, 2)
+    labels      = np.where(found[evt_rows], labels, 0)
+
+    for gamma in [1, 2]:
+        in_group = labels == gamma
+        records['n_sipms{}'.format(gamma)] = np.bincount(evt_rows, weights=in_group, minlength=n_evts)
+        records['charge{}' .format(gamma)] = np.bincount(evt_rows, weights=np.where(in_group, charges, 0),
+                                                         minlength=n_evts)
+
+    return records, labels
+
+
+def reconstruct_event_coincidence(sns_response: pd.DataFrame,
+                                  charge_range: Tuple[float, float],
+                                  sipm_geometry: 'SiPMGeometry',
+                                  particles: pd.DataFrame,
+                                  hits: pd.DataFrame) -> Tuple[np.void, Sequence[int]]:
+    """
+    Array version of reconstruct_coincidences for one event, using a
+    SiPMGeometry instead of DataSiPM_idx.
+    Returns the record of coincidence_dtype of the event and the gamma
+    (1 or 2, 0 if it is not a coincidence) each SiPM is assigned to.
+    Raises WaveformEmptyTable if there are no SiPMs with charge.
+    """
+    if len(sns_response) == 0:
+        raise WaveformEmptyTable("Sensor response dataframe is empty")
+    records, labels = reconstruct_coincidences_block(sns_response, charge_range, sipm_geometry,
+                                                     particles, hits)
+    return records[0], labels
+
+
 def find_coincidence_timestamps(tof_response: pd.DataFrame,
                                 sns1: Sequence[int],
                                 sns2: Sequence[int])-> Tuple[int, int, int, int]:
@@ -366,3 +755,52 @@ def find_coincidence_timestamps(tof_response: pd.DataFrame,
     min2, time2 = find_first_time_of_sensors(tof_response, -sns2)
 
     return min1, min2, time1, time2
+
+
+def find_first_times_of_sensor_groups(tof_response: pd.DataFrame,
+                                      evt_ids: Sequence[int],
+                                      sns_ids: Sequence[int],
+                                      groups: Sequence[int]) -> pd.DataFrame:
+    """
+    Batch version of find_first_time_of_sensors, for several groups of
+    sensors of many events at once.
+    evt_ids, sns_ids (positive ids) and groups give the event and the group
+    of each sensor; sensors of group 0 are ignored.
+    Returns a DataFrame with the event_id, the group, the positive id of the
+    sensor (sensor_id) and the time (time_bin) of the first photoelectron
+    of each group with signal in tof_response. In case more than one
+    photoelectron arrives at the same time, the sensor with minimum id
+    in tof_response is chosen, as in find_first_time_of_sensors.
+    """
+    groups      = np.asarray(groups)
+    assignments = pd.DataFrame({'event_id' :  np.asarray(evt_ids)[groups > 0],
+                                'sensor_id': -np.asarray(sns_ids)[groups > 0],
+                                'group'    :  groups[groups > 0]})
+
+    tof   = tof_response[['event_id', 'sensor_id', 'time_bin']]
+    tof   = tof.merge(assignments, on=['event_id', 'sensor_id'])
+    first = first_rows_per_group(tof, ['event_id', 'group'], ['time_bin', 'sensor_id'])
+    first = first.sort_values(['event_id', 'group']).reset_index(drop=True)
+    first['sensor_id'] = np.abs(first.sensor_id.values)
+
+    return first[['event_id', 'group', 'sensor_id', 'time_bin']]
+
+
+def find_all_coincidence_timestamps(tof_response: pd.DataFrame,
+                                    evt_ids: Sequence[int],
+                                    sns_ids: Sequence[int],
+                                    groups: Sequence[int]) -> pd.DataFrame:
+    """
+    Finds the first time and sensor of the two groups of sensors (1 and 2)
+    of all the events, given the full tof response dataframe, as
+    find_coincidence_timestamps does for one event.
+    Returns a DataFrame with one row per event where both groups have signal,
+    with columns event_id, first_sipm1, first_time1, first_sipm2, first_time2.
+    """
+    first  = find_first_times_of_sensor_groups(tof_response, evt_ids, sns_ids, groups)
+    first1 = first[first.group == 1].drop(columns='group')
+    first2 = first[first.group == 2].drop(columns='group')
+    stamps = first1.merge(first2, on='event_id', suffixes=('1', '2'))
+    stamps.columns = ['event_id', 'first_sipm1', 'first_time1', 'first_sipm2', 'first_time2']
+
+    return stamps
@@ -1,5 +1,7 @@
 import os
+import sys
 import math
+import subprocess
 import numpy                 as np
 import pandas                as pd
 import hypothesis.strategies as st
@@ -7,6 +9,7 @@ import hypothesis.strategies as st
 from hypothesis  import given
 from hypothesis  import assume
 from pytest      import raises
+from pytest      import fixture
 from .           import reco_functions   as rf
 from .           import mctrue_functions as mcf
 from .. database import load_db          as db
@@ -89,6 +92,32 @@ def test_find_SiPMs_over_threshold(ANTEADATADIR):
     assert len(df_over_thr) == len(sns_response) - len(df_below_thr)
 
 
+@fixture(scope='module')
+def sns_response_1000ev(ANTEADATADIR):
+    PATH_IN = os.path.join(ANTEADATADIR, 'ring_test_1000ev.h5')
+    return load_mcsns_response(PATH_IN)
+
+
+thresholds = st.lists(st.floats(min_value=0, max_value=10), min_size=1, max_size=4)
+
+@given(thresholds)
+def test_find_SiPMs_over_thresholds(sns_response_1000ev, thresholds):
+    """
+    Checks that the function find_SiPMs_over_thresholds, which integrates
+    the charge of the SiPMs only once, selects for each threshold
+    the same SiPMs as the integration of the charge followed by a cut.
+    """
+    sns_response = sns_response_1000ev
+    tot_charges  = sns_response.groupby(['event_id','sensor_id'])[['charge']].sum()
+
+    dfs_over_thr = rf.find_SiPMs_over_thresholds(sns_response, thresholds)
+    assert len(dfs_over_thr) == len(thresholds)
+
+    for threshold, df_over_thr in zip(thresholds, dfs_over_thr):
+        expected = tot_charges[tot_charges.charge > threshold].reset_index()
+        pd.testing.assert_frame_equal(df_over_thr, expected)
+
+
 sipm_id = st.integers(0, len(DataSiPM)-1)
 @given(x, y, z, sipm_id)
 def test_find_closest_sipm(x, y, z, sipm_id):
@@ -115,6 +144,37 @@ def test_find_closest_sipm(x, y, z, sipm_id):
     assert dist1 > 0
 
 
+def test_import_without_ANTEADIR():
+    """
+    Checks that the reconstruction functions can be imported without
+    ANTEADIR, which only the database functions need.
+    """
+    env = {key: val for key, val in os.environ.items() if key != 'ANTEADIR'}
+    cmd = 'import antea.reco.reco_functions'
+    assert subprocess.run([sys.executable, '-c', cmd], env=env).returncode == 0
+
+
+sipm_ids = st.lists(sipm_id, min_size=1, max_size=100, unique=True)
+@given(x, y, z, sipm_ids)
+def test_SiPMLocator_closest_sipms(x, y, z, sipm_ids):
+    """
+    Checks that the closest SiPM found by SiPMLocator, among all the
+    SiPMs or only among some of them, is the one found by find_closest_sipm.
+    """
+    locator = rf.SiPMLocator(DataSiPM)
+    point   = np.array([x, y, z])
+
+    closest_ids, closest_pos = locator.closest_sipms([point])
+    closest_sipm             = rf.find_closest_sipm(point, DataSiPM_idx)
+    assert closest_ids[0] == closest_sipm.name
+    np.testing.assert_array_equal(closest_pos[0], [closest_sipm.X, closest_sipm.Y, closest_sipm.Z])
+
+    sipms           = DataSiPM_idx.iloc[sipm_ids]
+    closest_ids, _  = locator.closest_sipms([point, point], sipms.index.values)
+    closest_sipm    = rf.find_closest_sipm(point, sipms)
+    assert np.all(closest_ids == closest_sipm.name)
+
+
 elements =st.tuples(st.integers(min_value=1,     max_value=1000),
                     st.floats  (min_value=-1000, max_value=1000),
                     st.floats  (min_value=-1000, max_value=1000),
@@ -153,6 +213,94 @@ def test_divide_sipms_in_two_hemispheres(x, y, z, l):
     assert (scalar_prod2 < 0).all()
 
 
+def test_phi_mean_var_does_not_modify_input():
+    """
+    Checks that phi_mean_var shifts the negative angles of a group
+    crossing phi = +-pi without modifying its input.
+    """
+    pos_phi = np.array([3., -3., 2.9])
+    q       = np.array([1.,  2., 1. ])
+    copy    = pos_phi.copy()
+
+    mean_phi, var_phi = rf.phi_mean_var(pos_phi, q)
+
+    np.testing.assert_array_equal(pos_phi, copy)
+    assert np.isclose(mean_phi, (3. + 2*(2*np.pi - 3.) + 2.9) / 4)
+    assert var_phi >= 0
+
+
+@given(l, st.integers(min_value=1, max_value=5))
+def test_charge_weighted_moments(l, n_groups):
+    """
+    Checks that charge_weighted_moments gives, for each group of sensors,
+    the same moments as phi_mean_var and np.average applied to the group alone,
+    and NaN for empty groups.
+    """
+    sns_positions = np.array([el[1:4] for el in l])
+    sns_charges   = np.array([el [4]  for el in l], dtype=float)
+    group_ids     = np.arange(len(l)) % (n_groups + 1)
+    group_ids[group_ids == n_groups] = 0 ## group n_groups is left empty
+
+    order, offsets = rf.group_offsets(group_ids, n_groups + 1)
+    moments        = rf.charge_weighted_moments(sns_positions[order], sns_charges[order], offsets)
+    assert len(moments) == n_groups + 1
+
+    for group, mom in enumerate(moments):
+        pos = sns_positions[group_ids == group]
+        q   = sns_charges  [group_ids == group]
+        assert mom['n_sipms'] == len(q)
+        if len(q) == 0:
+            assert np.isnan(mom['var_phi']) and np.isnan(mom['z'])
+            continue
+
+        mean_phi, var_phi = rf.phi_mean_var(rf.from_cartesian_to_cyl(pos)[:, 1], q)
+        mean_z            = np.average(pos[:, 2], weights=q)
+        var_z             = np.average((pos[:, 2] - mean_z)**2, weights=q)
+        reco_cart         = np.average(pos, weights=q, axis=0)
+
+        assert np.isclose(mom['charge'],   q.sum())
+        assert np.isclose(mom['mean_phi'], mean_phi)
+        assert np.isclose(mom['var_phi'],  var_phi)
+        assert np.isclose(mom['mean_z'],   mean_z)
+        assert np.isclose(mom['var_z'],    var_z, atol=1.e-6)
+        np.testing.assert_allclose([mom['x'], mom['y'], mom['z']], reco_cart, atol=1.e-8)
+
+
+@given(l, st.integers(min_value=1, max_value=5))
+def test_divide_sipms_in_two_hemispheres_per_event(l, n_evts):
+    """
+    Checks that the function divide_sipms_in_two_hemispheres_per_event
+    selects the same SiPMs as divide_sipms_in_two_hemispheres applied
+    to each event separately, and that it raises ValueError when the
+    reference position of an event is missing.
+    """
+    sns_positions = np.array([el[1:4] for el in l])
+    sns_charges   = np.array([el [4]  for el in l])
+    sns_ids       = np.array([el [0]  for el in l])
+    evt_ids       = np.arange(len(l)) % n_evts
+
+    ref_evt_ids   = np.arange(n_evts)[::-1]
+    reference_pos = np.array([[ 1., 0., 0.], [0., 1., 0.], [0., 0., 1.],
+                              [-1., 1., 0.], [1., 1., 1.]])[:n_evts]
+
+    sel = rf.divide_sipms_in_two_hemispheres_per_event(evt_ids, sns_positions,
+                                                       ref_evt_ids, reference_pos)
+    assert len(sel) == len(l)
+
+    for evt, ref_pos in zip(ref_evt_ids, reference_pos):
+        evt_sel = evt_ids == evt
+        _, _, pos1, _, q1, _ = rf.divide_sipms_in_two_hemispheres(sns_ids      [evt_sel],
+                                                                   sns_positions[evt_sel],
+                                                                   sns_charges  [evt_sel],
+                                                                   ref_pos)
+        np.testing.assert_array_equal(sns_positions[evt_sel & sel], pos1)
+        np.testing.assert_array_equal(sns_charges  [evt_sel & sel], q1)
+
+    with raises(ValueError):
+        rf.divide_sipms_in_two_hemispheres_per_event(evt_ids, sns_positions,
+                                                     ref_evt_ids[:-1], reference_pos[:-1])
+
+
 def test_assign_sipms_to_gammas(ANTEADATADIR):
     """
     Checks that the function assign_sipms_to_gammas divides the SiPMs
@@ -254,6 +402,70 @@ def test_part_first_hit(ANTEADATADIR, part_id):
            assert tmin_from_pos <= t
 
 
+def test_find_all_first_interactions_in_active(ANTEADATADIR):
+    """
+    Checks that the function find_all_first_interactions_in_active returns,
+    for all the events of a file at once, the same first interactions
+    as find_first_interactions_in_active event by event.
+    """
+    PATH_IN   = os.path.join(ANTEADATADIR, 'ring_test_1000ev.h5')
+    particles = load_mcparticles(PATH_IN)
+    hits      = load_mchits(PATH_IN)
+
+    interactions = rf.find_all_first_interactions_in_active(particles, hits)
+    interactions = interactions.set_index('event_id')
+
+    for evt in particles.event_id.unique():
+        evt_parts = particles[particles.event_id == evt]
+        evt_hits  = hits     [hits     .event_id == evt]
+
+        pos1, pos2, t1, t2, phot1, phot2 = rf.find_first_interactions_in_active(evt_parts, evt_hits)
+        if not len(pos1) or not len(pos2):
+            assert evt not in interactions.index
+            continue
+
+        evt_int = interactions.loc[evt]
+        assert np.allclose([evt_int.true_x1, evt_int.true_y1, evt_int.true_z1], pos1)
+        assert np.allclose([evt_int.true_x2, evt_int.true_y2, evt_int.true_z2], pos2)
+        assert evt_int.true_t1    == t1
+        assert evt_int.true_t2    == t2
+        assert evt_int.phot_like1 == phot1
+        assert evt_int.phot_like2 == phot2
+
+
+def test_first_interactions_without_hits_in_hemisphere():
+    """
+    Checks that an interaction without hits in its hemisphere is
+    photoelectric-like for both find_first_interactions_in_active
+    and find_all_first_interactions_in_active.
+    """
+    particles = pd.DataFrame({'event_id'      : [7, 7, 7, 7],
+                              'particle_id'   : [1, 2, 3, 4],
+                              'name'          : ['gamma', 'gamma', 'e-', 'e-'],
+                              'primary'       : [True, True, False, False],
+                              'mother_id'     : [0, 0, 1, 2],
+                              'initial_x'     : [0., 0., 0., 0.],
+                              'initial_y'     : [0., 0.,  400., -400.],
+                              'initial_z'     : [0., 0., 0., 0.],
+                              'initial_t'     : [0., 0., 1., 2.],
+                              'initial_volume': ['OTHER', 'OTHER', 'ACTIVE', 'ACTIVE'],
+                              'final_volume'  : ['OTHER', 'OTHER', 'ACTIVE', 'ACTIVE']})
+    hits      = pd.DataFrame({'event_id'   : [7, 7],
+                              'particle_id': [3, 3],
+                              'x'          : [0., 0.],
+                              'y'          : [400., 405.],
+                              'z'          : [0., 0.],
+                              'time'       : [1., 1.1],
+                              'energy'     : [0.3, 0.2]})
+
+    pos1, pos2, t1, t2, phot1, phot2 = rf.find_first_interactions_in_active(particles, hits)
+    assert not phot1 and phot2
+
+    interactions = rf.find_all_first_interactions_in_active(particles, hits)
+    assert interactions.phot_like1.tolist() == [phot1]
+    assert interactions.phot_like2.tolist() == [phot2]
+
+
 def test_find_first_time_of_sensors(ANTEADATADIR):
     """
     Checks that the function find_first_time_of_sensors returns the sensors id
@@ -276,6 +488,39 @@ def test_find_first_time_of_sensors(ANTEADATADIR):
             assert rf.lower_or_equal(time_from_id, t)
 
 
+def test_find_all_coincidence_timestamps(ANTEADATADIR):
+    """
+    Checks that the function find_all_coincidence_timestamps returns, for all
+    the events at once, the same first sensors and times of two groups
+    of sensors as find_coincidence_timestamps event by event.
+    The sensors of each event are divided in two groups by parity of their id.
+    """
+    PATH_IN = os.path.join(ANTEADATADIR, 'ring_test.h5')
+    tof_response = load_mcTOFsns_response(PATH_IN)
+    sensors      = tof_response[['event_id', 'sensor_id']].drop_duplicates()
+    evt_ids      =  sensors.event_id .values
+    sns_ids      = -sensors.sensor_id.values
+    groups       = sns_ids % 2 + 1
+
+    timestamps = rf.find_all_coincidence_timestamps(tof_response, evt_ids, sns_ids, groups)
+    timestamps = timestamps.set_index('event_id')
+
+    for evt in tof_response.event_id.unique():
+        tof  = tof_response[tof_response.event_id==evt]
+        sns1 = sns_ids[(evt_ids == evt) & (groups == 1)]
+        sns2 = sns_ids[(evt_ids == evt) & (groups == 2)]
+        if not len(sns1) or not len(sns2):
+            assert evt not in timestamps.index
+            continue
+
+        min_id1, min_id2, min_t1, min_t2 = rf.find_coincidence_timestamps(tof, sns1, sns2)
+        evt_stamps = timestamps.loc[evt]
+        assert evt_stamps.first_sipm1 == min_id1
+        assert evt_stamps.first_sipm2 == min_id2
+        assert evt_stamps.first_time1 == min_t1
+        assert evt_stamps.first_time2 == min_t2
+
+
 l = st.lists(st.integers(min_value=-10000, max_value=-1000), min_size=1, max_size=5)
 
 @given(l)
@@ -381,6 +626,61 @@ def test_select_coincidences(ANTEADATADIR):
             assert not len(q1)   and not len(q2)
 
 
+def test_reconstruct_coincidences_block(ANTEADATADIR):
+    """
+    Checks that the function reconstruct_coincidences_block divides the SiPMs
+    of all the events of a file between the two gammas as
+    reconstruct_coincidences does event by event, and that its records
+    hold the same true information and charges.
+    """
+    PATH_IN       = os.path.join(ANTEADATADIR, 'ring_test_1000ev.h5')
+    sns_response  = load_mcsns_response(PATH_IN)
+    charge_range  = (1000, 1400)
+    sel_df        = rf.find_SiPMs_over_threshold(sns_response, 2)
+    sipm_geometry = db.SiPMGeometry(DataSiPM)
+
+    particles = load_mcparticles(PATH_IN)
+    hits      = load_mchits(PATH_IN)
+    sel_df    = sel_df[sel_df.event_id.isin(particles.event_id)]
+
+    records, labels = rf.reconstruct_coincidences_block(sel_df, charge_range, sipm_geometry, particles, hits)
+    assert records.dtype == rf.coincidence_dtype
+    assert len(labels)   == len(sel_df)
+    np.testing.assert_array_equal(records['event_id'], np.unique(sel_df.event_id))
+
+    for record in records:
+        evt        = record['event_id']
+        sns        = sel_df[sel_df.event_id == evt]
+        evt_labels = labels[sel_df.event_id.values == evt]
+        evt_parts  = particles[particles.event_id == evt]
+        evt_hits   = hits     [hits     .event_id == evt]
+
+        _, _, q1, q2, true_pos1, true_pos2, true_t1, true_t2, sns1, sns2 = rf.reconstruct_coincidences(sns, charge_range, DataSiPM_idx, evt_parts, evt_hits)
+
+        assert record['coincidence'] == (len(q1) > 0)
+        if not record['coincidence']:
+            assert np.all(evt_labels == 0)
+            continue
+
+        np.testing.assert_array_equal(sns.sensor_id.values[evt_labels == 1], sns1)
+        np.testing.assert_array_equal(sns.sensor_id.values[evt_labels == 2], sns2)
+        assert np.allclose([record['true_x1'], record['true_y1'], record['true_z1']], true_pos1)
+        assert np.allclose([record['true_x2'], record['true_y2'], record['true_z2']], true_pos2)
+        assert record['true_t1']  == true_t1
+        assert record['true_t2']  == true_t2
+        assert record['n_sipms1'] == len(q1)
+        assert record['n_sipms2'] == len(q2)
+        assert np.isclose(record['charge1'], sum(q1))
+        assert np.isclose(record['charge2'], sum(q2))
+
+        evt_record, evt_labels2 = rf.reconstruct_event_coincidence(sns, charge_range, sipm_geometry, evt_parts, evt_hits)
+        assert evt_record == record
+        np.testing.assert_array_equal(evt_labels2, evt_labels)
+
+    with raises(WaveformEmptyTable):
+        rf.reconstruct_event_coincidence(sel_df[:0], charge_range, sipm_geometry, particles, hits)
+
+
 def test_only_gamma_hits_interaction():
    """
     This test uses an event where one primary gamma interacts in the cryostat
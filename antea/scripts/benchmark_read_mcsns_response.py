@@ -0,0 +1,110 @@
+import sys
+import time
+import numpy  as np
+import tables as tb
+
+from invisible_cities.core            import system_of_units as units
+from invisible_cities.evm.event_model import Waveform
+
+from antea.io.mc_io_tb import read_SiPM_bin_width_from_conf
+from antea.io.mc_io_tb import read_mcsns_response_range
+
+### Compare the bulk reader of mc_io_tb with the former row-by-row reader,
+### for both the SiPM and the TOF waveforms of a file.
+
+file_name = sys.argv[1]
+n_events  = int(sys.argv[2]) if len(sys.argv) > 2 else int(1e9)
+
+
+def read_mcsns_response_evt_by_row(mctables, event_number, last_line_of_event,
+                                   bin_width, last_row=0):
+    """
+    Former reader, which walks the extents and the waveforms one row at a time.
+    """
+    h5extents   = mctables[0]
+    h5waveforms = mctables[1]
+
+    current_event = {}
+    event_range   = (last_row, int(1e9))
+
+    iwvf = int(0)
+    if event_range[0] > 0:
+        iwvf = int(h5extents[event_range[0]-1][last_line_of_event]) + 1
+
+    for iext in range(*event_range):
+        this_row = h5extents[iext]
+        if this_row['evt_number'] == event_number:
+            iwvf_end          = int(h5extents[iext][last_line_of_event])
+            if iwvf_end < iwvf: break
+            current_sensor_id = h5waveforms[iwvf]['sensor_id']
+            time_bins         = []
+            charges           = []
+            while iwvf <= iwvf_end:
+                wvf_row   = h5waveforms[iwvf]
+                sensor_id = wvf_row['sensor_id']
+
+                if sensor_id == current_sensor_id:
+                    time_bins.append(wvf_row['time_bin'])
+                    charges.  append(wvf_row['charge'])
+                else:
+                    times = np.array(time_bins) * bin_width
+                    current_event[current_sensor_id] = Waveform(times, charges, bin_width)
+
+                    time_bins = []
+                    charges   = []
+                    time_bins.append(wvf_row['time_bin'])
+                    charges.append(wvf_row['charge'])
+
+                    current_sensor_id = sensor_id
+
+                iwvf += 1
+
+            times     = np.array(time_bins) * bin_width
+            current_event[current_sensor_id] = Waveform(times, charges, bin_width)
+            break
+
+    return current_event
+
+
+def read_by_row(h5extents, h5waveforms, last_line_name, bin_width):
+    all_events = {}
+    for iext in range(min(n_events, len(h5extents))):
+        evt_number = h5extents[iext]['evt_number']
+        all_events[evt_number] = read_mcsns_response_evt_by_row((h5extents, h5waveforms), evt_number,
+                                                                last_line_name, bin_width, iext)
+    return all_events
+
+
+def same_response(events1, events2):
+    if list(events1) != list(events2):
+        return False
+    for evt in events1:
+        if list(events1[evt]) != list(events2[evt]):
+            return False
+        for sns_id, wvf in events1[evt].items():
+            if not np.array_equal(wvf.times,   events2[evt][sns_id].times  ): return False
+            if not np.array_equal(wvf.charges, events2[evt][sns_id].charges): return False
+    return True
+
+
+with tb.open_file(file_name, mode='r') as h5f:
+    h5extents = h5f.root.MC.extents
+
+    for kind_of_waveform, h5waveforms, bin_width in [('data', h5f.root.MC.waveforms,
+                                                      read_SiPM_bin_width_from_conf(h5f)),
+                                                     ('tof',  h5f.root.MC.tof_waveforms,
+                                                      5 * units.picosecond)]:
+        last_line_name = 'last_sns_' + kind_of_waveform
+
+        t0         = time.perf_counter()
+        by_row     = read_by_row(h5extents, h5waveforms, last_line_name, bin_width)
+        t_by_row   = time.perf_counter() - t0
+
+        t0         = time.perf_counter()
+        bulk       = read_mcsns_response_range((h5extents, h5waveforms), (0, n_events),
+                                               last_line_name, bin_width)
+        t_bulk     = time.perf_counter() - t0
+
+        print('{0} waveforms, {1} events: by row {2:.3f} s, bulk {3:.3f} s, speed-up {4:.1f}, same result: {5}'
+              .format(kind_of_waveform, len(bulk), t_by_row, t_bulk,
+                      t_by_row / t_bulk, same_response(by_row, bulk)))
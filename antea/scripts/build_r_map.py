@@ -1,4 +1,4 @@
-import sys
+import argparse
 import numpy  as np
 import pandas as pd
 
@@ -6,25 +6,45 @@ import antea.database.load_db      as db
 import antea.reco.reco_functions   as rf
 import antea.reco.mctrue_functions as mcf
 
+from antea.io.mc_io import EventIndex, select_event
+from antea.utils.table_functions import RMapHistogram
 
-### read sensor positions from database
-#DataSiPM     = db.DataSiPM('petalo', 0) # ring
-DataSiPM     = db.DataSiPMsim_only('petalo', 0) # full body PET
-DataSiPM_idx = DataSiPM.set_index('SensorID')
 
-start     = int(sys.argv[1])
-numb      = int(sys.argv[2])
-threshold = int(sys.argv[3])
+### read sensor positions from database
+#DataSiPM      = db.DataSiPM('petalo', 0) # ring
+DataSiPM      = db.DataSiPMsim_only('petalo', 0) # full body PET
+sipm_geometry = db.SiPMGeometry(DataSiPM)
+locator       = rf.SiPMLocator(sipm_geometry)
+
+### One or more thresholds can be given: the tables of all of them
+### are built from a single read of the input files.
+### The ranges of the (RMS of phi, true r) histogram can be changed
+### with --rms-range and --r-range.
+### Each job writes the histograms of its files; those of all the jobs
+### are added by merge_r_maps.py, which writes the final radius tables.
+parser = argparse.ArgumentParser()
+parser.add_argument('start',      type=int)
+parser.add_argument('numb',       type=int)
+parser.add_argument('thresholds', type=int, nargs='+')
+parser.add_argument('--rms-range', type=float, nargs=2, default=(0., 0.3))
+parser.add_argument('--r-range',   type=float, nargs=2, default=(0., 500.))
+args = parser.parse_args()
+
+start      = args.start
+numb       = args.numb
+thresholds = args.thresholds
 
 folder = 'in_folder_name'
 file_full = folder + 'full_body_195cm.{0:03d}.pet.h5'
-evt_file = 'out_folder_name/full_body_195cm_r_map.{0}_{1}_{2}'.format(start, numb, threshold)
+rmap_file = 'out_folder_name/r_table_full_body_195cm_thr{2}pes.{0}_{1}.h5'.format(start, numb, '_'.join(map(str, thresholds)))
 
-true_r1, true_r2   = [], []
-var_phi1, var_phi2 = [], []
-var_z1, var_z2     = [], []
+### Binning of the (RMS of phi, true r) histogram.
+rms_range = tuple(args.rms_range)
+r_range   = tuple(args.r_range)
+rms_bins  = 200
+r_bins    = 100
 
-touched_sipms1, touched_sipms2 = [], []
+rmaps = [RMapHistogram(thr, rms_range, r_range, rms_bins, r_bins) for thr in thresholds]
 
 for ifile in range(start, start+numb):
 
@@ -42,80 +62,58 @@ for ifile in range(start, start+numb):
         continue
     print('Analyzing file {0}'.format(file_name))
 
-    sel_df = rf.find_SiPMs_over_threshold(sns_response, threshold)
+    ### The charge of the SiPMs is integrated once, for all the thresholds.
+    tot_charges = rf.integrate_SiPM_charges(sns_response)
 
     particles = pd.read_hdf(file_name, 'MC/particles')
     hits      = pd.read_hdf(file_name, 'MC/hits')
-    events    = particles.event_id.unique()
-
-    for evt in events[:]:
-
-        ### Select photoelectric events only
-        evt_parts = particles[particles.event_id == evt]
-        evt_hits  = hits[hits.event_id           == evt]
-        select, true_pos = mcf.select_photoelectric(evt_parts, evt_hits)
-        if not select: continue
-
-        waveforms = sel_df[sel_df.event_id == evt]
-        if len(waveforms) == 0: continue
-
-        _, _, pos1, pos2, q1, q2 = rf.assign_sipms_to_gammas(waveforms, true_pos, DataSiPM_idx)
-
-        if len(pos1) > 0:
-            pos_phi    = rf.from_cartesian_to_cyl(np.array(pos1))[:,1]
-            _, var_phi = rf.phi_mean_var(pos_phi, q1)
-
-            pos_z  = np.array(pos1)[:,2]
-            mean_z = np.average(pos_z, weights=q1)
-            var_z  = np.average((pos_z-mean_z)**2, weights=q1)
-
-            reco_cart = np.average(pos1, weights=q1, axis=0)
-
-            var_phi1.append(var_phi)
-            var_z1.append(var_z)
-            touched_sipms1.append(len(pos1))
 
-            r = np.sqrt(true_pos[0][0]**2 + true_pos[0][1]**2)
-            true_r1.append(r)
+    sns_idx   = EventIndex(tot_charges.event_id.values)
 
-        else:
-            var_phi1.append(1.e9)
-            var_z1.append(1.e9)
-            touched_sipms1.append(1.e9)
-            true_r1.append(1.e9)
+    ### Select photoelectric events only
+    phot_evts = mcf.select_photoelectric_events(particles, hits)
+    phot_evts = phot_evts[phot_evts.selected]
+    phot_pos1 = phot_evts[['true_x1', 'true_y1', 'true_z1']].values
+    phot_pos2 = phot_evts[['true_x2', 'true_y2', 'true_z2']].values
 
-        if len(pos2) > 0:
-            pos_phi    = rf.from_cartesian_to_cyl(np.array(pos2))[:,1]
-            _, var_phi = rf.phi_mean_var(pos_phi, q2)
+    ### The SiPMs of every gamma are collected for each threshold, and their
+    ### moments are computed at once for all the events of the file.
+    true_pos1,   true_pos2   = [[] for thr in thresholds], [[] for thr in thresholds]
+    pos_groups1, pos_groups2 = [[] for thr in thresholds], [[] for thr in thresholds]
+    q_groups1,   q_groups2   = [[] for thr in thresholds], [[] for thr in thresholds]
 
-            pos_z  = np.array(pos2)[:,2]
-            mean_z = np.average(pos_z, weights=q2)
-            var_z  = np.average((pos_z-mean_z)**2, weights=q2)
+    for evt, n_true, p1, p2 in zip(phot_evts.event_id, phot_evts.n_true, phot_pos1, phot_pos2):
 
-            reco_cart = np.average(pos2, weights=q2, axis=0)
+        true_pos = [p1, p2][:n_true]
 
-            var_phi2.append(var_phi)
-            var_z2.append(var_z)
-            touched_sipms2.append(len(pos2))
+        sns_evt = select_event(tot_charges, evt, sns_idx)
+        sns_thr = rf.select_SiPMs_over_thresholds(sns_evt, thresholds)
 
-            r = np.sqrt(true_pos[1][0]**2 + true_pos[1][1]**2)
-            true_r2.append(r)
+        for i, waveforms in enumerate(sns_thr):
+            if len(waveforms) == 0: continue
 
-        else:
-            var_phi2.append(1.e9)
-            var_z2.append(1.e9)
-            touched_sipms2.append(1.e9)
-            true_r2.append(1.e9)
+            _, _, pos1, pos2, q1, q2 = rf.assign_sipms_to_gammas(waveforms, true_pos, sipm_geometry, locator)
 
-a_true_r1  = np.array(true_r1)
-a_true_r2  = np.array(true_r2)
-a_var_phi1 = np.array(var_phi1)
-a_var_phi2 = np.array(var_phi2)
-a_var_z1   = np.array(var_z1)
-a_var_z2   = np.array(var_z2)
+            pos_groups1[i].append(pos1)
+            pos_groups2[i].append(pos2)
+            q_groups1  [i].append(q1)
+            q_groups2  [i].append(q2)
 
-a_touched_sipms1 = np.array(touched_sipms1)
-a_touched_sipms2 = np.array(touched_sipms2)
+            true_pos1[i].append(p1)
+            true_pos2[i].append(p2)
 
+    for i, rmap in enumerate(rmaps):
+        for true_pos, pos_groups, q_groups in [(true_pos1[i], pos_groups1[i], q_groups1[i]),
+                                               (true_pos2[i], pos_groups2[i], q_groups2[i])]:
+            if len(true_pos) == 0: continue
+            moments  = rf.charge_weighted_moments(*rf.concatenate_sensor_groups(pos_groups, q_groups))
+            true_pos = np.array(true_pos)
+            true_r   = np.sqrt(true_pos[:, 0]**2 + true_pos[:, 1]**2)
+            ## Gammas without SiPMs have NaN variance and are not filled.
+            rmap.fill(np.sqrt(moments['var_phi']), true_r)
 
-np.savez(evt_file, a_true_r1=a_true_r1, a_true_r2=a_true_r2, a_var_phi1=a_var_phi1, a_var_phi2=a_var_phi2, a_var_z1=a_var_z1, a_var_z2=a_var_z2, a_touched_sipms1=a_touched_sipms1, a_touched_sipms2=a_touched_sipms2)
+for rmap in rmaps:
+    if rmap.underflow or rmap.overflow:
+        print('Threshold {} pes: {} gammas below and {} above the RMS range {} not used'
+              .format(rmap.threshold, rmap.underflow, rmap.overflow, rms_range))
+    rmap.write(rmap_file)
@@ -0,0 +1,22 @@
+import argparse
+
+from antea.utils.table_functions import merge_rmap_histograms
+
+
+### Adds the r-map histograms written by the build_r_map.py jobs and writes,
+### for each threshold, the radius table read by load_rpos in the
+### reconstruction scripts (table_folder_name/r_table_full_body_195cm_thr{}pes.h5).
+parser = argparse.ArgumentParser()
+parser.add_argument('thresholds', type=int, nargs='+')
+parser.add_argument('--inputs',   nargs='+', required=True)
+parser.add_argument('--rms-bins', type=int, default=200)
+args = parser.parse_args()
+
+rmap_file = 'out_folder_name/r_table_full_body_195cm_thr{}pes.h5'
+
+for thr in args.thresholds:
+    rmap = merge_rmap_histograms(args.inputs, thr, args.rms_bins)
+    if rmap.underflow or rmap.overflow:
+        print('Threshold {} pes: {} gammas below and {} above the RMS range {} not used'
+              .format(thr, rmap.underflow, rmap.overflow, tuple(rmap.rms_edges[[0, -1]].tolist())))
+    rmap.write(rmap_file.format(thr))
@@ -1,7 +1,6 @@
 import sys
 import numpy  as np
 import pandas as pd
-import tables as tb
 
 from invisible_cities.core         import system_of_units as units
 from invisible_cities.io.mcinfo_io import units_dict
@@ -11,13 +10,15 @@ import antea.reco.reco_functions   as rf
 import antea.reco.mctrue_functions as mcf
 
 from antea.utils.table_functions import load_rpos
-from antea.io.mc_io import read_sensor_bin_width_from_conf
+from antea.io.mc_io import load_mc_configuration
+from antea.io.mc_io import EventIndex, select_event
 
 
 ### read sensor positions from database
-#DataSiPM     = db.DataSiPM('petalo', 0) # ring
-DataSiPM     = db.DataSiPMsim_only('petalo', 0) # full body PET
-DataSiPM_idx = DataSiPM.set_index('SensorID')
+#DataSiPM      = db.DataSiPM('petalo', 0) # ring
+DataSiPM      = db.DataSiPMsim_only('petalo', 0) # full body PET
+sipm_geometry = db.SiPMGeometry(DataSiPM)
+locator       = rf.SiPMLocator(sipm_geometry)
 
 start   = int(sys.argv[1])
 numb    = int(sys.argv[2])
@@ -25,6 +26,7 @@ thr_r   = float(sys.argv[3])
 thr_phi = float(sys.argv[4])
 thr_z   = float(sys.argv[5])
 thr_e   = float(sys.argv[6])
+thresholds = [thr_r, thr_phi, thr_z, thr_e]
 
 folder = 'in_folder_name'
 file_full = folder + '/full_body_195cm_center.{0:03d}.pet.h5'
@@ -36,18 +38,13 @@ Rpos = load_rpos(rpos_file,
                  group = "Radius",
                  node  = "f{}pes200bins".format(int(thr_r)))
 
-c1 = c2 = c3 = c4 = 0
+variables = ['r', 'phi', 'z', 'e']
+not_passing = dict.fromkeys(variables, 0)
 bad = 0
 
-true_r1, true_phi1, true_z1 = [], [], []
-reco_r1, reco_phi1, reco_z1 = [], [], []
-true_r2, true_phi2, true_z2 = [], [], []
-reco_r2, reco_phi2, reco_z2 = [], [], []
-
-photo_response1, photo_response2 = [], []
-first_sipm1, first_sipm2         = [], []
-first_time1, first_time2         = [], []
-touched_sipms1,  touched_sipms2  = [], []
+outputs = ['true_r', 'true_phi', 'true_z', 'reco_r', 'reco_phi', 'reco_z',
+           'sns_response', 'touched_sipms', 'first_sipm', 'first_time']
+results   = [{key: [] for key in outputs} for gamma in [1, 2]]
 event_ids = []
 
 for ifile in range(start, start+numb):
@@ -66,177 +63,95 @@ for ifile in range(start, start+numb):
         continue
     print('Analyzing file {0}'.format(file_name))
 
-    h5f = tb.open_file(file_name, mode='r')
-    tof_bin_size = read_sensor_bin_width_from_conf(h5f)
-    h5f.close()
+    tof_bin_size = load_mc_configuration(file_name).sensor_bin_width()
 
     particles = pd.read_hdf(file_name, 'MC/particles')
     hits      = pd.read_hdf(file_name, 'MC/hits')
     tof_response = pd.read_hdf(file_name, 'MC/tof_waveforms')
 
+    ### The charge of the SiPMs is integrated once, for all the thresholds.
+    tot_charges = rf.integrate_SiPM_charges(sns_response)
+
+    sns_idx   = EventIndex(tot_charges .event_id.values)
+    tof_idx   = EventIndex(tof_response.event_id.values)
+
     events = particles.event_id.unique()
     print(len(events))
 
-    for evt in events[:]:
-
-        ### Select photoelectric events only
-        evt_parts = particles[particles.event_id == evt]
-        evt_hits  = hits[hits.event_id           == evt]
-        select, true_pos = mcf.select_photoelectric(evt_parts, evt_hits)
-        if not select: continue
-
-        if (len(true_pos) == 1) & (evt_hits.energy.sum() > 0.511):
-            continue
-
-        sns_evt = sns_response[sns_response.event_id == evt]
-        evt_tof = tof_response[tof_response.event_id == evt]
-
-        sns_resp_r   = rf.find_SiPMs_over_threshold(sns_evt, threshold=thr_r)
-        sns_resp_phi = rf.find_SiPMs_over_threshold(sns_evt, threshold=thr_phi)
-        sns_resp_z   = rf.find_SiPMs_over_threshold(sns_evt, threshold=thr_z)
-        sns_resp_e   = rf.find_SiPMs_over_threshold(sns_evt, threshold=thr_e)
-
-        _, _, pos1, pos2, q1, q2 = rf.assign_sipms_to_gammas(sns_resp_r, true_pos, DataSiPM_idx)
-        if len(q1) == len(q2) == 0:
-            c1 += 1
-        r1 = r2 = None
-        if len(pos1) > 0:
-            pos1_phi = rf.from_cartesian_to_cyl(np.array(pos1))[:,1]
-            diff_sign = min(pos1_phi ) < 0 < max(pos1_phi)
-            if diff_sign & (np.abs(np.min(pos1_phi))>np.pi/2.):
-                pos1_phi[pos1_phi<0] = np.pi + np.pi + pos1_phi[pos1_phi<0]
-            mean_phi = np.average(pos1_phi, weights=q1)
-            var_phi1 = np.average((pos1_phi-mean_phi)**2, weights=q1)
-            r1  = Rpos(np.sqrt(var_phi1)).value
-        if len(pos2) > 0:
-            pos2_phi = rf.from_cartesian_to_cyl(np.array(pos2))[:,1]
-            diff_sign = min(pos2_phi ) < 0 < max(pos2_phi)
-            if diff_sign & (np.abs(np.min(pos2_phi))>np.pi/2.):
-                pos2_phi[pos2_phi<0] = np.pi + np.pi + pos2_phi[pos2_phi<0]
-            mean_phi = np.average(pos2_phi, weights=q2)
-            var_phi2 = np.average((pos2_phi-mean_phi)**2, weights=q2)
-            r2  = Rpos(np.sqrt(var_phi2)).value
-
-
-        _, _, pos1, pos2, q1, q2 = rf.assign_sipms_to_gammas(sns_resp_phi, true_pos, DataSiPM_idx)
-        if len(q1) == len(q2) == 0:
-            c2 += 1
-
-        phi1 = phi2 = None
-        if len(pos1) > 0:
-            reco_cart_pos = np.average(pos1, weights=q1, axis=0)
-            phi1 = np.arctan2(reco_cart_pos[1], reco_cart_pos[0])
-        if len(pos2) > 0:
-            reco_cart_pos = np.average(pos2, weights=q2, axis=0)
-            phi2 = np.arctan2(reco_cart_pos[1], reco_cart_pos[0])
-
-
-        _, _, pos1, pos2, q1, q2 = rf.assign_sipms_to_gammas(sns_resp_z, true_pos, DataSiPM_idx)
-        if len(q1) == len(q2) == 0:
-            c3 += 1
-
-        z1 = z2 = None
-        if len(pos1) > 0:
-            reco_cart_pos = np.average(pos1, weights=q1, axis=0)
-            z1 = reco_cart_pos[2]
-        if len(pos2) > 0:
-            reco_cart_pos = np.average(pos2, weights=q2, axis=0)
-            z2 = reco_cart_pos[2]
-
-        sns1, sns2, _, _, q1, q2 = rf.assign_sipms_to_gammas(sns_resp_e, true_pos, DataSiPM_idx)
-
-        if len(q1) == len(q2) == 0:
-            c4 += 1
+    ### Select photoelectric events only
+    phot_evts = mcf.select_photoelectric_events(particles, hits)
+    phot_evts = phot_evts[phot_evts.selected]
+    phot_pos1 = phot_evts[['true_x1', 'true_y1', 'true_z1']].values
+    phot_pos2 = phot_evts[['true_x2', 'true_y2', 'true_z2']].values
+
+    ### The SiPMs of every gamma are assigned event by event, for each
+    ### threshold, and their moments are computed at once for the whole file.
+    pos_groups = {var: ([], []) for var in variables}
+    q_groups   = {var: ([], []) for var in variables}
+    sns_groups = ([], [])
+
+    for evt, n_true, p1, p2 in zip(phot_evts.event_id, phot_evts.n_true, phot_pos1, phot_pos2):
+
+        true_pos = [p1, p2][:n_true]
+
+        sns_evt = select_event(tot_charges, evt, sns_idx)
+        sns_thr = rf.select_SiPMs_over_thresholds(sns_evt, thresholds)
+
+        for var, sns_resp in zip(variables, sns_thr):
+            sns1, sns2, pos1, pos2, q1, q2 = rf.assign_sipms_to_gammas(sns_resp, true_pos, sipm_geometry, locator)
+            if len(q1) == len(q2) == 0:
+                not_passing[var] += 1
+
+            pos_groups[var][0].append(pos1)
+            pos_groups[var][1].append(pos2)
+            q_groups  [var][0].append(q1)
+            q_groups  [var][1].append(q2)
+
+        ### The SiPMs over the energy threshold give the time of the first photoelectron.
+        sns_groups[0].append(sns1)
+        sns_groups[1].append(sns2)
+
+    n_evts = len(phot_evts)
+    valid  = []
+    for i, true_pos in enumerate([phot_pos1, phot_pos2]):
+        moments = {var: rf.charge_weighted_moments(*rf.concatenate_sensor_groups(pos_groups[var][i],
+                                                                                q_groups  [var][i]))
+                   for var in variables}
+        good = np.all([moments[var]['n_sipms'] > 0 for var in variables], axis=0)
+        valid.append(good)
+
+        reco_r = np.where(good, Rpos(np.sqrt(moments['r']['var_phi'])).value, 1.e9)
 
         ## Calculate time first photoelectron
-        sns1 = -np.array(sns1)
-        sns2 = -np.array(sns2)
-        if r1 and phi1 and z1 and len(q1):
-            min_id1, min_t1 = rf.find_first_time_of_sensors(evt_tof, sns1)
-        if r2 and phi2 and z2 and len(q2):
-            min_id2, min_t2 = rf.find_first_time_of_sensors(evt_tof, sns2)
-
-        both_bad = 0
-
-        if r1 and phi1 and z1 and q1:
-            reco_r1.append(r1)
-            reco_phi1.append(phi1)
-            reco_z1.append(z1)
-            true_r1.append(np.sqrt(true_pos[0][0]**2 + true_pos[0][1]**2))
-            true_phi1.append(np.arctan2(true_pos[0][1], true_pos[0][0]))
-            true_z1.append(true_pos[0][2])
-            photo_response1.append(sum(q1))
-            touched_sipms1.append(len(q1))
-            first_sipm1.append(min_id1)
-            first_time1.append(min_t1*tof_bin_size/units.ps)
-            event_ids.append(evt)
-        else:
-            reco_r1.append(1.e9)
-            reco_phi1.append(1.e9)
-            reco_z1.append(1.e9)
-            true_r1.append(1.e9)
-            true_phi1.append(1.e9)
-            true_z1.append(1.e9)
-            photo_response1.append(1.e9)
-            touched_sipms1.append(1.e9)
-            first_sipm1.append(1.e9)
-            first_time1.append(1.e9)
-            event_ids.append(evt)
-            both_bad += 1
-
-
-        if r2 and phi2 and z2 and q2:
-            reco_r2.append(r2)
-            reco_phi2.append(phi2)
-            reco_z2.append(z2)
-            true_r2.append(np.sqrt(true_pos[1][0]**2 + true_pos[1][1]**2))
-            true_phi2.append(np.arctan2(true_pos[1][1], true_pos[1][0]))
-            true_z2.append(true_pos[1][2])
-            photo_response2.append(sum(q2))
-            touched_sipms2.append(len(q2))
-            first_sipm2.append(min_id2)
-            first_time2.append(min_t2*tof_bin_size/units.ps)
-        else:
-            reco_r2.append(1.e9)
-            reco_phi2.append(1.e9)
-            reco_z2.append(1.e9)
-            true_r2.append(1.e9)
-            true_phi2.append(1.e9)
-            true_z2.append(1.e9)
-            photo_response2.append(1.e9)
-            touched_sipms2.append(1.e9)
-            first_sipm2.append(1.e9)
-            first_time2.append(1.e9)
-            both_bad += 1
-
-        if both_bad == 2:
-            bad += 1
-
-a_true_r1   = np.array(true_r1)
-a_true_phi1 = np.array(true_phi1)
-a_true_z1   = np.array(true_z1)
-a_reco_r1   = np.array(reco_r1)
-a_reco_phi1 = np.array(reco_phi1)
-a_reco_z1   = np.array(reco_z1)
-a_sns_response1 = np.array(photo_response1)
-a_touched_sipms1  = np.array(touched_sipms1)
-a_first_time1 = np.array(first_time1)
-a_first_sipm1 = np.array(first_sipm1)
-
-a_true_r2   = np.array(true_r2)
-a_true_phi2 = np.array(true_phi2)
-a_true_z2   = np.array(true_z2)
-a_reco_r2   = np.array(reco_r2)
-a_reco_phi2 = np.array(reco_phi2)
-a_reco_z2   = np.array(reco_z2)
-a_sns_response2 = np.array(photo_response2)
-a_touched_sipms2  = np.array(touched_sipms2)
-a_first_time2 = np.array(first_time2)
-a_first_sipm2 = np.array(first_sipm2)
-
-a_event_ids = np.array(event_ids)
-
-np.savez(evt_file, a_true_r1=a_true_r1, a_true_phi1=a_true_phi1, a_true_z1=a_true_z1, a_true_r2=a_true_r2, a_true_phi2=a_true_phi2, a_true_z2=a_true_z2, a_reco_r1=a_reco_r1, a_reco_phi1=a_reco_phi1, a_reco_z1=a_reco_z1, a_reco_r2=a_reco_r2, a_reco_phi2=a_reco_phi2, a_reco_z2=a_reco_z2,  a_touched_sipms1=a_touched_sipms1, a_touched_sipms2=a_touched_sipms2, a_sns_response1=a_sns_response1, a_sns_response2=a_sns_response2, a_first_time1=a_first_time1, a_first_sipm1=a_first_sipm1, a_first_time2=a_first_time2, a_first_sipm2=a_first_sipm2, a_event_ids=a_event_ids)
-
-print('Not passing threshold r = {}, phi = {}, z = {}, E = {}'.format(c1, c2, c3, c4))
+        first_sipm = np.full(n_evts, 1.e9)
+        first_time = np.full(n_evts, 1.e9)
+        for j in np.flatnonzero(good):
+            evt_tof = select_event(tof_response, phot_evts.event_id.values[j], tof_idx)
+            min_id, min_t = rf.find_first_time_of_sensors(evt_tof, -np.array(sns_groups[i][j]))
+            first_sipm[j] = min_id
+            first_time[j] = min_t*tof_bin_size/units.ps
+
+        res = results[i]
+        res['reco_r']       .append(reco_r)
+        res['reco_phi']     .append(np.where(good, np.arctan2(moments['phi']['y'], moments['phi']['x']), 1.e9))
+        res['reco_z']       .append(np.where(good, moments['z']['z'], 1.e9))
+        res['true_r']       .append(np.where(good, np.sqrt(true_pos[:, 0]**2 + true_pos[:, 1]**2), 1.e9))
+        res['true_phi']     .append(np.where(good, np.arctan2(true_pos[:, 1], true_pos[:, 0]), 1.e9))
+        res['true_z']       .append(np.where(good, true_pos[:, 2], 1.e9))
+        res['sns_response'] .append(np.where(good, moments['e']['charge'], 1.e9))
+        res['touched_sipms'].append(np.where(good, moments['e']['n_sipms'], 1.e9))
+        res['first_sipm']   .append(first_sipm)
+        res['first_time']   .append(first_time)
+
+    event_ids.append(phot_evts.event_id.values)
+    bad += np.count_nonzero(~valid[0] & ~valid[1])
+
+output = {'a_event_ids': np.concatenate(event_ids) if event_ids else np.array([])}
+for gamma, res in zip([1, 2], results):
+    for key, values in res.items():
+        output['a_{}{}'.format(key, gamma)] = np.concatenate(values) if values else np.array([])
+
+np.savez(evt_file, **output)
+
+print('Not passing threshold r = {}, phi = {}, z = {}, E = {}'.format(*[not_passing[var] for var in variables]))
 print('Both bad = {}'.format(bad))
@@ -1,8 +1,232 @@
-from invisible_cities.reco.corrections import Correction
+import os
+import numpy  as np
+import tables as tb
+
+from collections import namedtuple
+from typing      import Sequence, Tuple
+
 from invisible_cities.io.dst_io   import load_dst
 
 
+RadiusValue = namedtuple('RadiusValue', 'value uncertainty')
+
+
+class RadiusMap:
+    """
+    Radius of the interaction as a function of the RMS of the phi
+    distribution of the SiPMs, as stored in the tables of build_r_map.
+    Each RMS value is assigned the radius of the nearest RMS bin of the
+    table (the lower one in case of a tie), which is the behaviour of
+    the invisible_cities Correction used before. Whole arrays of RMS
+    values are evaluated at once; NaN values give NaN.
+    """
+
+    def __init__(self, rms_phi: Sequence[float],
+                       rpos: Sequence[float],
+                       uncertainty: Sequence[float]):
+        order            = np.argsort(rms_phi, kind='stable')
+        self.rms_phi     = np.asarray(rms_phi,     dtype=float)[order]
+        self.rpos        = np.asarray(rpos,        dtype=float)[order]
+        self.uncertainty = np.asarray(uncertainty, dtype=float)[order]
+        self.edges       = (self.rms_phi[1:] + self.rms_phi[:-1]) / 2
+        for array in [self.rms_phi, self.rpos, self.uncertainty, self.edges]:
+            array.flags.writeable = False
+
+    def bins(self, rms_phi: Sequence[float]) -> Sequence[int]:
+        """
+        Returns the index of the nearest RMS bin of each value.
+        """
+        return np.searchsorted(self.edges, rms_phi, side='left')
+
+    def __call__(self, rms_phi: Sequence[float]) -> RadiusValue:
+        rms_phi = np.asarray(rms_phi, dtype=float)
+        bins    = self.bins(rms_phi)
+        nan     = np.isnan(rms_phi)
+        value   = np.where(nan, np.nan, self.rpos       [bins])
+        uncert  = np.where(nan, np.nan, self.uncertainty[bins])
+        return RadiusValue(value, uncert)
+
+
+_radius_maps = {}
+max_cached_radius_maps = 128
+
+
 def load_rpos(filename, group = "Radius",
                         node  = "f100bins"):
-    dst = load_dst(filename, group, node)
-    return Correction((dst.RmsPhi.values,), dst.Rpos.values, dst.Uncertainty.values)
+    """
+    Reads a radius table and returns it as a RadiusMap.
+    The map is cached, keyed on the path and the modification time of
+    the file, so that it is read again if the file is rewritten.
+    """
+    cache_key = (os.path.abspath(filename), os.path.getmtime(filename), group, node)
+    if cache_key not in _radius_maps:
+        dst = load_dst(filename, group, node)
+
+        if len(_radius_maps) >= max_cached_radius_maps:
+            _radius_maps.pop(next(iter(_radius_maps)))
+        _radius_maps[cache_key] = RadiusMap(dst.RmsPhi.values, dst.Rpos.values, dst.Uncertainty.values)
+
+    return _radius_maps[cache_key]
+
+
+rmap_table_dtype = np.dtype([('RmsPhi', 'f8'), ('Rpos', 'f8'), ('Uncertainty', 'f8')])
+
+
+def _bin_index(edges: Sequence[float], values: Sequence[float]) -> Sequence[int]:
+    """
+    Index of the bin of each value, -1 if it is outside the edges or NaN.
+    The last bin includes its upper edge, as in np.histogram.
+    """
+    values = np.atleast_1d(np.asarray(values, dtype=float))
+    bins   = np.searchsorted(edges, values, side='right') - 1
+    bins[values == edges[-1]] = len(edges) - 2
+    return np.where((bins >= 0) & (bins < len(edges) - 1), bins, -1)
+
+
+class RMapHistogram:
+    """
+    Accumulates the (RMS of phi, true radius) pairs of the events into
+    a 2D histogram, to build the radius table of a given charge threshold
+    in a single pass over the data, with constant memory.
+    For each RMS bin the sum of the radii and of their squares is also
+    kept, so that the mean radius and its spread do not depend on the
+    radius binning. Histograms with the same binning can be added,
+    for instance those filled by different processes or files.
+    The events with an RMS below or above the RMS range are not binned,
+    but they are counted in underflow and overflow.
+    """
+
+    def __init__(self, threshold: float,
+                       rms_range: Tuple[float, float],
+                       r_range: Tuple[float, float],
+                       rms_bins: int = 200,
+                       r_bins: int = 100):
+        self.threshold = threshold
+        self.rms_edges = np.linspace(*rms_range, rms_bins + 1)
+        self.r_edges   = np.linspace(*r_range,   r_bins   + 1)
+        self.counts    = np.zeros((rms_bins, r_bins))
+        self.entries   = np.zeros(rms_bins)
+        self.sum_r     = np.zeros(rms_bins)
+        self.sum_r2    = np.zeros(rms_bins)
+        self.underflow = 0
+        self.overflow  = 0
+
+    @property
+    def node(self) -> str:
+        return 'f{}pes{}bins'.format(int(self.threshold), len(self.entries))
+
+    def fill(self, rms_phi: Sequence[float], true_r: Sequence[float]):
+        """
+        Adds the events with the given RMS of phi and true radius.
+        Events with NaN values are ignored, and those outside the RMS range
+        are only counted in underflow or overflow.
+        Those outside the radius range are not counted in the 2D
+        histogram, but they enter the mean radius of their RMS bin.
+        """
+        rms_phi = np.atleast_1d(np.asarray(rms_phi, dtype=float))
+        true_r  = np.atleast_1d(np.asarray(true_r,  dtype=float))
+        rms_bin = _bin_index(self.rms_edges, rms_phi)
+        r_bin   = _bin_index(self.r_edges,   true_r)
+        valid   = ~np.isnan(true_r)
+        self.underflow += np.count_nonzero(valid & (rms_phi < self.rms_edges[ 0]))
+        self.overflow  += np.count_nonzero(valid & (rms_phi > self.rms_edges[-1]))
+        sel     = (rms_bin >= 0) & valid
+        rms_bin, r_bin, true_r = rms_bin[sel], r_bin[sel], true_r[sel]
+
+        rms_bins, r_bins = self.counts.shape
+        self.entries += np.bincount(rms_bin, minlength=rms_bins)
+        self.sum_r   += np.bincount(rms_bin, weights=true_r,    minlength=rms_bins)
+        self.sum_r2  += np.bincount(rms_bin, weights=true_r**2, minlength=rms_bins)
+
+        in_r = r_bin >= 0
+        self.counts  += np.bincount(rms_bin[in_r] * r_bins + r_bin[in_r],
+                                    minlength=rms_bins * r_bins).reshape(rms_bins, r_bins)
+
+    def __iadd__(self, other: 'RMapHistogram') -> 'RMapHistogram':
+        if not (np.array_equal(self.rms_edges, other.rms_edges) and
+                np.array_equal(self.r_edges,   other.r_edges)):
+            raise ValueError('Cannot add r-map histograms with different binning')
+        self.counts  += other.counts
+        self.entries += other.entries
+        self.sum_r   += other.sum_r
+        self.sum_r2  += other.sum_r2
+        self.underflow += other.underflow
+        self.overflow  += other.overflow
+        return self
+
+    def table(self) -> np.ndarray:
+        """
+        Returns the radius table, with the centre of each filled RMS bin
+        (RmsPhi), the mean true radius of its events (Rpos) and their
+        standard deviation (Uncertainty).
+        """
+        filled  = self.entries > 0
+        entries = self.entries[filled]
+        mean_r  = self.sum_r [filled] / entries
+        var_r   = self.sum_r2[filled] / entries - mean_r**2
+
+        table = np.zeros(len(entries), dtype=rmap_table_dtype)
+        table['RmsPhi']      = ((self.rms_edges[1:] + self.rms_edges[:-1]) / 2)[filled]
+        table['Rpos']        = mean_r
+        table['Uncertainty'] = np.sqrt(np.clip(var_r, 0, None))
+        return table
+
+    def write(self, filename: str, group: str = "Radius"):
+        """
+        Writes the radius table in node self.node of the given group,
+        where load_rpos reads it, and the histogram itself in a group
+        named group + 'Histogram', where read_rmap_histogram reads it.
+        A table and histogram already in the file with the same node
+        name are replaced.
+        """
+        with tb.open_file(filename, 'a') as h5out:
+            for name in [group, group + 'Histogram']:
+                if name not in h5out.root:
+                    h5out.create_group(h5out.root, name)
+                elif self.node in h5out.get_node('/' + name):
+                    h5out.remove_node('/' + name, self.node, recursive=True)
+            h5out.create_table('/' + group, self.node, obj=self.table())
+
+            hist_group = h5out.create_group('/' + group + 'Histogram', self.node)
+            for name in ['rms_edges', 'r_edges', 'counts', 'entries', 'sum_r', 'sum_r2']:
+                h5out.create_array(hist_group, name, obj=getattr(self, name))
+            hist_group._v_attrs.threshold = self.threshold
+            hist_group._v_attrs.underflow = self.underflow
+            hist_group._v_attrs.overflow  = self.overflow
+
+
+def read_rmap_histogram(filename: str, threshold: float, rms_bins: int = 200,
+                        group: str = "Radius") -> RMapHistogram:
+    """
+    Reads an r-map histogram written by RMapHistogram.write.
+    """
+    node = 'f{}pes{}bins'.format(int(threshold), rms_bins)
+    with tb.open_file(filename) as h5in:
+        hist_group = h5in.get_node('/' + group + 'Histogram', node)
+        arrays     = {name: getattr(hist_group, name).read()
+                      for name in ['rms_edges', 'r_edges', 'counts', 'entries', 'sum_r', 'sum_r2']}
+        underflow  = int(hist_group._v_attrs.underflow)
+        overflow   = int(hist_group._v_attrs.overflow)
+
+    hist = RMapHistogram(threshold,
+                         arrays['rms_edges'][[0, -1]], arrays['r_edges'][[0, -1]],
+                         len(arrays['rms_edges']) - 1, len(arrays['r_edges']) - 1)
+    for name, array in arrays.items():
+        setattr(hist, name, array)
+    hist.underflow = underflow
+    hist.overflow  = overflow
+    return hist
+
+
+def merge_rmap_histograms(filenames: Sequence[str], threshold: float, rms_bins: int = 200,
+                          group: str = "Radius") -> RMapHistogram:
+    """
+    Reads the r-map histograms of a given threshold written in several
+    files (for instance by different jobs) and returns their sum.
+    """
+    if len(filenames) == 0:
+        raise ValueError('No r-map files to merge')
+    hist = read_rmap_histogram(filenames[0], threshold, rms_bins, group)
+    for filename in filenames[1:]:
+        hist += read_rmap_histogram(filename, threshold, rms_bins, group)
+    return hist
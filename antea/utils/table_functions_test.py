@@ -0,0 +1,176 @@
+import os
+import numpy                 as np
+import tables                as tb
+import hypothesis.strategies as st
+
+from hypothesis import given
+from pytest     import raises
+
+from . table_functions import RadiusMap
+from . table_functions import load_rpos
+from . table_functions import RMapHistogram
+from . table_functions import read_rmap_histogram
+from . table_functions import merge_rmap_histograms
+
+
+rms_values = st.lists(st.floats(min_value=-1, max_value=1), min_size=1, max_size=100)
+
+@given(rms_values)
+def test_RadiusMap_nearest_bin(rms_phi):
+    """
+    Checks that RadiusMap gives the radius and the uncertainty
+    of the nearest RMS bin of the table for a whole array of values.
+    """
+    table_rms = np.linspace(0, 0.5, 11)
+    rpos      = np.linspace(400, 0, 11)
+    uncert    = np.linspace(1, 2, 11)
+    rmap      = RadiusMap(table_rms[::-1], rpos[::-1], uncert[::-1])
+
+    rms_phi = np.array(rms_phi)
+    closest = np.argmin(np.abs(rms_phi[:, np.newaxis] - table_rms), axis=1)
+    result  = rmap(rms_phi)
+
+    np.testing.assert_allclose(result.value,       rpos  [closest])
+    np.testing.assert_allclose(result.uncertainty, uncert[closest])
+
+
+def test_RadiusMap_nan():
+    rmap   = RadiusMap([0., 0.1], [300., 200.], [1., 1.])
+    result = rmap([np.nan, 0.09])
+
+    assert np.isnan(result.value[0]) and np.isnan(result.uncertainty[0])
+    assert result.value[1] == 200.
+
+
+def test_load_rpos(output_tmpdir):
+    """
+    Checks that load_rpos reads a radius table only once,
+    until the file changes.
+    """
+    filename = os.path.join(output_tmpdir, 'test_rpos.h5')
+    table    = np.array([(0.01, 380., 1.), (0.02, 370., 2.), (0.03, 360., 3.)],
+                         dtype=[('RmsPhi', 'f8'), ('Rpos', 'f8'), ('Uncertainty', 'f8')])
+    with tb.open_file(filename, 'w') as h5out:
+        group = h5out.create_group(h5out.root, 'Radius')
+        h5out.create_table(group, 'f4pes3bins', obj=table)
+
+    rmap = load_rpos(filename, group='Radius', node='f4pes3bins')
+    np.testing.assert_array_equal(rmap([0.012, 0.5]).value, [380., 360.])
+    assert load_rpos(filename, group='Radius', node='f4pes3bins') is rmap
+
+    with tb.open_file(filename, 'a') as h5out:
+        h5out.root.Radius.f4pes3bins.modify_column(column=[390., 370., 360.], colname='Rpos')
+    os.utime(filename, (0, 0))
+    new_rmap = load_rpos(filename, group='Radius', node='f4pes3bins')
+    assert new_rmap is not rmap
+    np.testing.assert_array_equal(new_rmap([0.012]).value, [390.])
+
+
+rms_r_pairs = st.lists(st.tuples(st.floats(min_value=-0.1, max_value=0.4),
+                                 st.floats(min_value=0,    max_value=600)),
+                       min_size=1, max_size=200)
+
+@given(rms_r_pairs, st.integers(min_value=0, max_value=200))
+def test_RMapHistogram_fill_and_add(pairs, split):
+    """
+    Checks that RMapHistogram bins the pairs as np.histogram2d does,
+    that the mean radius of each RMS bin is right and that filling two
+    histograms and adding them gives the same result as filling one.
+    """
+    rms_phi, true_r = np.array(pairs).T
+
+    hist = RMapHistogram(4, (0, 0.3), (0, 500), rms_bins=30, r_bins=50)
+    hist.fill(rms_phi, true_r)
+
+    expected = np.histogram2d(rms_phi, true_r, bins=(hist.rms_edges, hist.r_edges))[0]
+    np.testing.assert_array_equal(hist.counts, expected)
+
+    entries = np.histogram(rms_phi, bins=hist.rms_edges)[0]
+    sum_r   = np.histogram(rms_phi, bins=hist.rms_edges, weights=true_r)[0]
+    filled  = entries > 0
+    table   = hist.table()
+    np.testing.assert_array_equal(hist.entries, entries)
+    np.testing.assert_allclose   (table['Rpos'], sum_r[filled] / entries[filled], atol=1.e-6)
+
+    hist1 = RMapHistogram(4, (0, 0.3), (0, 500), rms_bins=30, r_bins=50)
+    hist2 = RMapHistogram(4, (0, 0.3), (0, 500), rms_bins=30, r_bins=50)
+    hist1.fill(rms_phi[:split], true_r[:split])
+    hist2.fill(rms_phi[split:], true_r[split:])
+    hist1 += hist2
+    np.testing.assert_array_equal(hist1.counts,  hist.counts)
+    np.testing.assert_array_equal(hist1.entries, hist.entries)
+    np.testing.assert_allclose   (hist1.sum_r,   hist.sum_r)
+    assert hist1.underflow == hist.underflow == np.count_nonzero(rms_phi < 0)
+    assert hist1.overflow  == hist.overflow  == np.count_nonzero(rms_phi > 0.3)
+
+
+def test_RMapHistogram_fill_scalar():
+    hist = RMapHistogram(4, (0, 0.3), (0, 500), rms_bins=30, r_bins=50)
+    hist.fill(0.105, 305.)
+    hist.fill(0.5,   305.)
+    assert hist.entries.sum() == 1
+    assert hist.counts[10, 30] == 1
+    assert hist.overflow == 1
+
+
+def test_RMapHistogram_add_different_binning():
+    hist1 = RMapHistogram(4, (0, 0.3), (0, 500), rms_bins=30)
+    hist2 = RMapHistogram(4, (0, 0.3), (0, 500), rms_bins=20)
+    with raises(ValueError):
+        hist1 += hist2
+
+
+def test_RMapHistogram_write(output_tmpdir):
+    """
+    Checks that the table written by RMapHistogram is read by load_rpos,
+    and the histogram by read_rmap_histogram.
+    """
+    filename = os.path.join(output_tmpdir, 'test_rmap.h5')
+    hist     = RMapHistogram(6, (0, 0.3), (0, 500), rms_bins=30, r_bins=50)
+    hist.fill([0.011, 0.013, 0.1, 0.25], [380., 370., 200., 50.])
+    hist.write(filename)
+
+    rmap = load_rpos(filename, group='Radius', node='f6pes30bins')
+    np.testing.assert_allclose(rmap([0.012, 0.11, 0.3]).value, [375., 200., 50.])
+    np.testing.assert_allclose(rmap([0.012]).uncertainty, [5.])
+
+    read_hist = read_rmap_histogram(filename, 6, rms_bins=30)
+    np.testing.assert_array_equal(read_hist.counts, hist.counts)
+    np.testing.assert_array_equal(read_hist.sum_r2, hist.sum_r2)
+    assert read_hist.overflow == 0
+
+    ## Writing the histogram again replaces the previous one.
+    hist.fill([0.2, 0.5], [100., 100.])
+    hist.write(filename)
+    read_hist = read_rmap_histogram(filename, 6, rms_bins=30)
+    np.testing.assert_array_equal(read_hist.entries, hist.entries)
+    assert read_hist.overflow == 1
+
+
+def test_merge_rmap_histograms(output_tmpdir):
+    """
+    Checks that the histograms written in several files add up
+    to the histogram filled with all the events.
+    """
+    rms_phi = np.array([0.011, 0.013, 0.1, 0.25, 0.4, -0.1])
+    true_r  = np.array([380.,  370.,  200., 50., 100., 100.])
+
+    hist      = RMapHistogram(6, (0, 0.3), (0, 500), rms_bins=30, r_bins=50)
+    hist.fill(rms_phi, true_r)
+    filenames = []
+    for i, sel in enumerate([slice(0, 2), slice(2, 5), slice(5, 6)]):
+        filename = os.path.join(output_tmpdir, 'test_rmap_job{}.h5'.format(i))
+        job_hist = RMapHistogram(6, (0, 0.3), (0, 500), rms_bins=30, r_bins=50)
+        job_hist.fill(rms_phi[sel], true_r[sel])
+        job_hist.write(filename)
+        filenames.append(filename)
+
+    merged = merge_rmap_histograms(filenames, 6, rms_bins=30)
+    np.testing.assert_array_equal(merged.counts,  hist.counts)
+    np.testing.assert_array_equal(merged.entries, hist.entries)
+    np.testing.assert_allclose   (merged.table()['Rpos'], hist.table()['Rpos'])
+    assert merged.underflow == hist.underflow == 1
+    assert merged.overflow  == hist.overflow  == 1
+
+    with raises(ValueError):
+        merge_rmap_histograms([], 6, rms_bins=30)